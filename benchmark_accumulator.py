@@ -0,0 +1,77 @@
+import argparse
+import os
+import random
+import tempfile
+import time
+import pandas as pd
+from row_accumulator import ColumnarAccumulator
+
+# Compares the old per-record pd.DataFrame + pd.concat pattern with
+# ColumnarAccumulator on rows shaped like the pdb_entry_extract_v2.py entry table.
+# Throughput is printed per block of rows so a slowdown over the run shows up.
+
+
+def make_rows(n_rows, n_columns, seed=0):
+    random.seed(seed)
+    columns = ['pdb_id'] + [f'field_{i}' for i in range(n_columns - 1)]
+    rows = []
+    for i in range(n_rows):
+        row = {'pdb_id': f'{i:04X}'}
+        for col in columns[1:]:
+            row[col] = random.choice([None, random.randint(0, 1000), round(random.random(), 3), 'X-RAY DIFFRACTION'])
+        rows.append(row)
+    return columns, rows
+
+
+def run_concat(columns, rows, output, flush_every, report_every):
+    """The old pattern: one-row frame per record, concatenated onto a growing frame"""
+    data = pd.DataFrame(columns=columns)
+    timings = []
+    start = time.perf_counter()
+    for index, row in enumerate(rows):
+        row_df = pd.DataFrame({col: [row.get(col)] for col in columns})
+        data = pd.concat([data, row_df], ignore_index=True, sort=False)
+        if index % flush_every == 0 or index == len(rows) - 1:
+            data.to_csv(output, mode='a', index=False, header=not os.path.exists(output))
+            data = pd.DataFrame(columns=columns)
+        if (index + 1) % report_every == 0:
+            timings.append(time.perf_counter() - start)
+            start = time.perf_counter()
+    return timings
+
+
+def run_accumulator(columns, rows, output, flush_every, report_every):
+    data = ColumnarAccumulator(columns, capacity=flush_every)
+    timings = []
+    start = time.perf_counter()
+    for index, row in enumerate(rows):
+        data.add(row)
+        if data.full():
+            data.flush_csv(output)
+        if (index + 1) % report_every == 0:
+            timings.append(time.perf_counter() - start)
+            start = time.perf_counter()
+    data.flush_csv(output)
+    return timings
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark per-row DataFrame concat against ColumnarAccumulator")
+    parser.add_argument('--rows', type=int, default=10000)
+    parser.add_argument('--columns', type=int, default=50, help="The entry table has 50 columns")
+    parser.add_argument('--flush-every', type=int, default=5000)
+    parser.add_argument('--report-every', type=int, default=1000)
+    args = parser.parse_args()
+
+    columns, rows = make_rows(args.rows, args.columns)
+    with tempfile.TemporaryDirectory() as tmp:
+        for label, run in (('per-row DataFrame + pd.concat', run_concat), ('ColumnarAccumulator', run_accumulator)):
+            output = os.path.join(tmp, label.split()[0] + '.csv')
+            timings = run(columns, rows, output, args.flush_every, args.report_every)
+            rates = [args.report_every / t for t in timings]
+            print(f"{label}: {args.rows / sum(timings):.0f} rows/s overall")
+            print("  rows/s per block: " + " ".join(f"{r:.0f}" for r in rates))
+
+
+if __name__ == "__main__":
+    main()
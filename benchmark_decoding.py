@@ -0,0 +1,50 @@
+import argparse
+import time
+from record_decoding import RecordDecoder, available_backends, schemas
+from record_store import list_records
+
+# Times each decoder on a sample of stored responses. Example:
+#   python benchmark_decoding.py --json-folder .../pdb_json_entities --schema polymer_entity
+
+
+def time_decoder(decoder, bodies, repeat):
+    """Best wall time of repeat passes over bodies, in seconds"""
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for body in bodies:
+            decoder.decode(body)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare JSON decoders on stored API responses")
+    parser.add_argument('--json-folder', required=True, help="JSON directory or record store")
+    parser.add_argument('--schema', choices=sorted(schemas), default=None,
+                        help="Also time the typed decoder for this extractor schema")
+    parser.add_argument('--prefix', default="", help="Only use records whose name starts with this")
+    parser.add_argument('--limit', type=int, default=2000, help="Number of records to decode")
+    parser.add_argument('--repeat', type=int, default=3, help="Passes per decoder; the best one is reported")
+    args = parser.parse_args()
+
+    records = list_records(args.json_folder, args.prefix)[:args.limit]
+    bodies = [r.read() for r in records]
+    megabytes = sum(len(b) for b in bodies) / 1e6
+    print(f"Decoding {len(bodies)} records ({megabytes:.1f} MB), best of {args.repeat}")
+
+    decoders = [(f"{backend} (whole document)", RecordDecoder(None, backend)) for backend in reversed(available_backends)]
+    if args.schema and 'msgspec' in available_backends:
+        decoders.append((f"msgspec ({args.schema} schema)", RecordDecoder(args.schema, 'msgspec')))
+
+    baseline = None
+    for label, decoder in decoders:
+        elapsed = time_decoder(decoder, bodies, args.repeat)
+        baseline = elapsed if baseline is None else baseline
+        print(f"{label:<36} {len(bodies) / elapsed:>10.0f} records/s {megabytes / elapsed:>8.1f} MB/s "
+              f"{baseline / elapsed:>6.2f}x  fallbacks: {decoder.fallbacks // args.repeat}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,52 @@
+import argparse
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+import pdb_entity_extract_v3 as entity_extract
+from record_store import list_records
+
+# Compares one-file-per-task dispatch (executor.map with the default chunksize)
+# with the chunked, adaptive worker mode of pdb_entity_extract_v3.py. Only the
+# extraction is timed; nothing is written. Example:
+#   python benchmark_entity_dispatch.py --json-folder .../pdb_entity_json --limit 50000
+
+
+def drain(blocks):
+    """Consume a block iterator, returning (rows, failures, seconds)"""
+    start = time.perf_counter()
+    rows = 0
+    failures = 0
+    for columns, failed, _ in blocks:
+        rows += len(columns[entity_extract.entity_columns[0]])
+        failures += len(failed)
+    return rows, failures, time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark per-file and chunked dispatch for pdb_entity_extract_v3")
+    parser.add_argument('--json-folder', required=True, help="JSON directory or record store")
+    parser.add_argument('--prefix', default="response_entry_", help="Only use records whose name starts with this")
+    parser.add_argument('--limit', type=int, default=20000, help="Number of records to extract")
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1)
+    args = parser.parse_args()
+
+    records = list_records(args.json_folder, args.prefix)[:args.limit]
+    print(f"Extracting {len(records)} records with {args.workers} workers")
+
+    runs = [
+        ('one file per task', lambda executor: entity_extract.extract_per_file(executor, records)),
+        ('adaptive chunks', lambda executor: entity_extract.extract_blocks(executor, records, args.workers)),
+    ]
+    baseline = None
+    for label, blocks in runs:
+        # A fresh pool per run, started before the clock so spawn cost is not counted
+        with ProcessPoolExecutor(max_workers=args.workers) as executor:
+            list(executor.map(abs, range(args.workers)))
+            rows, failures, elapsed = drain(blocks(executor))
+        baseline = elapsed if baseline is None else baseline
+        print(f"{label:<20} {len(records) / elapsed:>10.0f} files/s {baseline / elapsed:>6.2f}x  "
+              f"rows: {rows}  failures: {failures}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,193 @@
+import argparse
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from collections import Counter
+import requests
+import emdb_pull
+import empiar_pullv2
+import pdb_entity_pull
+import pdb_entry_pull
+from fetch_engine import run_fetch
+from metrics import RunMetrics
+from mock_archive_server import add_fault_arguments
+from record_store import list_records
+from retry_scheduler import RetryScheduler
+
+# Measures puller throughput against a local mock_archive_server.py serving a
+# synthetic_corpus.py corpus, so concurrency, rate and retry settings can be tuned
+# under injected latency, errors and rate limits without touching the live
+# services. Each puller's own URLs, request settings and transform are used; the
+# bodies are written to a scratch directory that is removed afterwards. Example:
+#   python benchmark_pullers.py --corpus /scratch/corpus --latency 80 --jitter 30 \
+#       --error-rate 0.02 --rate-limit 50 --rate 100 --concurrency 5 20 50
+
+repo_dir = os.path.dirname(os.path.abspath(__file__))
+
+
+def set_base_url(base_url):
+    pdb_entry_pull.rcsb_base_url = pdb_entry_pull.rcsb_search_base_url = base_url
+    pdb_entity_pull.rcsb_base_url = base_url
+    emdb_pull.ebi_base_url = base_url
+    empiar_pullv2.ebi_base_url = base_url
+
+
+def record_ids(corpus, directory, prefix):
+    return [r.name[len(prefix):-len('.json')] for r in list_records(os.path.join(corpus, directory), prefix)]
+
+
+def puller_jobs(corpus, output):
+    """
+    (module, jobs, run_fetch keyword arguments) of each puller, as its main block builds them
+
+    EMPIAR is asked about every EMDB map; maps without raw data answer 404, as they do live.
+    """
+    emdb_ids = record_ids(corpus, 'emdb', 'response_emdb_')
+    return {
+        'entry': (pdb_entry_pull, [(i, pdb_entry_pull.entry_url(i), os.path.join(output, pdb_entry_pull.entry_file_name(i)))
+                                   for i in record_ids(corpus, 'entry', 'response_entry_')], {}),
+        'entity': (pdb_entity_pull, [(i, pdb_entity_pull.entity_url(*pdb_entity_pull.split_record_id(i)),
+                                      os.path.join(output, pdb_entity_pull.record_file_name(i)))
+                                     for i in record_ids(corpus, 'entity', 'response_entry_')], {}),
+        'emdb': (emdb_pull, [(i, emdb_pull.emdb_url(i), os.path.join(output, emdb_pull.emdb_file_name(i)))
+                             for i in emdb_ids], {}),
+        'empiar': (empiar_pullv2, [(i, empiar_pullv2.empiar_url(i), os.path.join(output, empiar_pullv2.empiar_file_name(i)))
+                                   for i in emdb_ids], {'timeout': 30, 'transform': empiar_pullv2.insert_emdb_id}),
+    }
+
+
+def server_stats(base_url):
+    return requests.get(f"{base_url}/mock/stats", timeout=10).json()
+
+
+def start_server(args):
+    """Start mock_archive_server.py on the corpus in its own process and wait until it answers"""
+    command = [sys.executable, os.path.join(repo_dir, 'mock_archive_server.py'), '--port', str(args.port),
+               '--payloads'] + [os.path.join(args.corpus, d) for d in ('entry', 'entity', 'emdb', 'empiar')]
+    for option in ('latency', 'jitter', 'not_found_rate', 'throttle_rate', 'error_rate', 'timeout_rate',
+                   'hang_seconds', 'rate_limit', 'retry_after', 'seed'):
+        value = getattr(args, option)
+        if value is not None:
+            command += ['--' + option.replace('_', '-'), str(value)]
+    server = subprocess.Popen(command, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+    base_url = f"http://localhost:{args.port}"
+    deadline = time.time() + 30
+    while True:
+        try:
+            server_stats(base_url)
+            return server, base_url
+        except requests.RequestException:
+            if server.poll() is not None or time.time() > deadline:
+                server.kill()
+                raise RuntimeError("mock_archive_server.py did not start")
+            time.sleep(0.2)
+
+
+def run_puller(name, jobs, fetch_kwargs, concurrency, rate, base_url, args):
+    before = server_stats(base_url)
+    retry = RetryScheduler(max_attempts=args.max_attempts, base_delay=args.base_delay)
+    metrics = RunMetrics(f"{name}_c{concurrency}" + ('_adaptive' if args.adaptive else ''), directory=args.metrics_dir)
+    start = time.perf_counter()
+    results = run_fetch(jobs, concurrency=concurrency, rate=rate, timeout=fetch_kwargs.get('timeout', args.timeout),
+                        retry=retry, transform=fetch_kwargs.get('transform'), metrics=metrics,
+                        adaptive=args.adaptive)
+    elapsed = time.perf_counter() - start
+    after = server_stats(base_url)
+    metrics.close()
+    summary = metrics.summary()
+    latency = summary['histograms'].get('request_seconds', {})
+    limit = summary['gauges'].get('concurrency_limit', {})
+
+    statuses = Counter(str(status) for status in results.values())
+    answers = Counter({s: n - before['statuses'].get(s, 0) for s, n in after['statuses'].items()})
+    requests_sent = after['requests'] - before['requests']
+    return {
+        'puller': name,
+        'concurrency': concurrency,
+        'adaptive': args.adaptive,
+        'final_concurrency_limit': next(iter(limit.values()), None),
+        'concurrency_decreases': int(metrics.total('concurrency_decreases_total')),
+        'rate': rate,
+        'records': len(jobs),
+        'seconds': round(elapsed, 3),
+        'records_per_second': round(len(jobs) / elapsed, 1),
+        'fetched_per_second': round(statuses.get('200', 0) / elapsed, 1),
+        'requests': requests_sent,
+        'requests_per_second': round(requests_sent / elapsed, 1),
+        'retries': requests_sent - len(jobs),
+        'final_statuses': dict(statuses),
+        'server_answers': {s: n for s, n in answers.items() if n},
+        'latency_seconds': next(iter(latency.values()), None),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the pullers against a local mock archive server")
+    parser.add_argument('--corpus', required=True, help="Directory written by synthetic_corpus.py")
+    parser.add_argument('--pullers', nargs='+', default=['entry', 'entity', 'emdb', 'empiar'],
+                        choices=['entry', 'entity', 'emdb', 'empiar'])
+    parser.add_argument('--limit', type=int, default=1000, help="Records requested per puller")
+    parser.add_argument('--concurrency', type=int, nargs='+', default=None,
+                        help="Requests in flight to try (default: each puller's own setting)")
+    parser.add_argument('--rate', type=float, default=None,
+                        help="Requests started per second (default: each puller's own setting)")
+    parser.add_argument('--adaptive', action='store_true',
+                        help="Let the AIMD limiter set the requests in flight, up to --concurrency")
+    parser.add_argument('--timeout', type=float, default=60, help="Client timeout per request in seconds")
+    parser.add_argument('--max-attempts', type=int, default=6)
+    parser.add_argument('--base-delay', type=float, default=1.0, help="Retry backoff base delay in seconds")
+    parser.add_argument('--port', type=int, default=8089)
+    parser.add_argument('--seed', type=int, default=0, help="Seed of the server's fault draws")
+    parser.add_argument('--results', default='benchmark_pullers.json', help="Results JSON")
+    parser.add_argument('--metrics-dir', default='benchmark_pullers_metrics',
+                        help="Metrics textfile and summary of each run go here")
+    add_fault_arguments(parser)
+    args = parser.parse_args()
+
+    server, base_url = start_server(args)
+    output = tempfile.mkdtemp(prefix='benchmark_pullers_')
+    results = []
+    try:
+        set_base_url(base_url)
+        jobs_by_puller = puller_jobs(args.corpus, output)
+        for name in args.pullers:
+            module, jobs, fetch_kwargs = jobs_by_puller[name]
+            jobs = jobs[:args.limit]
+            rate = args.rate if args.rate is not None else module.requests_per_second
+            for concurrency in args.concurrency or [module.concurrency]:
+                print(f"Pulling {len(jobs)} {name} records, {concurrency} in flight, {rate} per second")
+                result = run_puller(name, jobs, fetch_kwargs, concurrency, rate, base_url, args)
+                results.append(result)
+                print(f"{name:<7} c={concurrency:<4} {result['records_per_second']:>8.1f} records/s "
+                      f"{result['requests_per_second']:>8.1f} requests/s  retries: {result['retries']}  "
+                      f"final: {result['final_statuses']}  answers: {result['server_answers']}")
+                if args.adaptive:
+                    print(f"        adaptive limit at the end {result['final_concurrency_limit']}, "
+                          f"cut {result['concurrency_decreases']} times")
+                if result['latency_seconds']:
+                    print(f"        latency p50 {result['latency_seconds']['p50']:.3f} s  "
+                          f"p99 {result['latency_seconds']['p99']:.3f} s")
+                shutil.rmtree(output)
+                os.makedirs(output)
+    finally:
+        server.terminate()
+        server.wait()
+        shutil.rmtree(output, ignore_errors=True)
+
+    faults = {option: getattr(args, option) for option in
+              ('latency', 'jitter', 'not_found_rate', 'throttle_rate', 'error_rate', 'timeout_rate',
+               'hang_seconds', 'rate_limit', 'retry_after', 'seed')}
+    with open(args.results, 'w') as f:
+        json.dump({'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'), 'corpus': os.path.abspath(args.corpus),
+                   'faults': faults, 'timeout': args.timeout, 'max_attempts': args.max_attempts,
+                   'base_delay': args.base_delay, 'results': results}, f, indent=4)
+    print(f"Results saved to {args.results}")
+
+
+if __name__ == "__main__":
+    main()
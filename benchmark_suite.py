@@ -0,0 +1,255 @@
+import argparse
+import json
+import os
+import platform
+import re
+import shutil
+import subprocess
+import sys
+import time
+import pandas as pd
+from file_inventory import FileInventory
+
+# Runs every extractor and combiner against a corpus from synthetic_corpus.py and
+# reports files/s, peak RSS and output bytes, saved as JSON so runs can be compared
+# across commits. Each script runs unchanged in its own process: a copy is written
+# to the work directory with its path constants (and output_format) pointed at the
+# corpus and the work directory. Example:
+#   python synthetic_corpus.py --output /scratch/corpus --entries 100000
+#   python benchmark_suite.py --corpus /scratch/corpus --results before.json
+#   python benchmark_suite.py --corpus /scratch/corpus --results after.json --compare before.json
+
+repo_dir = os.path.dirname(os.path.abspath(__file__))
+
+# (name, script, corpus directory it reads, path constants). Constants name a file
+# in the benchmark's output directory, or one under the corpus (corpus:), the work
+# directory (work:) or an earlier benchmark's outputs (output:).
+benchmarks = [
+    ('pdb_entry_extract_v2', 'pdb_entry_extract_v2.py', 'entry', {
+        'json_folder': 'corpus:entry',
+        'missing_pdb_ids_file': 'work:missing_pdb_ids.csv',
+        'citation_output': 'citation.csv', 'refine_output': 'refine.csv', 'entry_output': 'entry.csv',
+        'citation_parquet': 'citation.parquet', 'refine_parquet': 'refine.parquet', 'entry_parquet': 'entry.parquet',
+        'failed_output': 'failed.csv',
+    }),
+    ('pdb_entry_emdb_extract', 'pdb_entry_emdb_extract.py', 'entry', {
+        'json_folder': 'corpus:entry', 'emdb_output': 'pdb_entries_emdb_ids.csv',
+        'parquet_output': 'pdb_entries_emdb_ids.parquet', 'state_output': 'state.sqlite', 'failed_output': 'failed.csv',
+    }),
+    ('v2pdb_structures_combined', 'v2pdb_structures_combined.py', 'entry', {
+        'json_folder': 'corpus:entry', 'combined_output': 'pdb_structures_combined.csv',
+        'parquet_output': 'pdb_structures_combined.parquet', 'checkpoint_output': 'checkpoint.sqlite',
+        'state_output': 'state.sqlite', 'failed_output': 'failed.csv',
+    }),
+    ('pdb_entity_extract_v3', 'pdb_entity_extract_v3.py', 'entity', {
+        'json_folder': 'corpus:entity', 'csv_output': 'pdb_entities_v3.csv', 'parquet_output': 'pdb_entities_v3.parquet',
+        'state_output': 'state.sqlite', 'failed_output': 'failed.csv',
+    }),
+    ('v2pdb_async_entities_combined', 'v2pdb_async_entities_combined.py', 'entity', {
+        'json_folder': 'corpus:entity', 'combined_output': 'pdb_entities_combined.csv',
+        'parquet_output': 'pdb_entities_combined.parquet', 'checkpoint_output': 'checkpoint.sqlite',
+        'state_output': 'state.sqlite', 'failed_output': 'failed.csv',
+    }),
+    ('emdb_extract', 'emdb_extract.py', 'emdb', {
+        'json_folder': 'corpus:emdb', 'emdb_output': 'emdb_structures.csv', 'parquet_output': 'emdb_structures.parquet',
+        'checkpoint_output': 'checkpoint.sqlite', 'state_output': 'state.sqlite', 'failed_output': 'failed.csv',
+    }),
+    ('empiar_extract_v2', 'empiar_extract_v2.py', 'empiar', {
+        'json_folder': 'corpus:empiar', 'csv_output': 'empiar_structures.csv',
+        'parquet_output': 'empiar_structures.parquet', 'merged_output': 'merged_empiar_emdb.csv',
+        'emdb_file': 'output:emdb_extract/emdb_structures.csv',
+    }),
+    ('emdb_pdb_merge', 'emdb_pdb_merge.py', 'emdb', {
+        'emdb_output': 'output:emdb_extract/emdb_structures.csv',
+        'pdb_emdb_output': 'output:pdb_entry_emdb_extract/pdb_entries_emdb_ids.csv',
+        'merged_output': 'emdb_empiar_merged.csv',
+    }),
+]
+
+
+def directory_bytes(directory):
+    total = 0
+    for root, _, files in os.walk(directory):
+        total += sum(os.path.getsize(os.path.join(root, f)) for f in files)
+    return total
+
+
+def corpus_listing(corpus, inventory):
+    """Number of files and bytes in each corpus directory, warming the inventory on the way"""
+    listing = {}
+    for kind in ('entry', 'entity', 'emdb', 'empiar'):
+        entries = inventory.entries(os.path.join(corpus, kind), suffix='.json')
+        listing[kind] = {'files': len(entries), 'bytes': sum(size or 0 for _, size, _ in entries)}
+    return listing, [name[len('response_entry_'):-len('.json')] for name, _, _ in
+                     inventory.entries(os.path.join(corpus, 'entry'), 'response_entry_', '.json', refresh=False)]
+
+
+def resolve(value, corpus, work_dir, output_dir):
+    if value.startswith('corpus:'):
+        return os.path.join(corpus, value[len('corpus:'):])
+    if value.startswith('work:'):
+        return os.path.join(work_dir, value[len('work:'):])
+    if value.startswith('output:'):
+        return os.path.join(work_dir, 'outputs', value[len('output:'):])
+    return os.path.join(output_dir, value)
+
+
+def patch_script(source, constants, preamble):
+    """Source of a script with its top-level constants replaced; raises if one is missing"""
+    for name, value in constants.items():
+        source, replaced = re.subn(rf'^{name} = .*$', lambda m: f"{name} = {value!r}", source, flags=re.MULTILINE)
+        if replaced == 0:
+            raise ValueError(f"{name} is not set in the script")
+    return preamble + source
+
+
+def run_script(path, log_path):
+    """
+    Run a script in its own process
+
+    Returns:
+        (exit code, wall seconds, peak RSS of the largest process in bytes)
+    """
+    env = dict(os.environ, PYTHONPATH=repo_dir + os.pathsep + os.environ.get('PYTHONPATH', ''))
+    with open(log_path, 'w') as log:
+        start = time.perf_counter()
+        process = subprocess.Popen([sys.executable, path], cwd=os.path.dirname(path), env=env,
+                                   stdout=log, stderr=subprocess.STDOUT)
+        # wait4 reports the peak RSS of the script and of the workers it waited for
+        _, status, usage = os.wait4(process.pid, 0)
+        elapsed = time.perf_counter() - start
+        process.returncode = os.waitstatus_to_exitcode(status)
+    max_rss = usage.ru_maxrss * (1 if sys.platform == 'darwin' else 1024)
+    return process.returncode, elapsed, max_rss
+
+
+def run_benchmark(name, script, kind, constants, corpus, work_dir, listing, output_format):
+    # Start from an empty output directory, so output_bytes counts this run only
+    output_dir = os.path.join(work_dir, 'outputs', name)
+    shutil.rmtree(output_dir, ignore_errors=True)
+    os.makedirs(output_dir)
+    values = {key: resolve(value, corpus, work_dir, output_dir) for key, value in constants.items()}
+
+    with open(os.path.join(repo_dir, script), 'r') as f:
+        source = f.read()
+    if output_format is not None and re.search(r'^output_format = ', source, flags=re.MULTILINE):
+        values['output_format'] = output_format
+    # Keep the catalog, the file inventory and the metrics files of the run inside the work directory
+    metrics_dir = os.path.join(work_dir, 'metrics', name)
+    preamble = ("import catalog, file_inventory, metrics as metrics_module\n"
+                f"catalog.default_catalog_path = {os.path.join(output_dir, 'catalog.sqlite')!r}\n"
+                f"file_inventory.default_index_path = {os.path.join(work_dir, 'inventory.sqlite')!r}\n"
+                f"metrics_module.default_metrics_dir = {metrics_dir!r}\n")
+    script_path = os.path.join(work_dir, 'scripts', script)
+    with open(script_path, 'w') as f:
+        f.write(patch_script(source, values, preamble))
+
+    log_path = os.path.join(work_dir, 'logs', name + '.log')
+    exit_code, seconds, max_rss = run_script(script_path, log_path)
+    files = listing[kind]['files']
+    # Stage timings the script recorded (see metrics.py)
+    stages = None
+    summary_path = os.path.join(metrics_dir, os.path.splitext(script)[0] + '.json')
+    if os.path.exists(summary_path):
+        with open(summary_path, 'r') as f:
+            stages = json.load(f)['histograms']
+    return {
+        'name': name,
+        'script': script,
+        'input_files': files,
+        'input_bytes': listing[kind]['bytes'],
+        'seconds': round(seconds, 3),
+        'files_per_second': round(files / seconds, 1) if seconds > 0 else None,
+        'peak_rss_bytes': max_rss,
+        'output_bytes': directory_bytes(output_dir),
+        'exit_code': exit_code,
+        'stages': stages,
+        'log': log_path,
+    }
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=repo_dir, capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def print_results(results, previous=None):
+    baseline = {r['name']: r for r in previous['results']} if previous else {}
+    for r in results:
+        line = (f"{r['name']:<30} {r['files_per_second'] or 0:>9.0f} files/s {r['seconds']:>8.1f} s "
+                f"{r['peak_rss_bytes'] / 1e6:>8.0f} MB RSS {r['output_bytes'] / 1e6:>8.1f} MB out")
+        old = baseline.get(r['name'])
+        if old is not None and old.get('files_per_second') and r['files_per_second']:
+            line += f" {r['files_per_second'] / old['files_per_second']:>6.2f}x"
+        if r['exit_code'] != 0:
+            line += f"  FAILED (exit {r['exit_code']})"
+        print(line)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the extract and combine scripts on a synthetic corpus")
+    parser.add_argument('--corpus', required=True, help="Directory written by synthetic_corpus.py")
+    parser.add_argument('--work-dir', default='benchmark_work', help="Outputs, logs and patched scripts go here")
+    parser.add_argument('--results', default=None, help="Results JSON (default: benchmark_<commit>.json)")
+    parser.add_argument('--compare', default=None, help="Earlier results JSON to report speedups against")
+    parser.add_argument('--only', nargs='+', default=None, choices=[b[0] for b in benchmarks],
+                        help="Run these benchmarks only (in suite order)")
+    parser.add_argument('--output-format', choices=['csv', 'parquet', 'both'], default=None,
+                        help="Override the output_format of the scripts that have one")
+    args = parser.parse_args()
+
+    corpus = os.path.abspath(args.corpus)
+    work_dir = os.path.abspath(args.work_dir)
+    for sub in ('outputs', 'logs', 'scripts'):
+        os.makedirs(os.path.join(work_dir, sub), exist_ok=True)
+
+    # List the corpus once up front, so every script starts from a warm inventory
+    inventory = FileInventory(os.path.join(work_dir, 'inventory.sqlite'))
+    listing, entry_ids = corpus_listing(corpus, inventory)
+    inventory.close()
+    print("Corpus: " + ', '.join(f"{n['files']} {kind}" for kind, n in listing.items()))
+
+    # pdb_entry_extract_v2 only extracts the entries listed in its missing IDs file
+    pd.DataFrame({'pdb_id': entry_ids}).to_csv(os.path.join(work_dir, 'missing_pdb_ids.csv'), index=False)
+
+    results = []
+    for name, script, kind, constants in benchmarks:
+        if args.only is not None and name not in args.only:
+            continue
+        print(f"Running {name} on {listing[kind]['files']} files")
+        results.append(run_benchmark(name, script, kind, constants, corpus, work_dir, listing, args.output_format))
+        print_results(results[-1:])
+
+    previous = None
+    if args.compare is not None:
+        with open(args.compare, 'r') as f:
+            previous = json.load(f)
+    commit = git_commit()
+    report = {
+        'commit': commit,
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpu_count': os.cpu_count(),
+        'output_format': args.output_format,
+        'corpus': listing,
+        'results': results,
+    }
+    manifest = os.path.join(corpus, 'corpus.json')
+    if os.path.exists(manifest):
+        with open(manifest, 'r') as f:
+            report['corpus_manifest'] = json.load(f)
+
+    results_path = args.results or f"benchmark_{commit or 'results'}.json"
+    with open(results_path, 'w') as f:
+        json.dump(report, f, indent=4)
+
+    print(f"\nResults saved to {results_path}" + (f", compared with {args.compare}" if previous else ""))
+    print_results(results, previous)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,305 @@
+import csv
+import json
+import os
+import re
+import sqlite3
+import time
+import pandas as pd
+
+# SQLite catalog of the extracted tables. The extractors upsert their batches into
+# one table each (keyed as in table_keys) as they write their CSVs, and the
+# comma- or #-separated ID lists are normalized into indexed link tables
+# (pdb_id <-> emdb_id <-> empiar_id). The merges that used to explode and join
+# whole CSVs in pandas are views over these tables, so they run inside SQLite
+# without loading the archive into memory and can be exported to CSV at any time.
+# The time each table was last written is kept in table_loads, so a merge can tell
+# when an extractor's CSV is newer than what the catalog holds and reload it.
+default_catalog_path = "/home/zhn1744/AlphaFold/data/catalog.sqlite"
+
+# Primary key column of each extracted table
+table_keys = {
+    'entry': 'pdb_id',
+    'entity': 'rcsb_id',
+    'emdb': 'emdb_id',
+    'entry_emdb': 'pdb_id',
+    'empiar': 'empiar_id',
+}
+
+# Link tables: name -> (table the links are derived from, its key column, linked ID column)
+link_tables = {
+    'pdb_emdb': ('entry_emdb', 'pdb_id', 'emdb_id'),
+    'emdb_empiar': ('empiar', 'empiar_id', 'emdb_id'),
+}
+
+# Rows fetched per round trip when exporting
+export_batch = 10000
+
+
+def quote(name):
+    return '"' + name.replace('"', '""') + '"'
+
+
+def sql_value(value):
+    if isinstance(value, (list, dict)):
+        return json.dumps(value)
+    if hasattr(value, 'item') and not isinstance(value, (str, bytes)):
+        # numpy scalars from DataFrames
+        value = value.item()
+    if isinstance(value, float) and value != value:
+        return None
+    return value
+
+
+def pdb_emdb_links(data):
+    """(pdb_id, emdb_id) pairs from the comma-separated emdb_ids of entry_emdb rows"""
+    pairs = []
+    for pdb_id, emdb_ids in zip(data.get('pdb_id', []), data.get('emdb_ids', [])):
+        if not isinstance(emdb_ids, str):
+            continue
+        for emdb_id in emdb_ids.split(','):
+            if emdb_id.strip():
+                pairs.append((pdb_id, emdb_id.strip()))
+    return pairs
+
+
+def emdb_empiar_links(data):
+    """(empiar_id, emdb_id) pairs from the #-separated cross_references of empiar rows"""
+    pairs = []
+    for empiar_id, references in zip(data.get('empiar_id', []), data.get('cross_references', [])):
+        if not isinstance(references, str):
+            continue
+        for reference in references.split('#'):
+            match = re.search(r'(EMD-\d+)', reference)
+            if match:
+                pairs.append((empiar_id, match.group(1)))
+    return pairs
+
+
+link_functions = {'pdb_emdb': pdb_emdb_links, 'emdb_empiar': emdb_empiar_links}
+
+
+def merge_select(left_alias, left_columns, right_alias, right_columns, on):
+    """Select list of a pandas-style merge: shared columns other than on get _x / _y"""
+    select = []
+    for column in left_columns:
+        name = column + '_x' if column != on and column in right_columns else column
+        select.append(f"{left_alias}.{quote(column)} AS {quote(name)}")
+    for column in right_columns:
+        if column == on:
+            continue
+        name = column + '_y' if column in left_columns else column
+        select.append(f"{right_alias}.{quote(column)} AS {quote(name)}")
+    return ', '.join(select)
+
+
+class Catalog:
+    """
+    Connection to the catalog database
+
+    Args:
+        path: Catalog file, default_catalog_path if None
+    """
+
+    def __init__(self, path=None):
+        self.path = path if path is not None else default_catalog_path
+        self.conn = sqlite3.connect(self.path, timeout=60)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        for link, (_, key, linked) in link_tables.items():
+            self.conn.execute(f"""
+                CREATE TABLE IF NOT EXISTS {link} (
+                    {key} TEXT NOT NULL,
+                    {linked} TEXT NOT NULL,
+                    PRIMARY KEY ({key}, {linked})
+                )
+            """)
+            self.conn.execute(f"CREATE INDEX IF NOT EXISTS {link}_{linked} ON {link} ({linked})")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS table_loads (name TEXT PRIMARY KEY, loaded_at REAL NOT NULL)")
+        self.conn.commit()
+
+    def has_table(self, table):
+        return self.conn.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?",
+                                 (table,)).fetchone() is not None
+
+    def loaded_at(self, table):
+        """Time (seconds since the epoch) table was last written, or None"""
+        row = self.conn.execute("SELECT loaded_at FROM table_loads WHERE name = ?", (table,)).fetchone()
+        return row[0] if row is not None else None
+
+    def columns(self, table):
+        return [r[1] for r in self.conn.execute(f"PRAGMA table_info({quote(table)})")]
+
+    def count(self, table):
+        return self.conn.execute(f"SELECT COUNT(*) FROM {quote(table)}").fetchone()[0]
+
+    def ensure_table(self, table, columns):
+        """Create table keyed on its table_keys column, adding any columns it lacks"""
+        key = table_keys[table]
+        if not self.has_table(table):
+            others = ''.join(f", {quote(c)}" for c in columns if c != key)
+            self.conn.execute(f"CREATE TABLE {quote(table)} ({quote(key)} TEXT PRIMARY KEY{others})")
+            return
+        existing = set(self.columns(table))
+        for column in columns:
+            if column not in existing:
+                self.conn.execute(f"ALTER TABLE {quote(table)} ADD COLUMN {quote(column)}")
+
+    def clear(self, table):
+        """Empty table and the links derived from it"""
+        if self.has_table(table):
+            self.conn.execute(f"DELETE FROM {quote(table)}")
+        for link, (source, _, _) in link_tables.items():
+            if source == table:
+                self.conn.execute(f"DELETE FROM {link}")
+
+    def upsert(self, table, data):
+        """
+        Insert or replace a batch given as a dictionary of column -> list of values
+
+        Links derived from the table are replaced for the keys in the batch.
+        """
+        columns = list(data)
+        size = len(data[columns[0]]) if columns else 0
+        if size == 0:
+            return
+        self.ensure_table(table, columns)
+        placeholders = ', '.join('?' * len(columns))
+        self.conn.executemany(
+            f"INSERT OR REPLACE INTO {quote(table)} ({', '.join(quote(c) for c in columns)}) VALUES ({placeholders})",
+            ([sql_value(v) for v in row] for row in zip(*(data[c] for c in columns))))
+
+        for link, (source, key, linked) in link_tables.items():
+            if source != table:
+                continue
+            self.conn.executemany(f"DELETE FROM {link} WHERE {key} = ?", ((k,) for k in data[key]))
+            self.conn.executemany(f"INSERT OR IGNORE INTO {link} ({key}, {linked}) VALUES (?, ?)",
+                                  link_functions[link](data))
+        self.conn.execute("INSERT OR REPLACE INTO table_loads (name, loaded_at) VALUES (?, ?)", (table, time.time()))
+
+    def load_csv(self, table, csv_path, chunksize=50000):
+        """Upsert an extractor's existing CSV output, a chunk at a time"""
+        rows = 0
+        for chunk in pd.read_csv(csv_path, dtype=str, chunksize=chunksize):
+            self.upsert(table, {c: chunk[c].tolist() for c in chunk.columns})
+            rows += len(chunk)
+        self.conn.commit()
+        return rows
+
+    def load_csv_if_newer(self, table, csv_path):
+        """
+        Make table hold an extractor's CSV output
+
+        The table is kept as it is when it was written (by the extractor with
+        load_catalog = True, or an earlier load) after the CSV; otherwise it is
+        emptied and loaded again from the CSV, so rows of a later extractor run
+        are not missed.
+
+        Returns:
+            Number of rows loaded, or None if the table was already current
+        """
+        loaded_at = self.loaded_at(table)
+        if self.has_table(table) and loaded_at is not None and os.path.getmtime(csv_path) <= loaded_at:
+            return None
+        self.clear(table)
+        return self.load_csv(table, csv_path)
+
+    def refresh_views(self):
+        """(Re)create the merge views over the tables that exist"""
+        self.conn.execute("DROP VIEW IF EXISTS emdb_pdb_merged")
+        self.conn.execute("DROP VIEW IF EXISTS empiar_emdb_merged")
+        if self.has_table('emdb'):
+            # Every EMDB entry with the PDB entries that list it (emdb_pdb_merge.py)
+            emdb_columns = self.columns('emdb')
+            select = merge_select('e', emdb_columns, 'l', ['emdb_id', 'pdb_id'], 'emdb_id')
+            self.conn.execute(f"""
+                CREATE VIEW emdb_pdb_merged AS
+                SELECT {select} FROM emdb e LEFT JOIN pdb_emdb l ON l.emdb_id = e.emdb_id
+                ORDER BY e.rowid
+            """)
+            if self.has_table('empiar'):
+                # Every EMDB entry with the EMPIAR entries that reference it (empiar_extract_v2.py)
+                empiar_columns = [c for c in self.columns('empiar')] + ['emdb_id']
+                select = merge_select('e', emdb_columns, 'p', empiar_columns, 'emdb_id')
+                self.conn.execute(f"""
+                    CREATE VIEW empiar_emdb_merged AS
+                    SELECT {select} FROM emdb e LEFT JOIN (
+                        SELECT empiar.*, l.emdb_id FROM emdb_empiar l JOIN empiar ON empiar.empiar_id = l.empiar_id
+                    ) p ON p.emdb_id = e.emdb_id
+                    ORDER BY e.rowid
+                """)
+        self.conn.commit()
+
+    def export(self, query, csv_path, params=()):
+        """
+        Write the result of a query (or the name of a table or view) to a CSV
+
+        Returns:
+            Number of rows written
+        """
+        if re.fullmatch(r'\w+', query):
+            query = f"SELECT * FROM {query}"
+        cursor = self.conn.execute(query, params)
+        rows = 0
+        with open(csv_path, 'w', newline='', encoding='utf-8') as f:
+            writer = csv.writer(f)
+            writer.writerow([d[0] for d in cursor.description])
+            while True:
+                batch = cursor.fetchmany(export_batch)
+                if not batch:
+                    break
+                writer.writerows(batch)
+                rows += len(batch)
+        return rows
+
+    def commit(self):
+        self.conn.commit()
+
+    def close(self):
+        self.conn.commit()
+        self.conn.close()
+
+
+class CatalogTable:
+    """
+    Loads an extractor's batches into one catalog table as they are written
+
+    Has the write_columns / write_rows / write_frame / close interface of
+    parquet_output.ParquetBatchWriter. Each batch is committed, so a killed run
+    keeps what it loaded and a resumed one upserts the rest.
+
+    Args:
+        table: One of table_keys
+        replace: Empty the table first (full runs); otherwise rows are upserted
+        path: Catalog file, default_catalog_path if None
+    """
+
+    def __init__(self, table, replace=False, path=None):
+        self.table = table
+        self.catalog = Catalog(path)
+        self.row_count = 0
+        if replace:
+            self.catalog.clear(table)
+            self.catalog.commit()
+
+    def write_columns(self, data):
+        self.catalog.upsert(self.table, data)
+        self.catalog.commit()
+        self.row_count += len(next(iter(data.values()), []))
+
+    def write_rows(self, rows):
+        if rows:
+            columns = list(dict.fromkeys(c for row in rows for c in row))
+            self.write_columns({c: [row.get(c) for row in rows] for c in columns})
+
+    def write_frame(self, df):
+        self.write_columns({c: df[c].tolist() for c in df.columns})
+
+    def close(self):
+        """
+        Refresh the merge views and close
+
+        Returns:
+            Number of rows loaded
+        """
+        self.catalog.refresh_views()
+        self.catalog.close()
+        return self.row_count
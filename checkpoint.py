@@ -0,0 +1,95 @@
+import json
+import os
+import sqlite3
+
+# Progress record for long extraction runs. Every so often a script flushes its
+# output to disk and saves, in one SQLite transaction, the names of the inputs
+# whose rows are now in that output together with the output's state (a byte
+# offset and whatever else it needs to carry on). After a kill, --resume cuts the
+# output back to the saved offset, which drops any rows written after the last
+# checkpoint, and skips the inputs already done, so no row is written twice.
+
+
+class Checkpoint:
+    """
+    Completed inputs and output state of one extraction run
+
+    Args:
+        path: Checkpoint file, kept next to the output
+        resume: Keep an existing checkpoint instead of starting over
+    """
+
+    def __init__(self, path, resume=False):
+        self.path = path
+        if not resume:
+            self.remove()
+        self.conn = sqlite3.connect(path)
+        self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS completed (
+                name TEXT PRIMARY KEY,
+                failed INTEGER NOT NULL DEFAULT 0
+            )
+        """)
+        self.conn.execute("CREATE TABLE IF NOT EXISTS state (key TEXT PRIMARY KEY, value TEXT NOT NULL)")
+        self.conn.commit()
+        self.pending = []
+
+    def state(self):
+        """Output state of the last checkpoint, or None if there is none"""
+        row = self.conn.execute("SELECT value FROM state WHERE key = 'output'").fetchone()
+        return json.loads(row[0]) if row is not None else None
+
+    def completed(self):
+        return set(r[0] for r in self.conn.execute("SELECT name FROM completed"))
+
+    def failed(self):
+        return [r[0] for r in self.conn.execute("SELECT name FROM completed WHERE failed = 1 ORDER BY rowid")]
+
+    def done(self, name, failed=False):
+        """Note an input as done; it counts once the next save() has run"""
+        self.pending.append((name, int(failed)))
+
+    def save(self, output_state):
+        """
+        Record the inputs noted since the last save with the output state
+
+        Call only once the output holds every row of those inputs and is on disk.
+        """
+        with self.conn:
+            self.conn.executemany("INSERT OR REPLACE INTO completed (name, failed) VALUES (?, ?)", self.pending)
+            self.conn.execute("INSERT OR REPLACE INTO state (key, value) VALUES ('output', ?)",
+                              (json.dumps(output_state),))
+        self.pending = []
+
+    def close(self):
+        self.conn.close()
+
+    def remove(self):
+        """Delete the checkpoint, once the run has finished"""
+        if getattr(self, 'conn', None) is not None:
+            self.conn.close()
+            self.conn = None
+        for suffix in ('', '-journal', '-wal', '-shm'):
+            if os.path.exists(self.path + suffix):
+                os.remove(self.path + suffix)
+
+
+def sync_file(path):
+    """fsync path, returning its size (0 if it does not exist)"""
+    if not os.path.exists(path):
+        return 0
+    with open(path, 'ab') as f:
+        os.fsync(f.fileno())
+        return f.tell()
+
+
+def truncate_file(path, size):
+    """Cut path back to size bytes, dropping anything written after a checkpoint"""
+    if size == 0:
+        if os.path.exists(path):
+            os.remove(path)
+        return
+    if not os.path.exists(path) or os.path.getsize(path) < size:
+        raise ValueError(f"{path} is shorter than its checkpoint; it cannot be resumed")
+    with open(path, 'r+b') as f:
+        f.truncate(size)
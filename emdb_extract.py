@@ -1,29 +1,50 @@
+import argparse
 import os
 import json
+import time
 import pandas as pd
+from catalog import CatalogTable
+from checkpoint import Checkpoint, sync_file, truncate_file
+from field_spec import FieldSpec
+from incremental_extract import ExtractionState
+from metrics import RunMetrics
+from parquet_output import ParquetBatchWriter
+from progress import ErrorLog, Progress, error_log_path, get_logger
+from record_decoding import RecordDecoder
+from record_store import list_records
+from row_accumulator import ColumnarAccumulator
 
-# Initialize an empty DataFrame
-emdb_data = pd.DataFrame(columns=[])
-
-# Set the folder path where the JSON files are located
+# Set the folder path (or record store) where the JSON files are located
 json_folder = '/kellogg/proj/rrh3749/Working_Projects/AlphaFold/data/emdb_json'
 emdb_output = "/home/zhn1744/AlphaFold/data/emdb/emdb_structures.csv"
 failed_output = "/home/zhn1744/AlphaFold/data/failed/emdb_entries_failed.csv"
-failed_filenames = []
-cursor_index = 0
 
-try:
-    os.remove(emdb_output)
-except:
-    pass
+# "csv", "parquet" or "both"
+output_format = "csv"
+parquet_output = "/home/zhn1744/AlphaFold/data/emdb/emdb_structures.parquet"
+
+# Also load the rows into the SQLite catalog (see catalog.py)
+load_catalog = False
+
+# Progress is saved each time a batch is written to the CSV, so that a killed run
+# can carry on with --resume instead of starting over
+checkpoint_output = "/home/zhn1744/AlphaFold/data/emdb/emdb_structures.checkpoint.sqlite"
 
-file_paths = [os.path.join(json_folder, f) for f in os.listdir(json_folder)
-              if f.startswith("response_emdb_EMD") and f.endswith(".json")]
+# Only extract files that are new or changed since the last run, keeping the
+# rows of every file in state_output (see incremental_extract.py)
+incremental = False
+state_output = "/home/zhn1744/AlphaFold/data/emdb/emdb_structures.state.sqlite"
 
-#file_paths = [os.path.join(json_folder, "response_emdb_EMD-17212,EMD-17254,EMD-17255.json")]
+# Parquet types of the numeric columns; the rest (mostly "value units" strings) stay strings
+emdb_types = {'buffer_ph': 'float64', 'calibrated_magnification': 'int64', 'number_real_images': 'int64',
+              'number_images_used': 'int64', 'map_dimensions_x': 'int64', 'map_dimensions_y': 'int64',
+              'map_dimensions_z': 'int64'}
 
-total_files = len(file_paths)
-print(f"Total files to process: {total_files}")
+# Skip the sample, interpretation and validation sections while decoding
+decoder = RecordDecoder('emdb')
+
+# Throttled progress lines (see progress.py)
+logger = get_logger('emdb_extract')
 
 def get_buffer_components(buffer_data):
     if not buffer_data or 'component' not in buffer_data:
@@ -67,128 +88,207 @@ def format_pretreatment(pretreat):
             parts.append(f"Pressure: {pressure}")
     return '; '.join(parts)
 
-for index, file_path in enumerate(file_paths, start=1):
-    print(f"Processing {index} of {total_files}")
-    
-    try:
-        with open(file_path, "r") as f:
-            data = json.load(f)
-
-        # Get structure determination details
-        struct_det = data.get('structure_determination_list', {}).get('structure_determination', [{}])[0]
-        
-        # Get specimen preparation details
-        specimen_prep = struct_det.get('specimen_preparation_list', {}).get('specimen_preparation', [{}])[0]
-        
-        # Get microscopy details
-        microscopy = struct_det.get('microscopy_list', {}).get('microscopy', [{}])[0]
-        
-        # Get image recording details
-        image_recording = microscopy.get('image_recording_list', {}).get('image_recording', [{}])[0]
-        
-        # Get image processing details
-        image_processing = struct_det.get('image_processing', [{}])[0]
-        reconstruction = image_processing.get('final_reconstruction', {})
-
-        # Get buffer data safely
-        buffer = specimen_prep.get('buffer', {})
-        
-        # Get grid data safely
-        grid = specimen_prep.get('grid', {})
-        
-        # Get vitrification data safely
-        vitrification = specimen_prep.get('vitrification', {})
-
-        emdb_ids = file_path.replace("/kellogg/proj/rrh3749/Working_Projects/AlphaFold/data/emdb_json/response_emdb_", "")
-        emdb_ids = file_path.replace(".json", "")
-        emdb_list = emdb_ids.split(",")
-
-        for id in emdb_list:
-            emdb_df = pd.DataFrame({
-                'emdb_id': [id],
-                'pdb_id': ['#'.join([
-                    ref.get('pdb_id', '') 
-                    for ref in data.get('crossreferences', {}).get('pdb_list', {}).get('pdb_reference', [])
-                    if ref.get('pdb_id', '')
-                ])],
-                'title': [data.get('admin', {}).get('title', '')],
-                'method': [struct_det.get('method', '')],
-                'aggregation_state': [struct_det.get('aggregation_state', '')],
-                
-                # Specimen preparation
-                'concentration': [get_value_with_units(specimen_prep.get('concentration'))],
-                'specimen_details': [specimen_prep.get('details', '')],
-                'buffer_ph': [buffer.get('ph', '')],
-                'buffer_details': [buffer.get('details', '')],
-                'buffer_component_names': [get_buffer_components(buffer)[0]],
-                'buffer_component_formulas': [get_buffer_components(buffer)[1]],
-                'buffer_component_concentrations': [get_buffer_components(buffer)[2]],
-                
-                # Grid
-                'grid_mesh': [grid.get('mesh', '')],
-                'grid_model': [grid.get('model', '')],
-                'grid_material': [grid.get('material', '')],
-                'grid_details': [grid.get('details', '')],
-                'grid_pretreatment': [format_pretreatment(grid.get('pretreatment', {}))],
-                
-                # Vitrification
-                'vitrification_cryogen': [vitrification.get('cryogen_name', '')],
-                'chamber_humidity': [get_value_with_units(vitrification.get('chamber_humidity'))],
-                'chamber_temperature': [get_value_with_units(vitrification.get('chamber_temperature'))],
-                'vitrification_instrument': [vitrification.get('instrument', '')],
-                
-                # Microscopy
-                'microscope': [microscopy.get('microscope', '')],
-                'illumination_mode': [microscopy.get('illumination_mode', '')],
-                'imaging_mode': [microscopy.get('imaging_mode', '')],
-                'electron_source': [microscopy.get('electron_source', '')],
-                'acceleration_voltage': [get_value_with_units(microscopy.get('acceleration_voltage'))],
-                'c2_aperture_diameter': [get_value_with_units(microscopy.get('c2_aperture_diameter'))],
-                'nominal_cs': [get_value_with_units(microscopy.get('nominal_cs'))],
-                'nominal_defocus_min': [get_value_with_units(microscopy.get('nominal_defocus_min'))],
-                'nominal_defocus_max': [get_value_with_units(microscopy.get('nominal_defocus_max'))],
-                'calibrated_magnification': [microscopy.get('calibrated_magnification', '')],
-                'specimen_holder_model': [microscopy.get('specimen_holder_model', '')],
-                'cooling_holder_cryogen': [microscopy.get('cooling_holder_cryogen', '')],
-                'alignment_procedure': [','.join(microscopy.get('alignment_procedure', {}).keys())],
-                
-                # Image recording
-                'detector_model': [image_recording.get('film_or_detector_model', {}).get('valueOf_', '')],
-                'number_real_images': [image_recording.get('number_real_images', '')],
-                'average_electron_dose': [get_value_with_units(image_recording.get('average_electron_dose_per_image'))],
-                
-                # Image processing
-                'resolution': [get_value_with_units(reconstruction.get('resolution'))],
-                'resolution_method': [reconstruction.get('resolution_method', '')],
-                'number_images_used': [reconstruction.get('number_images_used', '')],
-                'applied_symmetry_point_group': [reconstruction.get('applied_symmetry', {}).get('point_group', '')],
-                
-                # Map details from main map data
-                'map_format': [data.get('map', {}).get('format', '')],
-                'map_data_type': [data.get('map', {}).get('data_type', '')],
-                'map_dimensions_x': [data.get('map', {}).get('dimensions', {}).get('col', '')],
-                'map_dimensions_y': [data.get('map', {}).get('dimensions', {}).get('row', '')],
-                'map_dimensions_z': [data.get('map', {}).get('dimensions', {}).get('sec', '')],
-                'map_pixel_spacing_x': [get_value_with_units(data.get('map', {}).get('pixel_spacing', {}).get('x'))],
-                'map_pixel_spacing_y': [get_value_with_units(data.get('map', {}).get('pixel_spacing', {}).get('y'))],
-                'map_pixel_spacing_z': [get_value_with_units(data.get('map', {}).get('pixel_spacing', {}).get('z'))]
-            })
-
-            emdb_data = pd.concat([emdb_data, emdb_df], ignore_index=True, sort=False)
-
-    except Exception as e:
-        print(f"Error processing {file_path}: {e}")
-        failed_filenames.append(os.path.basename(file_path))
-        continue
-
-    if cursor_index % 100 == 0 or cursor_index == total_files - 1:
-        print("Writing batch to CSV...")
-        emdb_data.to_csv(emdb_output, mode='a', index=False, header=not os.path.exists(emdb_output))
-        emdb_data = pd.DataFrame(columns=emdb_data.columns)
-    
-    cursor_index += 1
+def join_pdb_ids(pdb_references):
+    return '#'.join(ref.get('pdb_id', '') for ref in pdb_references if ref.get('pdb_id', ''))
+
+def join_keys(obj):
+    return ','.join(obj.keys())
+
+# Paths of the sections the columns are read from
+struct_det = 'structure_determination_list.structure_determination.0'
+specimen_prep = struct_det + '.specimen_preparation_list.specimen_preparation.0'
+microscopy = struct_det + '.microscopy_list.microscopy.0'
+image_recording = microscopy + '.image_recording_list.image_recording.0'
+reconstruction = struct_det + '.image_processing.0.final_reconstruction'
+
+# Output columns: (name, JSON path, formatter, default when the path is missing)
+emdb_fields = FieldSpec([
+    ('pdb_id', 'crossreferences.pdb_list.pdb_reference', join_pdb_ids, []),
+    ('title', 'admin.title', None, ''),
+    ('method', struct_det + '.method', None, ''),
+    ('aggregation_state', struct_det + '.aggregation_state', None, ''),
+
+    # Specimen preparation
+    ('concentration', specimen_prep + '.concentration', get_value_with_units),
+    ('specimen_details', specimen_prep + '.details', None, ''),
+    ('buffer_ph', specimen_prep + '.buffer.ph', None, ''),
+    ('buffer_details', specimen_prep + '.buffer.details', None, ''),
+    (('buffer_component_names', 'buffer_component_formulas', 'buffer_component_concentrations'),
+     specimen_prep + '.buffer', get_buffer_components, {}),
+
+    # Grid
+    ('grid_mesh', specimen_prep + '.grid.mesh', None, ''),
+    ('grid_model', specimen_prep + '.grid.model', None, ''),
+    ('grid_material', specimen_prep + '.grid.material', None, ''),
+    ('grid_details', specimen_prep + '.grid.details', None, ''),
+    ('grid_pretreatment', specimen_prep + '.grid.pretreatment', format_pretreatment, {}),
+
+    # Vitrification
+    ('vitrification_cryogen', specimen_prep + '.vitrification.cryogen_name', None, ''),
+    ('chamber_humidity', specimen_prep + '.vitrification.chamber_humidity', get_value_with_units),
+    ('chamber_temperature', specimen_prep + '.vitrification.chamber_temperature', get_value_with_units),
+    ('vitrification_instrument', specimen_prep + '.vitrification.instrument', None, ''),
+
+    # Microscopy
+    ('microscope', microscopy + '.microscope', None, ''),
+    ('illumination_mode', microscopy + '.illumination_mode', None, ''),
+    ('imaging_mode', microscopy + '.imaging_mode', None, ''),
+    ('electron_source', microscopy + '.electron_source', None, ''),
+    ('acceleration_voltage', microscopy + '.acceleration_voltage', get_value_with_units),
+    ('c2_aperture_diameter', microscopy + '.c2_aperture_diameter', get_value_with_units),
+    ('nominal_cs', microscopy + '.nominal_cs', get_value_with_units),
+    ('nominal_defocus_min', microscopy + '.nominal_defocus_min', get_value_with_units),
+    ('nominal_defocus_max', microscopy + '.nominal_defocus_max', get_value_with_units),
+    ('calibrated_magnification', microscopy + '.calibrated_magnification', None, ''),
+    ('specimen_holder_model', microscopy + '.specimen_holder_model', None, ''),
+    ('cooling_holder_cryogen', microscopy + '.cooling_holder_cryogen', None, ''),
+    ('alignment_procedure', microscopy + '.alignment_procedure', join_keys, {}),
+
+    # Image recording
+    ('detector_model', image_recording + '.film_or_detector_model.valueOf_', None, ''),
+    ('number_real_images', image_recording + '.number_real_images', None, ''),
+    ('average_electron_dose', image_recording + '.average_electron_dose_per_image', get_value_with_units),
+
+    # Image processing
+    ('resolution', reconstruction + '.resolution', get_value_with_units),
+    ('resolution_method', reconstruction + '.resolution_method', None, ''),
+    ('number_images_used', reconstruction + '.number_images_used', None, ''),
+    ('applied_symmetry_point_group', reconstruction + '.applied_symmetry.point_group', None, ''),
+
+    # Map details from main map data
+    ('map_format', 'map.format', None, ''),
+    ('map_data_type', 'map.data_type', None, ''),
+    ('map_dimensions_x', 'map.dimensions.col', None, ''),
+    ('map_dimensions_y', 'map.dimensions.row', None, ''),
+    ('map_dimensions_z', 'map.dimensions.sec', None, ''),
+    ('map_pixel_spacing_x', 'map.pixel_spacing.x', get_value_with_units),
+    ('map_pixel_spacing_y', 'map.pixel_spacing.y', get_value_with_units),
+    ('map_pixel_spacing_z', 'map.pixel_spacing.z', get_value_with_units),
+])
+
+
+def emdb_rows(record):
+    """Rows of one file, one per EMDB ID in its name"""
+    row = emdb_fields(decoder.load(record))
+
+    # File names hold one or more comma-separated EMDB IDs; emdb_id is the bare ID (e.g. "EMD-1234")
+    emdb_ids = record.name.replace("response_emdb_", "").replace(".json", "")
+    emdb_list = emdb_ids.split(",")
+
+    return [{'emdb_id': id, **row} for id in emdb_list]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Extract EMDB entry JSON into one table")
+    parser.add_argument('--resume', action='store_true',
+                        help="Carry on from the last checkpoint of a killed run instead of starting over")
+    args = parser.parse_args()
+
+    # Rows are collected column-wise; the columns come from the first row
+    emdb_data = ColumnarAccumulator()
+    failed_filenames = []
+
+    # Files/s, parse and flush times go to the metrics textfile and summary (see metrics.py)
+    metrics = RunMetrics('emdb_extract')
+
+    # One JSON line per failed file next to failed_output (see progress.py)
+    errors = ErrorLog(error_log_path(failed_output), logger, stage='extract')
+
+    emdb_csv = emdb_output if output_format in ("csv", "both") else None
+    if args.resume and emdb_csv is None:
+        logger.warning("--resume continues the CSV output; with output_format = 'parquet' the run starts over")
+
+    # The checkpoint records the CSV size; rows past it are dropped when resuming
+    checkpoint = Checkpoint(checkpoint_output, resume=args.resume and emdb_csv is not None and not incremental)
+    resume_from = checkpoint.state()
+
+    if resume_from:
+        truncate_file(emdb_output, resume_from['csv_offset'])
+    else:
+        try:
+            os.remove(emdb_output)
+        except:
+            pass
+
+    records = list_records(json_folder, "response_emdb_EMD")
+    if resume_from:
+        completed = checkpoint.completed()
+        failed_filenames = checkpoint.failed()
+        records = [r for r in records if r.name not in completed]
+        logger.info(f"Resuming: {len(completed)} files done")
+
+    total_files = len(records)
+    logger.info(f"Total files to process: {total_files}")
+
+    # When resuming, the Parquet file is written from the finished CSV instead, as the
+    # rows of the killed run are only in the CSV (a null string comes back as "")
+    parquet_writer = None
+    if output_format in ("parquet", "both") and not resume_from:
+        parquet_writer = ParquetBatchWriter(parquet_output, ['emdb_id'] + emdb_fields.columns, emdb_types)
+    # Batches are upserted, so rows loaded after the last checkpoint are not duplicated on resume
+    catalog_table = CatalogTable('emdb', replace=not resume_from) if load_catalog else None
+
+    def flush_rows():
+        """Write the held rows out, timing the write"""
+        with metrics.timer('flush_seconds', table='emdb'):
+            rows = emdb_data.flush(emdb_csv, parquet_writer, catalog_table)
+        metrics.count('rows_written_total', rows, table='emdb')
+
+    if incremental:
+        # Extract new and changed files only, then rewrite the output from the state
+        state = ExtractionState(state_output)
+        failed_filenames = state.update(records, emdb_rows, metrics=metrics, errors=errors)
+        for row in state.rows():
+            emdb_data.add(row)
+            if emdb_data.full():
+                flush_rows()
+        state.close()
+    else:
+        progress = Progress(total_files, logger)
+        for record in records:
+            start = time.perf_counter()
+            try:
+                for row in emdb_rows(record):
+                    emdb_data.add(row)
+                checkpoint.done(record.name)
+                metrics.observe('parse_seconds', time.perf_counter() - start)
+                metrics.count('files_parsed_total')
+                progress.update()
+
+            except Exception as e:
+                errors.record(record.name, e)
+                failed_filenames.append(record.name)
+                checkpoint.done(record.name, failed=True)
+                metrics.count('files_failed_total')
+                progress.update(failed=1)
+                continue
+
+            if emdb_data.full():
+                logger.debug("Writing batch to CSV")
+                flush_rows()
+                if emdb_csv is not None:
+                    checkpoint.save({'csv_offset': sync_file(emdb_csv)})
+        progress.finish()
+
+    # Write the last partial batch
+    flush_rows()
+    if resume_from and output_format == "both":
+        parquet_writer = ParquetBatchWriter(parquet_output, ['emdb_id'] + emdb_fields.columns, emdb_types)
+        for chunk in pd.read_csv(emdb_csv, dtype=str, keep_default_na=False, chunksize=emdb_data.capacity):
+            parquet_writer.write_frame(chunk)
+    if parquet_writer is not None:
+        parquet_writer.close()
+    if catalog_table is not None:
+        catalog_table.close()
+    checkpoint.remove()
+
+    if failed_filenames:
+        pd.DataFrame({'failed_filenames': failed_filenames}).to_csv(failed_output, index=False)
+
+    errors.close()
+    metrics.close()
+    logger.info("Processing complete!")
 
-if failed_filenames:
-    pd.DataFrame({'failed_filenames': failed_filenames}).to_csv(failed_output, index=False)
 
-print("Processing complete!")
\ No newline at end of file
+if __name__ == "__main__":
+    main()
@@ -1,28 +1,25 @@
-import pandas as pd
-import os
-import sys
+from catalog import Catalog
+from progress import get_logger
 
 emdb_output = "/home/zhn1744/AlphaFold/data/emdb_structures.csv"
+pdb_emdb_output = '/home/zhn1744/AlphaFold/data/pdb_entries_emdb_ids.csv'
+merged_output = "/home/zhn1744/AlphaFold/data/emdb_empiar_merged.csv"
 
-# Load the newly created CSV and the pdb_entries_emdb_ids.csv
-new_csv = pd.read_csv(emdb_output)
-pdb_emdb_mapping = pd.read_csv('/home/zhn1744/AlphaFold/data/pdb_entries_emdb_ids.csv')
-
-# Split the emdb_ids column into a list and explode it into separate rows
-pdb_emdb_mapping['emdb_ids'] = pdb_emdb_mapping['emdb_ids'].str.split(',')
-pdb_emdb_exploded = pdb_emdb_mapping.explode('emdb_ids').rename(columns={'emdb_ids': 'emdb_id'})
-
-# Strip any whitespace from emdb_id in both DataFrames to ensure clean merging
-pdb_emdb_exploded['emdb_id'] = pdb_emdb_exploded['emdb_id'].str.strip()
-new_csv['emdb_id'] = new_csv['emdb_id'].str.strip()
-
-# Perform a left merge to keep all rows from new_csv and add corresponding pdb_id where available
-merged_df = pd.merge(new_csv, pdb_emdb_exploded[['emdb_id', 'pdb_id']], 
-                    on='emdb_id', 
-                    how='left')
+# The merge is the emdb_pdb_merged view of the catalog: every EMDB entry with the
+# pdb_id of each PDB entry that lists it, through the indexed pdb_emdb link table.
+# The extractors fill the catalog when run with load_catalog = True; a table that
+# is not there yet, or is older than its CSV output (an extractor run without
+# load_catalog since), is loaded from the CSV, a chunk at a time.
+logger = get_logger('emdb_pdb_merge')
+catalog = Catalog()
+for table, csv_path in (('emdb', emdb_output), ('entry_emdb', pdb_emdb_output)):
+    loaded = catalog.load_csv_if_newer(table, csv_path)
+    if loaded is not None:
+        logger.info(f"Loaded {loaded} rows of {csv_path} into the catalog")
+catalog.refresh_views()
 
-# Save the merged DataFrame back to the output file or a new file
-merged_output = "/home/zhn1744/AlphaFold/data/emdb_empiar_merged.csv"
-merged_df.to_csv(merged_output, index=False)
+# Save the merged rows to the output file
+rows = catalog.export('emdb_pdb_merged', merged_output)
+catalog.close()
 
-print("Merging complete! Output saved to:", merged_output)
\ No newline at end of file
+logger.info(f"Merging complete! {rows} rows saved to: {merged_output}")
@@ -1,128 +1,108 @@
-import aiohttp
-import asyncio
-import json
+import argparse
 import pandas as pd
-from datetime import datetime, timedelta
 import os
-import csv
-import time
-from aiofiles import open as aio_open
+from fetch_engine import run_fetch, append_failed_ids
+from fetch_manifest import FetchManifest
+from incremental_refresh import plan_revalidation
+from metrics import RunMetrics
+from progress import ErrorLog, error_log_path, get_logger
+from record_store import RecordStore, reconcile_manifest
+from retry_scheduler import RetryScheduler
 
 # Define paths
 output = '/kellogg/proj/rrh3749/Working_Projects/AlphaFold/data/emdb_json'
 emdb_ids_path = "/home/zhn1744/AlphaFold/data/pdb_entries_emdb_ids.csv"
 failed_ids_path = "/home/zhn1744/AlphaFold/data/emdb_pull_failed_ids.csv"
+manifest_path = "/home/zhn1744/AlphaFold/data/fetch_manifest.sqlite"
+source = 'emdb'
 
-# Create output directory if it doesn't exist
-os.makedirs(output, exist_ok=True)
-
-# Get existing files
-existing_files = set(os.listdir(output))
-
-# Read and process EMDB IDs
-emdb_ids = pd.read_csv(emdb_ids_path)
-emdb_ids = emdb_ids[emdb_ids['emdb_ids'].notna() & (emdb_ids['emdb_ids'] != "")]
-#emdb_ids = emdb_ids.iloc[:10]  # Keep original slice
-emdb_ids.reset_index(drop=True, inplace=True)
-
-print(f"Total EMDB IDs to process: {len(emdb_ids)}")
-
-# Create list of IDs to process (excluding existing files)
-to_process = []
-for _, row in emdb_ids.iterrows():
-    emdb_id = row["emdb_ids"]
-    if emdb_id == "":
-        continue
-    filename = f'response_emdb_{emdb_id}.json'
-    if filename not in existing_files:
-        to_process.append(emdb_id)
-
-print(f"EMDB IDs to download: {len(to_process)}")
-
-failed_ids = []
-wait_time = 0.05  # Original wait time
-
-async def fetch_and_save(session, emdb_id):
-    URL = f"https://www.ebi.ac.uk/emdb/api/entry/{emdb_id}"
-    file_path = os.path.join(output, f'response_emdb_{emdb_id}.json')
-    
-    try:
-        async with session.get(URL) as response:
-            content = await response.read()
-            async with aio_open(file_path, 'wb') as f:
-                await f.write(content)
-            #print(f"Successfully processed {emdb_id}")
-    except Exception as e:
-        #print(f"Failed to process {emdb_id}: {str(e)}")
-        failed_ids.append(emdb_id)
-        
-    # Maintain original rate limiting
-    await asyncio.sleep(wait_time)
-
-async def main():
-    async with aiohttp.ClientSession() as session:
-        tasks = []
-        for emdb_id in to_process:
-            task = asyncio.ensure_future(fetch_and_save(session, emdb_id))
-            tasks.append(task)
-        await asyncio.gather(*tasks)
-    
-    # Save failed IDs (keeping original functionality)
-    if failed_ids:
-        failed_data = pd.DataFrame(data={'failed_ids': failed_ids})
-        failed_data.to_csv(
-            failed_ids_path, 
-            mode='a', 
-            index=False, 
-            header=not os.path.exists(failed_ids_path)
-        )
+# Server the requests go to; --base-url sends them elsewhere, e.g. to a
+# mock_archive_server.py for load tests
+ebi_base_url = "https://www.ebi.ac.uk"
 
-if __name__ == "__main__":
-    asyncio.run(main())
-    print("Run 1 Complete")
-    # Get existing files
-    existing_files = set(os.listdir(output))
+# Requests in flight and requests started per second against www.ebi.ac.uk
+concurrency = 20
+requests_per_second = 20
 
-    # Read and process EMDB IDs
-    emdb_ids = pd.read_csv(emdb_ids_path)
-    emdb_ids = emdb_ids[emdb_ids['emdb_ids'].notna() & (emdb_ids['emdb_ids'] != "")]
-    #emdb_ids = emdb_ids.iloc[:10]  # Keep original slice
-    emdb_ids.reset_index(drop=True, inplace=True)
-
-    print(f"Total EMDB IDs to process: {len(emdb_ids)}")
-    to_process = []
-    for _, row in emdb_ids.iterrows():
-        emdb_id = row["emdb_ids"]
-        if emdb_id == "":
-            continue
-        filename = f'response_emdb_{emdb_id}.json'
-        if filename not in existing_files:
-            to_process.append(emdb_id)
-
-    print(f"EMDB IDs to download: {len(to_process)}")
-    time.sleep(500)
-    asyncio.run(main())
-    print("Run 2 Complete")
-    # Get existing files
-    existing_files = set(os.listdir(output))
+# With adaptive_concurrency the requests in flight start low and grow up to
+# concurrency while the server keeps up, halving on 429s, 5xx or slow answers
+adaptive_concurrency = True
+
+# Failed requests are retried within the one pass, up to max_attempts tries per ID,
+# waiting out Retry-After or an exponential backoff in the fetch engine's delay queue
+max_attempts = 6
+
+# Revalidate every fetched record with a conditional GET (ETag / Last-Modified):
+# unchanged records are not rewritten and withdrawn ones are marked obsolete
+incremental = False
+
+# Append responses to compressed shards in output instead of writing one file per ID
+use_record_store = False
+
+
+# Run messages and the error log's warnings (see progress.py)
+logger = get_logger('emdb_pull')
 
+def emdb_url(emdb_id):
+    return f"{ebi_base_url}/emdb/api/entry/{emdb_id}"
+
+
+def emdb_file_name(emdb_id):
+    return f'response_emdb_{emdb_id}.json'
+
+
+def emdb_file_path(emdb_id):
+    return os.path.join(output, emdb_file_name(emdb_id))
+
+
+def load_emdb_ids():
     # Read and process EMDB IDs
     emdb_ids = pd.read_csv(emdb_ids_path)
     emdb_ids = emdb_ids[emdb_ids['emdb_ids'].notna() & (emdb_ids['emdb_ids'] != "")]
     #emdb_ids = emdb_ids.iloc[:10]  # Keep original slice
-    emdb_ids.reset_index(drop=True, inplace=True)
-
-    print(f"Total EMDB IDs to process: {len(emdb_ids)}")
-    to_process = []
-    for _, row in emdb_ids.iterrows():
-        emdb_id = row["emdb_ids"]
-        if emdb_id == "":
-            continue
-        filename = f'response_emdb_{emdb_id}.json'
-        if filename not in existing_files:
-            to_process.append(emdb_id)
-
-    print(f"EMDB IDs to download: {len(to_process)}")
-    time.sleep(500)
-    asyncio.run(main())
-    print("Run 3 Complete")
\ No newline at end of file
+    return list(dict.fromkeys(emdb_ids['emdb_ids']))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Download EMDB entry JSON")
+    parser.add_argument('--base-url', default=None,
+                        help="Send every request to this server, e.g. http://localhost:8080 for mock_archive_server.py")
+    args = parser.parse_args()
+    if args.base_url:
+        ebi_base_url = args.base_url.rstrip('/')
+    metrics = RunMetrics('emdb_pull')
+    # Requests that raised, one JSON line each, next to the failed IDs
+    errors = ErrorLog(error_log_path(failed_ids_path), logger, stage='fetch')
+
+    # Create output directory if it doesn't exist
+    os.makedirs(output, exist_ok=True)
+
+    emdb_ids = load_emdb_ids()
+    logger.info(f"Total EMDB IDs to process: {len(emdb_ids)}")
+
+    manifest = FetchManifest(manifest_path)
+    store = RecordStore(output) if use_record_store else None
+    if store is not None:
+        logger.info(f"Re-queued {reconcile_manifest(store, manifest, source, emdb_file_name)} IDs missing from the store")
+    elif manifest.count(source) == 0:
+        logger.info(f"Adopted {manifest.import_existing(source, emdb_ids, emdb_file_path)} existing files")
+    manifest.register(source, emdb_ids)
+    if incremental:
+        plan_revalidation(manifest, source, emdb_ids)
+    manifest.report(source)
+
+    # One pass over everything not yet fetched; failures are retried inside it
+    jobs = [(emdb_id, emdb_url(emdb_id), emdb_file_path(emdb_id))
+            for emdb_id in manifest.pending(source, emdb_ids)]
+    run_fetch(jobs, concurrency=concurrency, rate=requests_per_second, retry=RetryScheduler(max_attempts=max_attempts),
+              manifest=manifest, source=source, conditional=incremental, store=store, metrics=metrics, errors=errors,
+              adaptive=adaptive_concurrency)
+    manifest.report(source)
+
+    if store is not None:
+        store.close()
+    failed_ids = manifest.not_fetched(source, emdb_ids)
+    manifest.close()
+    append_failed_ids(failed_ids, failed_ids_path)
+    errors.close()
+    metrics.close()
@@ -1,6 +1,12 @@
 import os
 import json
+import time
 import pandas as pd
+from catalog import Catalog, CatalogTable
+from metrics import RunMetrics
+from parquet_output import ParquetBatchWriter
+from progress import ErrorLog, Progress, error_log_path, get_logger
+from record_store import list_records, load_json
 
 # Set paths
 json_folder = '/kellogg/proj/rrh3749/Working_Projects/AlphaFold/data/empiar_json_v2'
@@ -8,28 +14,43 @@ csv_output = "/home/zhn1744/AlphaFold/data/empiar_structures.csv"
 emdb_file = '/home/zhn1744/AlphaFold/data/emdb_structures.csv'
 merged_output = '/home/zhn1744/AlphaFold/data/merged_empiar_emdb.csv'
 
-def extract_empiar_data(json_folder, csv_output):
+# "csv", "parquet" or "both"
+output_format = "csv"
+parquet_output = "/home/zhn1744/AlphaFold/data/empiar_structures.parquet"
+# Write the Parquet output as release_year=YYYY directories instead of one file
+partition_by_release_year = False
+
+# Parquet types of the dated columns; the rest are strings
+empiar_types = {'release_date': 'timestamp', 'update_date': 'timestamp'}
+
+# Throttled progress lines (see progress.py)
+logger = get_logger('empiar_extract_v2')
+
+def extract_empiar_data(json_folder, csv_output, metrics=None):
     # Initialize empty lists to store data
     data_list = []
 
-    # Get list of JSON files
-    file_paths = [os.path.join(json_folder, f) for f in os.listdir(json_folder)
-                  if f.endswith('.json')]
+    # Get list of JSON records (plain directory or record store)
+    records = list_records(json_folder)
+    progress = Progress(len(records), logger)
+    # One JSON line per failed file next to csv_output
+    errors = ErrorLog(error_log_path(csv_output), logger, stage='extract')
 
     # Process each file
-    for file_path in file_paths:
+    for record in records:
+        start = time.perf_counter()
         try:
-            print(f"Processing {file_path}")
-            
             # Load the JSON data
-            with open(file_path, 'r') as f:
-                data = json.load(f)
+            data = load_json(record)
                 
             # Find the EMPIAR entry key (should start with 'EMPIAR-')
             empiar_key = next((key for key in data.keys() if key.startswith('EMPIAR-')), None)
             
             if empiar_key is None:
-                print(f"Warning: No EMPIAR key found in {file_path}")
+                errors.record(record.name, "No EMPIAR key found")
+                if metrics is not None:
+                    metrics.count('files_failed_total')
+                progress.update(failed=1)
                 continue
                 
             entry_data = data[empiar_key]
@@ -55,67 +76,88 @@ def extract_empiar_data(json_folder, csv_output):
             }
             
             data_list.append(entry_dict)
-            print(f"Successfully processed {empiar_key}")
+            logger.debug("Processed %s (%s)", empiar_key, record.name)
+            if metrics is not None:
+                metrics.observe('parse_seconds', time.perf_counter() - start)
+                metrics.count('files_parsed_total')
+            progress.update()
             
         except Exception as e:
-            print(f"Error processing {file_path}: {str(e)}")
+            errors.record(record.name, e)
+            if metrics is not None:
+                metrics.count('files_failed_total')
+            progress.update(failed=1)
+    progress.finish()
+    errors.close()
 
-    # Create DataFrame and save to CSV
+    # Create DataFrame and save to CSV and/or Parquet
     if data_list:
+        start = time.perf_counter()
         df = pd.DataFrame(data_list)
-        df.to_csv(csv_output, index=False)
-        print(f"Data saved to {csv_output}")
+        if output_format in ("csv", "both"):
+            df.to_csv(csv_output, index=False)
+            logger.info(f"Data saved to {csv_output}")
+        if output_format in ("parquet", "both"):
+            writer = ParquetBatchWriter(parquet_output, list(df.columns), empiar_types,
+                                        'release_date' if partition_by_release_year else None)
+            writer.write_frame(df)
+            writer.close()
+            logger.info(f"Data saved to {parquet_output}")
+        if metrics is not None:
+            metrics.observe('flush_seconds', time.perf_counter() - start, table='empiar')
+            metrics.count('rows_written_total', len(df), table='empiar')
         return df
     else:
-        print("No data was processed successfully")
+        logger.warning("No data was processed successfully")
         return None
 
 def merge_with_emdb(empiar_df, emdb_file_path, output_path):
-    print("\nStarting merge process...")
+    logger.info("Starting merge process...")
     
-    # Read the EMDB entries file
-    emdb_df = pd.read_csv(emdb_file_path)
-    print(f"Loaded EMDB data with {len(emdb_df)} entries")
+    # Load the EMPIAR rows into the catalog; their EMDB cross references become
+    # the indexed emdb_empiar link table
+    empiar_table = CatalogTable('empiar', replace=True)
+    empiar_table.write_frame(empiar_df)
+    empiar_table.close()
 
-    # Create a copy of the original EMPIAR dataframe for processing
-    df = empiar_df.copy()
-    
-    # Split the cross_references column and explode to create separate rows for each EMDB ID
-    df['emdb_id'] = df['cross_references'].str.split('#').apply(lambda x: [id for id in x if 'EMD-' in id])
-    df = df.explode('emdb_id')
-    
-    # Clean up the EMDB IDs to match format in emdb_entries.csv
-    df['emdb_id'] = df['emdb_id'].str.extract(r'(EMD-\d+)')
-    
-    # Before merging, keep a copy of original EMPIAR IDs
-    empiar_ids = df['empiar_id'].unique()
-    print(f"Found {len(empiar_ids)} unique EMPIAR IDs")
+    # The EMDB table comes from emdb_extract.py (load_catalog = True), or from its
+    # CSV when the table is missing or older than the CSV
+    catalog = Catalog()
+    loaded = catalog.load_csv_if_newer('emdb', emdb_file_path)
+    if loaded is not None:
+        logger.info(f"Loaded {loaded} rows of {emdb_file_path} into the catalog")
+    catalog.refresh_views()
+    logger.info(f"EMDB data has {catalog.count('emdb')} entries")
+    logger.info(f"Found {catalog.count('empiar')} unique EMPIAR IDs")
 
-    # Merge the dataframes with left join to keep all EMDB entries
-    merged_df = pd.merge(emdb_df, df, on='emdb_id', how='left')
-    
-    # Find EMPIAR entries that didn't merge
-    merged_empiar_ids = merged_df['empiar_id'].unique()
-    unmatched_empiar = set(empiar_ids) - set(merged_empiar_ids[~pd.isna(merged_empiar_ids)])
+    # Find EMPIAR entries that don't reference any EMDB entry in the catalog
+    unmatched_empiar = set(r[0] for r in catalog.conn.execute("""
+        SELECT empiar_id FROM empiar WHERE empiar_id NOT IN (
+            SELECT l.empiar_id FROM emdb_empiar l JOIN emdb e ON e.emdb_id = l.emdb_id)
+    """))
 
-    print(f"\nEMPIAR entries that didn't find EMDB matches:")
-    print(unmatched_empiar)
-    print(f"Number of unmatched EMPIAR entries: {len(unmatched_empiar)}")
+    logger.info(f"{len(unmatched_empiar)} EMPIAR entries didn't find EMDB matches: {sorted(unmatched_empiar)}")
 
-    # Save the merged dataframe
-    merged_df.to_csv(output_path, index=False)
-    print(f"Merged data saved to {output_path}")
+    # Save the merge (every EMDB entry, with the EMPIAR entries referencing it)
+    rows = catalog.export('empiar_emdb_merged', output_path)
+    catalog.close()
+    logger.info(f"Merged data ({rows} rows) saved to {output_path}")
     
-    return merged_df
+    return rows
 
 def main():
+    # Files/s, parse and write times go to the metrics textfile and summary (see metrics.py)
+    metrics = RunMetrics('empiar_extract_v2')
     
     # Extract EMPIAR data
-    empiar_df = extract_empiar_data(json_folder, csv_output)
+    empiar_df = extract_empiar_data(json_folder, csv_output, metrics)
     
     if empiar_df is not None:
         # Merge with EMDB data
-        merge_with_emdb(empiar_df, emdb_file, merged_output)
+        with metrics.timer('flush_seconds', table='empiar_emdb_merged'):
+            rows = merge_with_emdb(empiar_df, emdb_file, merged_output)
+        metrics.count('rows_written_total', rows, table='empiar_emdb_merged')
+    metrics.close()
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
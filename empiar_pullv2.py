@@ -1,158 +1,133 @@
-import aiohttp
-import asyncio
-import json
+import argparse
 import pandas as pd
-from datetime import datetime, timedelta
 import os
-import csv
-import time
-from aiofiles import open as aio_open
+from fetch_engine import run_fetch, append_failed_ids
+from fetch_manifest import FetchManifest
+from incremental_refresh import plan_revalidation
+from metrics import RunMetrics
+from progress import ErrorLog, error_log_path, get_logger
+from record_store import RecordStore, list_records, reconcile_manifest
+from retry_scheduler import RetryScheduler
 
 # Define paths
 output = '/kellogg/proj/rrh3749/Working_Projects/AlphaFold/data/empiar_json'
 json_folder = '/kellogg/proj/rrh3749/Working_Projects/AlphaFold/data/emdb_json'
-temp_ids = []
-
-for filename in os.listdir(json_folder):
-    print(filename)
-    if ',' in filename:  # Handle files with multiple IDs
-        id_list = filename.split(',')
-        for id_str in id_list:
-            print(id_str)
-            id_str = id_str.replace('response_emdb_', '')
-            id_str = id_str.replace('.json', '')
-            num = id_str
-            temp_ids.append(num)
-    else:
-        id_str = filename
-        id_str = id_str.replace('response_emdb_', '')
-        id_str = id_str.replace('.json', '')
-        emdb_id = id_str
-        temp_ids.append(emdb_id)
-
-emdb_ids = pd.DataFrame(temp_ids, columns=['emdb_ids'])
 failed_ids_path = "/home/zhn1744/AlphaFold/data/empiar_pull_failed_ids.csv"
-os.makedirs(output, exist_ok=True)
-
-emdb_ids = emdb_ids[emdb_ids['emdb_ids'].notna() & (emdb_ids['emdb_ids'] != "")]
-emdb_ids.reset_index(drop=True, inplace=True)
-print(f"Total EMDB IDs to process: {len(emdb_ids)}")
-
-existing_files = set(os.listdir(output))
-to_process = []
-for _, row in emdb_ids.iterrows():
-    emdb_id = row["emdb_ids"]
-    if emdb_id == "":
-        continue
-    filename = f'response_empiar_{emdb_id}.json'
-    if filename not in existing_files:
-        to_process.append(emdb_id)
-
-print(f"EMDB IDs to download: {len(to_process)}")
-
-failed_ids = []
-wait_time = 0.05  # Original wait time
-
-async def fetch_and_save(session, emdb_id, semaphore):
-    async with semaphore:
-        URL = f"https://www.ebi.ac.uk/empiar/api/emdb_ref/{emdb_id}"
-        file_path = os.path.join(output, f'response_empiar_{emdb_id}.json')
-        try:
-            async with session.get(URL) as response:
-                content = await response.read()
-                # Insert the emdb_id directly into the JSON string.
-                # Assumes the JSON object starts with '{'
-                content_str = content.decode("utf-8")
-                insert_str = f'"emdb_id": "{emdb_id}",'
-                content_str = content_str.replace("{", "{" + insert_str, 1)
-                content = content_str.encode("utf-8")
-                async with aio_open(file_path, 'wb') as f:
-                    await f.write(content)
-        except Exception as e:
-            print(f"Error processing {emdb_id}: {e}")
-            failed_ids.append(emdb_id)
-        await asyncio.sleep(wait_time)
-
-async def main():
-    # Create the semaphore inside main so it's attached to the current event loop.
-    semaphore = asyncio.Semaphore(5)
-    timeout = aiohttp.ClientTimeout(total=30)  # Adjust the timeout as needed
-    async with aiohttp.ClientSession(timeout=timeout) as session:
-        tasks = []
-        for emdb_id in to_process:
-            task = asyncio.ensure_future(fetch_and_save(session, emdb_id, semaphore))
-            tasks.append(task)
-        await asyncio.gather(*tasks)
-    
-    if failed_ids:
-        failed_data = pd.DataFrame(data={'failed_ids': failed_ids})
-        failed_data.to_csv(
-            failed_ids_path, 
-            mode='a', 
-            index=False, 
-            header=not os.path.exists(failed_ids_path)
-        )
+manifest_path = "/home/zhn1744/AlphaFold/data/fetch_manifest.sqlite"
+source = 'empiar'
+
+# Server the requests go to; --base-url sends them elsewhere, e.g. to a
+# mock_archive_server.py for load tests
+ebi_base_url = "https://www.ebi.ac.uk"
+
+# Requests in flight and requests started per second against www.ebi.ac.uk. EMPIAR
+# used to be held at 5 in flight; the adaptive limit now finds the level the server
+# takes, with concurrency as its ceiling
+concurrency = 20
+requests_per_second = 20
+
+# With adaptive_concurrency the requests in flight start low and grow up to
+# concurrency while the server keeps up, halving on 429s, 5xx or slow answers
+adaptive_concurrency = True
+
+# Failed requests are retried within the one pass, up to max_attempts tries per ID,
+# waiting out Retry-After or an exponential backoff in the fetch engine's delay queue
+max_attempts = 10
+
+# Revalidate every fetched record with a conditional GET (ETag / Last-Modified):
+# unchanged records are not rewritten and withdrawn ones are marked obsolete
+incremental = False
+
+# Append responses to compressed shards in output instead of writing one file per ID
+use_record_store = False
+
+
+# Run messages and the error log's warnings (see progress.py)
+logger = get_logger('empiar_pull')
+
+def empiar_url(emdb_id):
+    return f"{ebi_base_url}/empiar/api/emdb_ref/{emdb_id}"
+
+
+def empiar_file_name(emdb_id):
+    return f'response_empiar_{emdb_id}.json'
+
+
+def empiar_file_path(emdb_id):
+    return os.path.join(output, empiar_file_name(emdb_id))
+
+
+def load_emdb_ids(manifest):
+    """
+    EMDB IDs with a downloaded EMDB entry
+
+    Taken from the EMDB pull in the manifest; the EMDB directory or record store
+    is only listed when the manifest has no EMDB rows yet. A record ID may hold several
+    comma-separated EMDB IDs.
+    """
+    record_ids = manifest.ids('emdb')
+    if not record_ids:
+        record_ids = [r.name.replace('response_emdb_', '').replace('.json', '')
+                      for r in list_records(json_folder, 'response_emdb_')]
+
+    emdb_ids = []
+    for record_id in record_ids:
+        for emdb_id in record_id.split(','):
+            emdb_id = emdb_id.replace('response_emdb_', '').replace('.json', '').strip()
+            if emdb_id:
+                emdb_ids.append(emdb_id)
+    return list(dict.fromkeys(emdb_ids))
+
+
+def insert_emdb_id(emdb_id, content):
+    # Insert the emdb_id directly into the JSON string.
+    # Assumes the JSON object starts with '{'
+    content_str = content.decode("utf-8")
+    insert_str = f'"emdb_id": "{emdb_id}",'
+    content_str = content_str.replace("{", "{" + insert_str, 1)
+    return content_str.encode("utf-8")
+
 
 if __name__ == "__main__":
-    asyncio.run(main())
-    print("Run 1 Complete")
-    
-    # Run 2
-    existing_files = set(os.listdir(output))
-    to_process = []
-    for _, row in emdb_ids.iterrows():
-        emdb_id = row["emdb_ids"]
-        if emdb_id == "":
-            continue
-        filename = f'response_empiar_{emdb_id}.json'
-        if filename not in existing_files:
-            to_process.append(emdb_id)
-    print(f"EMDB IDs to download: {len(to_process)}")
-    time.sleep(500)
-    asyncio.run(main())
-    print("Run 2 Complete")
-    
-    # Run 3
-    existing_files = set(os.listdir(output))
-    to_process = []
-    for _, row in emdb_ids.iterrows():
-        emdb_id = row["emdb_ids"]
-        if emdb_id == "":
-            continue
-        filename = f'response_empiar_{emdb_id}.json'
-        if filename not in existing_files:
-            to_process.append(emdb_id)
-    print(f"EMDB IDs to download: {len(to_process)}")
-    time.sleep(500)
-    asyncio.run(main())
-    print("Run 3 Complete")
-    
-    # Run 4
-    existing_files = set(os.listdir(output))
-    to_process = []
-    for _, row in emdb_ids.iterrows():
-        emdb_id = row["emdb_ids"]
-        if emdb_id == "":
-            continue
-        filename = f'response_empiar_{emdb_id}.json'
-        if filename not in existing_files:
-            to_process.append(emdb_id)
-    print(f"EMDB IDs to download: {len(to_process)}")
-    time.sleep(500)
-    asyncio.run(main())
-    print("Run 4 Complete")
-    
-    # Run 5
-    existing_files = set(os.listdir(output))
-    to_process = []
-    for _, row in emdb_ids.iterrows():
-        emdb_id = row["emdb_ids"]
-        if emdb_id == "":
-            continue
-        filename = f'response_empiar_{emdb_id}.json'
-        if filename not in existing_files:
-            to_process.append(emdb_id)
-    print(f"EMDB IDs to download: {len(to_process)}")
-    time.sleep(500)
-    asyncio.run(main())
-    print("Run 5 Complete")
+    parser = argparse.ArgumentParser(description="Download the EMPIAR entries of EMDB maps")
+    parser.add_argument('--base-url', default=None,
+                        help="Send every request to this server, e.g. http://localhost:8080 for mock_archive_server.py")
+    args = parser.parse_args()
+    if args.base_url:
+        ebi_base_url = args.base_url.rstrip('/')
+    metrics = RunMetrics('empiar_pull')
+    # Requests that raised, one JSON line each, next to the failed IDs
+    errors = ErrorLog(error_log_path(failed_ids_path), logger, stage='fetch')
+
+    os.makedirs(output, exist_ok=True)
+
+    manifest = FetchManifest(manifest_path)
+    emdb_ids = load_emdb_ids(manifest)
+    logger.info(f"Total EMDB IDs to process: {len(emdb_ids)}")
+
+    store = RecordStore(output) if use_record_store else None
+    if store is not None:
+        logger.info(f"Re-queued {reconcile_manifest(store, manifest, source, empiar_file_name)} IDs missing from the store")
+    elif manifest.count(source) == 0:
+        logger.info(f"Adopted {manifest.import_existing(source, emdb_ids, empiar_file_path)} existing files")
+    manifest.register(source, emdb_ids)
+    if incremental:
+        plan_revalidation(manifest, source, emdb_ids)
+    manifest.report(source)
+
+    # One pass over everything not yet fetched; failures are retried inside it
+    jobs = [(emdb_id, empiar_url(emdb_id), empiar_file_path(emdb_id))
+            for emdb_id in manifest.pending(source, emdb_ids)]
+    run_fetch(jobs, concurrency=concurrency, rate=requests_per_second, timeout=30,
+              retry=RetryScheduler(max_attempts=max_attempts),
+              manifest=manifest, source=source, conditional=incremental, transform=insert_emdb_id,
+              store=store, metrics=metrics, errors=errors, adaptive=adaptive_concurrency)
+    manifest.report(source)
+
+    if store is not None:
+        store.close()
+    failed_ids = manifest.not_fetched(source, emdb_ids)
+    manifest.close()
+    append_failed_ids(failed_ids, failed_ids_path)
+    errors.close()
+    metrics.close()
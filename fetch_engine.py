@@ -0,0 +1,322 @@
+import aiohttp
+import asyncio
+import os
+import pandas as pd
+import time
+from collections import namedtuple
+from aiofiles import open as aio_open
+from metrics import url_host
+from progress import ErrorLog, Progress, get_logger
+from retry_scheduler import PERMANENT, DelayQueue, RetryScheduler, classify, parse_retry_after
+
+# Defaults match the old 0.05 s sleep between requests (20 requests per second)
+default_concurrency = 20
+default_rate = 20
+default_timeout = 60
+
+# Adaptive concurrency (AIMD): each host starts at adaptive_initial requests in flight,
+# gains about one per round trip while responses are healthy and the limit is in use,
+# and is cut by adaptive_decrease on a 429, a 5xx, a failed connection or a response
+# slower than adaptive_latency_factor times the usual latency
+adaptive_initial = 4
+adaptive_decrease = 0.5
+adaptive_latency_factor = 3.0
+# Responses seen before latency spikes count, and the weight of each in the baseline
+adaptive_latency_samples = 20
+adaptive_latency_weight = 0.05
+
+logger = get_logger('fetch_engine')
+
+
+class TokenBucket:
+    """Token bucket that limits how many requests may start per second"""
+
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity if capacity else max(1, rate)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.lock = asyncio.Lock()
+
+    async def acquire(self):
+        # The lock makes waiters queue up in order instead of all waking at once
+        async with self.lock:
+            while True:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+
+class AdaptiveConcurrency:
+    """
+    Additive-increase / multiplicative-decrease limit on the requests in flight to one host
+
+    acquire() waits for a free slot and returns a ticket; release() reports how the
+    request went. Only requests started after the last cut can cut the limit again,
+    so a burst of 429s from one overloaded moment halves it once, not once per reply.
+
+    Args:
+        max_limit: Ceiling of the limit (the number of workers)
+        initial: Starting limit, adaptive_initial if None
+        min_limit: Floor of the limit
+    """
+
+    def __init__(self, max_limit, initial=None, min_limit=1):
+        self.max_limit = max_limit
+        self.min_limit = min(min_limit, max_limit)
+        self.limit = float(min(max_limit, initial if initial is not None else adaptive_initial))
+        self.in_flight = 0
+        self.tickets = 0
+        self.cut_at = 0
+        self.latency = None
+        self.samples = 0
+        self.changed = asyncio.Condition()
+
+    def current(self):
+        return max(self.min_limit, int(self.limit))
+
+    async def acquire(self):
+        async with self.changed:
+            await self.changed.wait_for(lambda: self.in_flight < self.current())
+            self.in_flight += 1
+            self.tickets += 1
+            return self.tickets
+
+    async def release(self, ticket, status, seconds):
+        """
+        Returns:
+            Reason the limit was cut ('throttled', 'error', 'latency'), or None
+        """
+        async with self.changed:
+            saturated = self.in_flight >= self.current()
+            self.in_flight -= 1
+            reason = self.congestion(status, seconds)
+            cut = None
+            if reason is not None and ticket > self.cut_at:
+                # Already at the floor there is nothing to cut, but the window still restarts
+                if self.limit > self.min_limit:
+                    self.limit = max(self.min_limit, self.limit * adaptive_decrease)
+                    cut = reason
+                self.cut_at = self.tickets
+            elif reason is None and saturated:
+                # About +1 per limit's worth of responses, i.e. per round trip
+                self.limit = min(self.max_limit, self.limit + 1 / self.limit)
+            self.changed.notify_all()
+            return cut
+
+    def congestion(self, status, seconds):
+        """Why this response signals an overloaded host, or None if it was healthy"""
+        error_class = classify(status)
+        if status in (429, 503):
+            return 'throttled'
+        if error_class is not None and error_class != PERMANENT:
+            return 'error'
+        if self.samples >= adaptive_latency_samples and seconds > adaptive_latency_factor * self.latency:
+            return 'latency'
+        # Healthy answers (404s included) set the latency baseline
+        self.samples += 1
+        if self.latency is None:
+            self.latency = seconds
+        else:
+            self.latency += adaptive_latency_weight * (seconds - self.latency)
+        return None
+
+
+# Outcome of one request. content is the saved body (only set on 200), retry_after
+# the seconds asked for by the server, etag / last_modified the response validators,
+# seconds the time from sending the request to reading the body.
+FetchResult = namedtuple('FetchResult', ['status', 'content', 'retry_after', 'etag', 'last_modified', 'seconds'])
+
+
+def conditional_headers(validators):
+    """If-None-Match / If-Modified-Since headers from a stored (etag, last_modified) pair"""
+    headers = {}
+    if validators:
+        etag, last_modified = validators
+        if etag:
+            headers['If-None-Match'] = etag
+        if last_modified:
+            headers['If-Modified-Since'] = last_modified
+    return headers
+
+
+def record_request(metrics, host, status, seconds, size):
+    metrics.count('requests_total', host=host, status=str(status) if status is not None else 'error')
+    metrics.observe('request_seconds', seconds, host=host)
+    if size:
+        metrics.count('downloaded_bytes_total', size, host=host)
+
+
+async def fetch_and_save(session, bucket, job_id, url, file_path, transform=None, headers=None, store=None,
+                         sink=None, metrics=None, errors=None):
+    """
+    Fetch a single URL and write the body to file_path on a 200 response
+
+    With a RecordStore the body is appended to the store under the file name
+    instead, and with file_path None the body is not kept at all. A sink is
+    called with (job_id, body) for every 200 response. A 304 Not Modified
+    leaves the existing record in place. With a metrics.RunMetrics the status,
+    latency and size of the response are recorded under the URL's host.
+    Exceptions go to the progress.ErrorLog errors, or are logged if it is None.
+
+    Returns:
+        FetchResult; status is None if the request did not complete
+    """
+    await bucket.acquire()
+    start = time.monotonic()
+    recorded = False
+    try:
+        async with session.get(url, headers=headers) as response:
+            content = await response.read()
+            seconds = time.monotonic() - start
+            if metrics is not None:
+                recorded = True
+                record_request(metrics, url_host(url), response.status, seconds,
+                               len(content) if response.status == 200 else 0)
+            etag = response.headers.get('ETag')
+            last_modified = response.headers.get('Last-Modified')
+            if response.status != 200:
+                retry_after = parse_retry_after(response.headers.get('Retry-After'))
+                return FetchResult(response.status, None, retry_after, etag, last_modified, seconds)
+            if transform is not None:
+                content = transform(job_id, content)
+            if store is not None:
+                store.put(os.path.basename(file_path), content)
+            elif file_path is not None:
+                # Renamed into place: a refreshed file changes its directory's mtime,
+                # which is how file_inventory notices it, and is never seen half written
+                async with aio_open(file_path + '.tmp', 'wb') as f:
+                    await f.write(content)
+                os.replace(file_path + '.tmp', file_path)
+            if sink is not None:
+                sink(job_id, content)
+            return FetchResult(response.status, content, None, etag, last_modified, seconds)
+    except Exception as e:
+        if errors is not None:
+            errors.record(job_id, repr(e))
+        else:
+            logger.warning(f"Failed to fetch {job_id}: {e!r}")
+        # Failures while saving a body were already counted with its status
+        if metrics is not None and not recorded:
+            record_request(metrics, url_host(url), None, time.monotonic() - start, 0)
+        return FetchResult(None, None, None, None, None, time.monotonic() - start)
+
+
+async def fetch_all(jobs, concurrency=default_concurrency, rate=default_rate, timeout=default_timeout,
+                    manifest=None, source=None, transform=None, retry=None, conditional=False, store=None,
+                    sink=None, metrics=None, errors=None, adaptive=False):
+    """
+    Download a list of URLs with a fixed number of workers and a shared rate limit
+
+    Failed requests are handed to the retry scheduler and wait in a delay queue
+    while the workers carry on with the rest of the jobs.
+
+    Args:
+        jobs: Iterable of (job_id, url, file_path) tuples; file_path None skips saving
+        concurrency: Maximum number of requests in flight
+        rate: Maximum number of requests started per second
+        timeout: Total timeout in seconds for a single request
+        manifest: Optional FetchManifest that records every attempt under source
+        source: Source name used for the manifest rows
+        transform: Optional callable(job_id, content) returning the bytes to save
+        retry: RetryScheduler deciding which failures are retried and when
+        conditional: Send the validators stored in manifest so unchanged records
+            come back as 304 and are not rewritten
+        store: Optional RecordStore that receives the bodies instead of file_path
+        sink: Optional callable(job_id, content) run on every 200 body, e.g. a
+            stream_extract.RowSink that writes output rows while the pull runs
+        metrics: Optional metrics.RunMetrics that receives the requests, their
+            latency, bytes and retries by host
+        errors: Optional progress.ErrorLog for requests that raised (connection
+            errors, timeouts, failed saves); by default the first few are logged
+        adaptive: Let an AdaptiveConcurrency limiter per host decide how many of
+            the concurrency workers may have a request in flight, backing off on
+            429s, 5xx and latency spikes (the limit goes to metrics as a gauge)
+
+    Returns:
+        Dictionary mapping job_id to the HTTP status code of its last attempt
+        (None for connection errors, 304 for unchanged records)
+    """
+    retry = retry if retry is not None else RetryScheduler()
+    validators = manifest.validators(source) if conditional and manifest is not None else {}
+    queue = DelayQueue()
+    for job_id, url, file_path in jobs:
+        queue.add((job_id, url, file_path, 1))
+    total = queue.unfinished
+
+    results = {}
+    bucket = TokenBucket(rate)
+    errors = errors if errors is not None else ErrorLog(None, logger, stage='fetch')
+    progress = Progress(total, logger, label='records')
+    limiters = {}
+
+    def host_limiter(host):
+        limiter = limiters.get(host)
+        if limiter is None:
+            limiter = limiters[host] = AdaptiveConcurrency(concurrency)
+            if metrics is not None:
+                metrics.set('concurrency_limit', limiter.current(), host=host)
+        return limiter
+
+    async def worker(session):
+        while True:
+            item = await queue.get()
+            if item is None:
+                return
+            job_id, url, file_path, attempt = item
+            headers = conditional_headers(validators.get(str(job_id)))
+            host = url_host(url)
+            limiter = host_limiter(host) if adaptive else None
+            ticket = await limiter.acquire() if limiter is not None else None
+            result = await fetch_and_save(session, bucket, job_id, url, file_path, transform, headers, store, sink,
+                                          metrics, errors)
+            if limiter is not None:
+                cut = await limiter.release(ticket, result.status, result.seconds)
+                if metrics is not None:
+                    metrics.set('concurrency_limit', limiter.current(), host=host)
+                    if cut is not None:
+                        metrics.count('concurrency_decreases_total', host=host, reason=cut)
+                if cut is not None:
+                    logger.debug(f"{host}: {cut}, concurrency limit cut to {limiter.current()}")
+            if manifest is not None:
+                manifest.record(source, job_id, result.status, result.content, result.etag, result.last_modified)
+
+            delay = retry.next_delay(result.status, attempt, result.retry_after)
+            if delay is not None:
+                queue.put((job_id, url, file_path, attempt + 1), delay)
+                if metrics is not None:
+                    metrics.count('retries_total', host=host)
+                continue
+
+            results[job_id] = result.status
+            queue.done()
+            progress.set(waiting_to_retry=queue.delayed_count())
+            progress.update(not_fetched=int(result.status not in (200, 304)))
+
+    connector = aiohttp.TCPConnector(limit=concurrency)
+    client_timeout = aiohttp.ClientTimeout(total=timeout)
+    async with aiohttp.ClientSession(connector=connector, timeout=client_timeout) as session:
+        await asyncio.gather(*(worker(session) for _ in range(concurrency)))
+    progress.set(waiting_to_retry=0)
+    progress.finish()
+
+    if manifest is not None:
+        manifest.commit()
+    return results
+
+
+def run_fetch(jobs, **kwargs):
+    """Blocking wrapper around fetch_all for the synchronous pull scripts"""
+    return asyncio.run(fetch_all(jobs, **kwargs))
+
+
+def append_failed_ids(failed_ids, failed_ids_path):
+    """Append failed IDs to the failed-ID CSV, writing the header only once"""
+    if not failed_ids:
+        return
+    failed_data = pd.DataFrame(data={'failed_ids': failed_ids})
+    failed_data.to_csv(failed_ids_path, mode='a', index=False, header=not os.path.exists(failed_ids_path))
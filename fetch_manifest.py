@@ -0,0 +1,222 @@
+import hashlib
+import os
+import sqlite3
+from datetime import datetime
+from progress import get_logger
+
+# Record states
+PENDING = 'pending'
+OK = 'ok'
+MISSING = 'missing'  # The archive answered 404, re-requesting will not help
+FAILED = 'failed'
+OBSOLETE = 'obsolete'  # Fetched before, now withdrawn from the archive
+
+logger = get_logger('fetch_manifest')
+
+# Columns added after the first version of the table, created on open if missing
+added_columns = {
+    'etag': 'TEXT',
+    'last_modified': 'TEXT',
+    'last_changed': 'TEXT',
+}
+
+
+class FetchManifest:
+    """
+    SQLite record of every ID each puller has been asked to fetch
+
+    One row per (source, record_id) holds the last status, HTTP code, attempt
+    count, byte size, sha256 of the saved body and timestamps. Pullers use it to
+    decide what still needs downloading instead of listing the output directory.
+    The ETag / Last-Modified validators of the last download are kept for
+    conditional GETs, and last_changed records when the stored content last changed.
+    """
+
+    def __init__(self, path, commit_every=500):
+        self.path = path
+        self.commit_every = commit_every
+        self.uncommitted = 0
+        self.conn = sqlite3.connect(path)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS fetches (
+                source TEXT NOT NULL,
+                record_id TEXT NOT NULL,
+                status TEXT NOT NULL,
+                http_code INTEGER,
+                attempts INTEGER NOT NULL DEFAULT 0,
+                bytes INTEGER,
+                sha256 TEXT,
+                first_attempt TEXT,
+                last_attempt TEXT,
+                last_success TEXT,
+                PRIMARY KEY (source, record_id)
+            )
+        """)
+        existing = set(r[1] for r in self.conn.execute("PRAGMA table_info(fetches)"))
+        for column, column_type in added_columns.items():
+            if column not in existing:
+                self.conn.execute(f"ALTER TABLE fetches ADD COLUMN {column} {column_type}")
+        self.conn.execute("CREATE INDEX IF NOT EXISTS fetches_status ON fetches (source, status)")
+        self.conn.commit()
+
+    def count(self, source):
+        return self.conn.execute("SELECT COUNT(*) FROM fetches WHERE source = ?", (source,)).fetchone()[0]
+
+    def register(self, source, record_ids):
+        """Add IDs as pending, leaving IDs that are already known untouched"""
+        self.conn.executemany(
+            "INSERT OR IGNORE INTO fetches (source, record_id, status) VALUES (?, ?, ?)",
+            ((source, str(record_id), PENDING) for record_id in record_ids))
+        self.conn.commit()
+
+    def import_existing(self, source, record_ids, path_for_id):
+        """
+        Mark IDs whose output file already exists as fetched
+
+        Used once per source so that files pulled before the manifest existed are
+        not downloaded again. Checks each expected path instead of listing the directory.
+        """
+        now = datetime.now().isoformat(timespec='seconds')
+        rows = []
+        for record_id in record_ids:
+            try:
+                size = os.path.getsize(path_for_id(record_id))
+            except OSError:
+                continue
+            rows.append((source, str(record_id), OK, 200, 1, size, now, now, now, now))
+        self.conn.executemany("""
+            INSERT OR REPLACE INTO fetches
+                (source, record_id, status, http_code, attempts, bytes, first_attempt, last_attempt,
+                 last_success, last_changed)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+        """, rows)
+        self.conn.commit()
+        return len(rows)
+
+    def pending(self, source, record_ids=None):
+        """
+        IDs that still need fetching: never tried, or failed with a retryable error
+
+        Args:
+            source: Source name, e.g. 'emdb'
+            record_ids: Optional iterable restricting the result to these IDs
+        """
+        rows = self.conn.execute(
+            "SELECT record_id FROM fetches WHERE source = ? AND status IN (?, ?)",
+            (source, PENDING, FAILED)).fetchall()
+        pending_ids = [r[0] for r in rows]
+        if record_ids is not None:
+            wanted = set(str(i) for i in record_ids)
+            pending_ids = [i for i in pending_ids if i in wanted]
+        return pending_ids
+
+    def not_fetched(self, source, record_ids):
+        """IDs among record_ids that neither downloaded successfully nor were withdrawn"""
+        done = set(self.ids(source, OK)) | set(self.ids(source, OBSOLETE))
+        return [i for i in (str(r) for r in record_ids) if i not in done]
+
+    def ids(self, source, status=OK):
+        rows = self.conn.execute(
+            "SELECT record_id FROM fetches WHERE source = ? AND status = ?", (source, status)).fetchall()
+        return [r[0] for r in rows]
+
+    def record(self, source, record_id, http_code, content=None, etag=None, last_modified=None):
+        """
+        Store the outcome of one request
+
+        A 304 keeps the stored body and only refreshes the timestamps. A 404 for an
+        ID that was fetched before marks it obsolete rather than missing.
+        """
+        now = datetime.now().isoformat(timespec='seconds')
+        if http_code in (200, 304):
+            status = OK
+        elif http_code in (404, 410):
+            status = MISSING
+        else:
+            status = FAILED
+
+        size = len(content) if http_code == 200 and content is not None else None
+        digest = hashlib.sha256(content).hexdigest() if http_code == 200 and content is not None else None
+
+        self.conn.execute("""
+            INSERT INTO fetches (source, record_id, status, http_code, attempts, bytes, sha256,
+                                 first_attempt, last_attempt, last_success, etag, last_modified, last_changed)
+            VALUES (?, ?, ?, ?, 1, ?, ?, ?, ?, ?, ?, ?, ?)
+            ON CONFLICT (source, record_id) DO UPDATE SET
+                status = CASE WHEN excluded.status = 'missing' AND fetches.last_success IS NOT NULL
+                              THEN 'obsolete' ELSE excluded.status END,
+                http_code = excluded.http_code,
+                attempts = fetches.attempts + 1,
+                bytes = COALESCE(excluded.bytes, fetches.bytes),
+                sha256 = COALESCE(excluded.sha256, fetches.sha256),
+                first_attempt = COALESCE(fetches.first_attempt, excluded.first_attempt),
+                last_attempt = excluded.last_attempt,
+                last_success = COALESCE(excluded.last_success, fetches.last_success),
+                etag = COALESCE(excluded.etag, fetches.etag),
+                last_modified = COALESCE(excluded.last_modified, fetches.last_modified),
+                last_changed = CASE WHEN excluded.sha256 IS NOT NULL
+                                         AND excluded.sha256 IS NOT fetches.sha256
+                                    THEN excluded.last_changed ELSE fetches.last_changed END
+        """, (source, str(record_id), status, http_code, size, digest, now, now,
+              now if status == OK else None, etag, last_modified, now if digest else None))
+
+        self.uncommitted += 1
+        if self.uncommitted >= self.commit_every:
+            self.commit()
+
+    def validators(self, source):
+        """Dictionary of record_id -> (etag, last_modified) for conditional GETs"""
+        rows = self.conn.execute("""
+            SELECT record_id, etag, last_modified FROM fetches
+            WHERE source = ? AND status IN (?, ?) AND (etag IS NOT NULL OR last_modified IS NOT NULL)
+        """, (source, OK, PENDING)).fetchall()
+        return {r[0]: (r[1], r[2]) for r in rows}
+
+    def mark_stale(self, source, record_ids):
+        """Queue fetched IDs for another download, keeping their validators"""
+        self.conn.executemany(
+            "UPDATE fetches SET status = ? WHERE source = ? AND record_id = ? AND status = ?",
+            ((PENDING, source, str(record_id), OK) for record_id in record_ids))
+        self.conn.commit()
+
+    def mark_obsolete(self, source, record_ids):
+        """Flag IDs the archive has withdrawn"""
+        self.conn.executemany(
+            "UPDATE fetches SET status = ? WHERE source = ? AND record_id = ?",
+            ((OBSOLETE, source, str(record_id)) for record_id in record_ids))
+        self.conn.commit()
+
+    def last_pull(self, source):
+        """Timestamp of the most recent successful download for a source, or None"""
+        return self.conn.execute(
+            "SELECT MAX(last_success) FROM fetches WHERE source = ?", (source,)).fetchone()[0]
+
+    def times(self, source, column):
+        """Dictionary of record_id -> timestamp column ('last_success' or 'last_changed')"""
+        if column not in ('last_success', 'last_changed'):
+            raise ValueError(f"Unknown timestamp column {column}")
+        rows = self.conn.execute(
+            f"SELECT record_id, {column} FROM fetches WHERE source = ?", (source,)).fetchall()
+        return dict(rows)
+
+    def commit(self):
+        self.conn.commit()
+        self.uncommitted = 0
+
+    def progress(self, source):
+        """Dictionary of status -> count for one source"""
+        rows = self.conn.execute(
+            "SELECT status, COUNT(*) FROM fetches WHERE source = ? GROUP BY status", (source,)).fetchall()
+        return dict(rows)
+
+    def report(self, source):
+        counts = self.progress(source)
+        total = sum(counts.values())
+        parts = ", ".join(f"{status}: {counts[status]}" for status in sorted(counts))
+        logger.info(f"[{source}] {counts.get(OK, 0)} of {total} fetched ({parts})")
+
+    def close(self):
+        self.commit()
+        self.conn.close()
+
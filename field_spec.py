@@ -0,0 +1,97 @@
+# Declarative column specs for the extract scripts. A spec is a list of
+#   (column, path)  or  (column, path, formatter)  or  (column, path, formatter, default)
+# where path is a dotted JSON path ('rcsb_entry_info.molecular_weight', with
+# integers for list positions: 'refine.0.ls_rfactor_rfree'). column may also be a
+# tuple of names when the formatter returns one value per name.
+#
+# FieldSpec compiles the spec once into a Python function that walks every shared
+# path prefix a single time per document, so adding a column is a one-line change
+# and a row costs one dict lookup per distinct path step.
+#
+# Lookups follow the .get() chains they replace: a missing key gives the column's
+# default (None unless given), a null value stays None, and a path through a
+# missing, null, empty or mistyped node also gives the default.
+
+missing = object()
+
+
+def parse_path(path):
+    steps = []
+    for part in path.split('.'):
+        steps.append(int(part) if part.isdigit() else part)
+    return tuple(steps)
+
+
+class FieldSpec:
+    """
+    Row extractor compiled from a column spec
+
+    Calling the spec with a decoded document returns a dict of column -> value,
+    in spec order.
+    """
+
+    def __init__(self, fields):
+        self.fields = [self.normalize(f) for f in fields]
+        self.columns = []
+        for columns, _, _, _ in self.fields:
+            self.columns.extend(columns)
+        self.source = self.generate()
+        namespace = {'missing': missing}
+        for i, (_, _, formatter, default) in enumerate(self.fields):
+            namespace[f'format_{i}'] = formatter
+            namespace[f'default_{i}'] = default
+        exec(compile(self.source, '<field_spec>', 'exec'), namespace)
+        self.extract = namespace['extract']
+
+    @staticmethod
+    def normalize(field):
+        column, path = field[0], field[1]
+        formatter = field[2] if len(field) > 2 else None
+        default = field[3] if len(field) > 3 else None
+        columns = tuple(column) if isinstance(column, (tuple, list)) else (column,)
+        if len(columns) > 1 and formatter is None:
+            raise ValueError(f"Columns {columns} share one path and need a formatter that splits it")
+        return columns, parse_path(path), formatter, default
+
+    def generate(self):
+        """Source of extract(data): one local per distinct path prefix, then the row"""
+        lines = ['def extract(data):']
+        nodes = {(): 'data'}
+
+        def node_for(prefix):
+            # Intermediate nodes are dicts or lists; anything else ends the path
+            if prefix in nodes:
+                return nodes[prefix]
+            parent = node_for(prefix[:-1])
+            step = prefix[-1]
+            name = f'n{len(nodes)}'
+            if isinstance(step, int):
+                lines.append(f'    {name} = {parent}[{step}] if type({parent}) is list and len({parent}) > {step} else None')
+            else:
+                lines.append(f'    {name} = {parent}.get({step!r}) if type({parent}) is dict else None')
+            nodes[prefix] = name
+            return name
+
+        values = []
+        for i, (columns, path, formatter, _) in enumerate(self.fields):
+            parent = node_for(path[:-1])
+            step = path[-1]
+            value = f'v{i}'
+            if isinstance(step, int):
+                lines.append(f'    {value} = {parent}[{step}] if type({parent}) is list and len({parent}) > {step} else default_{i}')
+            else:
+                lines.append(f'    {value} = {parent}.get({step!r}, missing) if type({parent}) is dict else missing')
+                lines.append(f'    if {value} is missing:')
+                lines.append(f'        {value} = default_{i}')
+            if formatter is not None:
+                lines.append(f'    {value} = format_{i}({value})')
+            if len(columns) == 1:
+                values.append(f'{columns[0]!r}: {value}')
+            else:
+                values.extend(f'{column!r}: {value}[{j}]' for j, column in enumerate(columns))
+
+        lines.append('    return {' + ', '.join(values) + '}')
+        return '\n'.join(lines) + '\n'
+
+    def __call__(self, data):
+        return self.extract(data)
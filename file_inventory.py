@@ -0,0 +1,254 @@
+import argparse
+import os
+import sqlite3
+import time
+from progress import get_logger
+
+# Cached listings of the big JSON directories. The first listing of a directory
+# walks it once with os.scandir and keeps (name, size, mtime) of every file in a
+# SQLite index; later runs reuse the rows as long as the directory's own mtime is
+# unchanged, which is the case until a file is added, removed or renamed. When it
+# has changed, the directory is walked again but only new names are stat'ed.
+#
+# Because known names are not stat'ed again, their size/mtime is only known to be
+# current while the directory is unchanged since it was last fully stat'ed;
+# stat_entries() re-stats every file of a directory whose mtime moved since then.
+# Rewriting an existing file in place does not touch the directory mtime at all, so
+# the pullers write to a temporary name and rename it over the old file, which does;
+# refresh(full=True) re-stats everything. The index lives outside the listed
+# directories, as its own journal files would otherwise change their mtime on every write.
+default_index_path = os.path.join(os.path.expanduser('~'), '.cache', 'protein_science', 'inventory.sqlite')
+
+# A directory modified this close to its last scan may have changed again within
+# the same mtime tick (coarse on network filesystems), so that scan is not trusted
+racy_seconds = 2
+
+logger = get_logger('file_inventory')
+
+# Rows inserted per executemany while scanning
+insert_batch = 10000
+
+# Columns added after the first version of the directories table, created on open if missing
+added_columns = {
+    'stat_mtime_ns': 'INTEGER',
+}
+
+
+def scan_directory(directory, known=frozenset()):
+    """
+    Yield (name, size, mtime) for every file in directory, one scandir entry at a time
+
+    Names in known are yielded without a stat call, with size and mtime None.
+    """
+    with os.scandir(directory) as entries:
+        for entry in entries:
+            if entry.name in known:
+                yield entry.name, None, None
+                continue
+            try:
+                if not entry.is_file():
+                    continue
+                stat = entry.stat()
+            except OSError:
+                # Removed while we were scanning
+                continue
+            yield entry.name, stat.st_size, stat.st_mtime
+
+
+class FileInventory:
+    """
+    SQLite index of the files in one or more directories
+
+    Args:
+        index_path: Index file, shared by every directory listed through it
+    """
+
+    def __init__(self, index_path=default_index_path):
+        self.index_path = index_path
+        directory = os.path.dirname(index_path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.conn = sqlite3.connect(index_path, timeout=60)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS directories (
+                directory TEXT PRIMARY KEY,
+                mtime_ns INTEGER NOT NULL,
+                scanned_at REAL NOT NULL,
+                stat_mtime_ns INTEGER
+            )
+        """)
+        self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS files (
+                directory TEXT NOT NULL,
+                name TEXT NOT NULL,
+                size INTEGER,
+                mtime REAL,
+                PRIMARY KEY (directory, name)
+            )
+        """)
+        existing = set(r[1] for r in self.conn.execute("PRAGMA table_info(directories)"))
+        for column, column_type in added_columns.items():
+            if column not in existing:
+                self.conn.execute(f"ALTER TABLE directories ADD COLUMN {column} {column_type}")
+        self.conn.commit()
+
+    @staticmethod
+    def key(directory):
+        return os.path.realpath(directory)
+
+    def is_current(self, directory):
+        """True if the cached listing of directory can be used as is"""
+        row = self.conn.execute("SELECT mtime_ns, scanned_at FROM directories WHERE directory = ?",
+                                (self.key(directory),)).fetchone()
+        if row is None:
+            return False
+        stat = os.stat(directory)
+        mtime_ns, scanned_at = row
+        return stat.st_mtime_ns == mtime_ns and stat.st_mtime < scanned_at - racy_seconds
+
+    def refresh(self, directory, full=False):
+        """
+        Bring the listing of directory up to date
+
+        Args:
+            directory: Directory to list
+            full: Re-stat every file instead of only names that are new
+
+        Returns:
+            True if the directory was scanned, False if the cached listing was current
+        """
+        if not full and self.is_current(directory):
+            return False
+
+        key = self.key(directory)
+        # Taken before the walk, so a change made during it shows up next time
+        mtime_ns = os.stat(directory).st_mtime_ns
+        scanned_at = time.time()
+        known = set() if full else set(
+            r[0] for r in self.conn.execute("SELECT name FROM files WHERE directory = ?", (key,)))
+        if full:
+            self.conn.execute("DELETE FROM files WHERE directory = ?", (key,))
+
+        seen = set()
+        batch = []
+        for name, size, mtime in scan_directory(directory, known):
+            seen.add(name)
+            if name in known:
+                continue
+            batch.append((key, name, size, mtime))
+            if len(batch) >= insert_batch:
+                self.conn.executemany("INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?)", batch)
+                batch = []
+        if batch:
+            self.conn.executemany("INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?)", batch)
+
+        gone = known - seen
+        self.conn.executemany("DELETE FROM files WHERE directory = ? AND name = ?", ((key, n) for n in gone))
+        # Every file was stat'ed only if none were skipped as known
+        stat_mtime_ns = mtime_ns if not known else self.stat_mtime_ns(directory)
+        self.conn.execute("INSERT OR REPLACE INTO directories (directory, mtime_ns, scanned_at, stat_mtime_ns) "
+                          "VALUES (?, ?, ?, ?)", (key, mtime_ns, scanned_at, stat_mtime_ns))
+        self.conn.commit()
+        return True
+
+    def stat_mtime_ns(self, directory):
+        """Directory mtime when every file in it was last stat'ed, or None"""
+        row = self.conn.execute("SELECT stat_mtime_ns FROM directories WHERE directory = ?",
+                                (self.key(directory),)).fetchone()
+        return row[0] if row is not None else None
+
+    def entries(self, directory, prefix='', suffix='', refresh=True):
+        """(name, size, mtime) of the files in directory, sorted by name"""
+        if refresh:
+            self.refresh(directory)
+        rows = self.conn.execute("SELECT name, size, mtime FROM files WHERE directory = ? ORDER BY name",
+                                 (self.key(directory),))
+        return [r for r in rows if r[0].startswith(prefix) and r[0].endswith(suffix)]
+
+    def stat_entries(self, directory, prefix='', suffix=''):
+        """
+        (name, size, mtime) of the files in directory, with a current size and mtime
+
+        The cached rows are used as they are while the directory is unchanged since
+        its files were last stat'ed; otherwise every file in it is stat'ed again.
+        """
+        if not self.is_current(directory) or self.stat_mtime_ns(directory) != os.stat(directory).st_mtime_ns:
+            self.refresh(directory, full=True)
+        return self.entries(directory, prefix, suffix, refresh=False)
+
+    def names(self, directory, prefix='', suffix=''):
+        return [r[0] for r in self.entries(directory, prefix, suffix)]
+
+    def forget(self, directory):
+        key = self.key(directory)
+        self.conn.execute("DELETE FROM files WHERE directory = ?", (key,))
+        self.conn.execute("DELETE FROM directories WHERE directory = ?", (key,))
+        self.conn.commit()
+
+    def close(self):
+        self.conn.close()
+
+
+def list_files(directory, prefix='', suffix='', index_path=None):
+    """
+    Sorted names of the files in directory, through the cached inventory
+    (default_index_path if index_path is None)
+
+    Falls back to a plain scandir walk when the index cannot be opened or written.
+    """
+    try:
+        inventory = FileInventory(index_path if index_path is not None else default_index_path)
+        try:
+            return inventory.names(directory, prefix, suffix)
+        finally:
+            inventory.close()
+    except (sqlite3.Error, OSError) as e:
+        logger.warning(f"File inventory unavailable ({e}), listing {directory} directly")
+        return sorted(name for name, _, _ in scan_directory(directory)
+                      if name.startswith(prefix) and name.endswith(suffix))
+
+
+def file_stats(directory, prefix='', suffix='', index_path=None):
+    """
+    (name, size, mtime) of the files in directory, through the cached inventory
+    (default_index_path if index_path is None); see FileInventory.stat_entries
+
+    Falls back to a plain scandir walk when the index cannot be opened or written.
+    """
+    try:
+        inventory = FileInventory(index_path if index_path is not None else default_index_path)
+        try:
+            return inventory.stat_entries(directory, prefix, suffix)
+        finally:
+            inventory.close()
+    except (sqlite3.Error, OSError) as e:
+        logger.warning(f"File inventory unavailable ({e}), listing {directory} directly")
+        return sorted(r for r in scan_directory(directory) if r[0].startswith(prefix) and r[0].endswith(suffix))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Build or refresh the cached listing of JSON directories")
+    parser.add_argument('directories', nargs='+')
+    parser.add_argument('--index', default=default_index_path, help="Inventory index file")
+    parser.add_argument('--full', action='store_true', help="Re-stat every file, not just new names")
+    parser.add_argument('--forget', action='store_true', help="Drop the directories from the index")
+    args = parser.parse_args()
+
+    inventory = FileInventory(args.index)
+    for directory in args.directories:
+        if args.forget:
+            inventory.forget(directory)
+            print(f"{directory}: removed from the index")
+            continue
+        start = time.time()
+        scanned = inventory.refresh(directory, full=args.full)
+        entries = inventory.entries(directory, refresh=False)
+        total_bytes = sum(size or 0 for _, size, _ in entries)
+        print(f"{directory}: {len(entries)} files, {total_bytes / 1e9:.2f} GB "
+              f"({'scanned' if scanned else 'cached'} in {time.time() - start:.1f} s)")
+    inventory.close()
+
+
+if __name__ == "__main__":
+    main()
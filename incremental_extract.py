@@ -0,0 +1,213 @@
+import hashlib
+import json
+import multiprocessing as mp
+import os
+import sqlite3
+import time
+from collections import namedtuple
+from functools import partial
+from file_inventory import file_stats
+from progress import ErrorLog, Progress, get_logger
+from record_store import StoredRecord
+
+# Incremental mode for the extract scripts. Next to its output, an extractor keeps
+# a SQLite state file with one row per source file: the file's fingerprint (size,
+# a version that is the mtime for plain files or the shard position for a record
+# store, and the sha256 of its content) and the rows extracted from it as JSON.
+#
+# A run only extracts files whose size or version changed, and of those only the
+# ones whose sha256 changed too; rows of new and changed files are upserted, rows
+# of files that are gone are deleted, and the output is then written again from
+# the stored rows, which takes a fraction of re-parsing the corpus. Files that fail
+# are not stored, so they are retried and reported on every run.
+
+# Rows per executemany / commit while storing results
+commit_every = 1000
+# Files handed to a worker per task
+default_chunk_size = 100
+
+logger = get_logger('incremental_extract')
+
+
+class LoadedRecord(namedtuple('LoadedRecord', ['name', 'content'])):
+    """A record whose bytes have already been read (and hashed)"""
+    __slots__ = ()
+
+    def read(self):
+        return self.content
+
+
+def fingerprints(records):
+    """
+    (size, version) of each record, by name
+
+    Plain files come from the cached file inventory, so only directories that
+    changed since their files were last stat'ed are walked and stat'ed again;
+    records in a store use their shard position.
+    """
+    result = {}
+    by_directory = {}
+    for record in records:
+        if isinstance(record, StoredRecord):
+            result[record.name] = (record.size, f"{record.shard}:{record.block_offset}")
+        else:
+            by_directory.setdefault(os.path.dirname(record.path), set()).add(record.name)
+
+    for directory, names in by_directory.items():
+        for name, size, mtime in file_stats(directory):
+            if name in names:
+                result[name] = (size, repr(mtime))
+    return result
+
+
+def extract_record(record_rows, task):
+    """
+    Worker side of ExtractionState.update
+
+    Returns:
+        (name, sha256, rows or None when the content is unchanged, error message or None,
+         seconds taken)
+    """
+    start = time.perf_counter()
+    record, known_sha256 = task
+    try:
+        content = record.read()
+    except OSError as e:
+        return record.name, None, None, str(e), time.perf_counter() - start
+    sha256 = hashlib.sha256(content).hexdigest()
+    if sha256 == known_sha256:
+        return record.name, sha256, None, None, time.perf_counter() - start
+    try:
+        return record.name, sha256, record_rows(LoadedRecord(record.name, content)), None, time.perf_counter() - start
+    except Exception as e:
+        return record.name, sha256, None, str(e), time.perf_counter() - start
+
+
+class ExtractionState:
+    """
+    Fingerprints and extracted rows of every source file of one output
+
+    Args:
+        path: State file, kept next to the output
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.conn = sqlite3.connect(path)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS files (
+                name TEXT PRIMARY KEY,
+                size INTEGER,
+                version TEXT,
+                sha256 TEXT,
+                rows TEXT NOT NULL
+            )
+        """)
+        self.conn.commit()
+
+    def count(self):
+        return self.conn.execute("SELECT COUNT(*) FROM files").fetchone()[0]
+
+    def plan(self, records):
+        """
+        Compare the current records with the stored fingerprints
+
+        Returns:
+            (list of (record, stored sha256 or None) to look at, names that are gone,
+             current fingerprints by name)
+        """
+        known = {name: (size, version, sha256) for name, size, version, sha256
+                 in self.conn.execute("SELECT name, size, version, sha256 FROM files")}
+        current = fingerprints(records)
+        tasks = []
+        for record in records:
+            stored = known.get(record.name)
+            if stored is None:
+                tasks.append((record, None))
+            elif current.get(record.name) != (stored[0], stored[1]):
+                tasks.append((record, stored[2]))
+        names = set(r.name for r in records)
+        gone = [name for name in known if name not in names]
+        return tasks, gone, current
+
+    def update(self, records, record_rows, processes=None, chunk_size=default_chunk_size, metrics=None,
+               errors=None):
+        """
+        Extract new and changed records and drop the rows of removed ones
+
+        Args:
+            records: Current list_records() of the source
+            record_rows: Picklable function of a record (with .name and .read())
+                returning the list of rows extracted from it; raises on failure
+            processes: Worker processes, None for one per core, 1 to run in this process
+            metrics: Optional metrics.RunMetrics that receives the files extracted or
+                failed and the worker time per file
+            errors: Optional progress.ErrorLog for the files that failed
+
+        Returns:
+            Names of the records that failed
+        """
+        tasks, gone, current = self.plan(records)
+        logger.info(f"Incremental extraction: {len(records)} files, {len(tasks)} new or modified, {len(gone)} removed")
+
+        self.conn.executemany("DELETE FROM files WHERE name = ?", ((name,) for name in gone))
+
+        errors = errors if errors is not None else ErrorLog(None, logger, stage='extract')
+        progress = Progress(len(tasks), logger)
+        extracted = unchanged = 0
+        failed = []
+        pending = []
+        work = partial(extract_record, record_rows)
+        pool = None
+        if processes != 1 and len(tasks) > chunk_size:
+            pool = mp.Pool(processes=processes)
+            results = pool.imap_unordered(work, tasks, chunksize=chunk_size)
+        else:
+            results = map(work, tasks)
+
+        try:
+            for name, sha256, rows, error, seconds in results:
+                size, version = current.get(name, (None, None))
+                if metrics is not None:
+                    metrics.observe('parse_seconds', seconds)
+                    metrics.count('files_failed_total' if error is not None else 'files_parsed_total')
+                if error is not None:
+                    # Old rows no longer describe the file; leave it unrecorded so it is retried
+                    errors.record(name, error, stage='extract')
+                    failed.append(name)
+                    self.conn.execute("DELETE FROM files WHERE name = ?", (name,))
+                elif rows is None:
+                    unchanged += 1
+                    self.conn.execute("UPDATE files SET size = ?, version = ? WHERE name = ?", (size, version, name))
+                else:
+                    extracted += 1
+                    pending.append((name, size, version, sha256, json.dumps(rows)))
+                    if len(pending) >= commit_every:
+                        self.store(pending)
+                        pending = []
+                progress.update(failed=int(error is not None))
+        finally:
+            if pool is not None:
+                pool.close()
+                pool.join()
+
+        self.store(pending)
+        progress.finish()
+        logger.info(f"Incremental extraction: {extracted} extracted, {unchanged} unchanged content, {len(failed)} failed")
+        return failed
+
+    def store(self, pending):
+        self.conn.executemany("INSERT OR REPLACE INTO files (name, size, version, sha256, rows) VALUES (?, ?, ?, ?, ?)",
+                              pending)
+        self.conn.commit()
+
+    def rows(self):
+        """Every stored row, in file name order"""
+        for (rows,) in self.conn.execute("SELECT rows FROM files ORDER BY name"):
+            for row in json.loads(rows):
+                yield row
+
+    def close(self):
+        self.conn.commit()
+        self.conn.close()
@@ -0,0 +1,127 @@
+import requests
+from fetch_manifest import OK
+from progress import get_logger
+
+# RCSB publishes the current and withdrawn entry IDs, and the search API can list
+# entries revised after a date. Together they give the weekly change set without
+# touching unchanged entries.
+rcsb_holdings_url = "https://data.rcsb.org/rest/v1/holdings"
+rcsb_search_url = "https://search.rcsb.org/rcsbsearch/v2/query"
+
+logger = get_logger('incremental_refresh')
+
+
+def fetch_current_entry_ids(holdings_url=rcsb_holdings_url):
+    response = requests.get(f"{holdings_url}/current/entry_ids", timeout=300)
+    response.raise_for_status()
+    return response.json()
+
+
+def fetch_removed_entry_ids(holdings_url=rcsb_holdings_url):
+    response = requests.get(f"{holdings_url}/removed/entry_ids", timeout=300)
+    response.raise_for_status()
+    return response.json()
+
+
+def fetch_revised_entry_ids(since, search_url=rcsb_search_url):
+    """
+    Entry IDs whose rcsb_accession_info.revision_date is after since
+
+    Args:
+        since: ISO date or timestamp of the last pull
+
+    Returns:
+        List of entry IDs
+    """
+    query = {
+        "query": {
+            "type": "terminal",
+            "service": "text",
+            "parameters": {
+                "attribute": "rcsb_accession_info.revision_date",
+                "operator": "greater",
+                "value": since[:10],
+            },
+        },
+        "return_type": "entry",
+        "request_options": {"return_all_hits": True},
+    }
+    response = requests.post(search_url, json=query, timeout=300)
+    # The search API answers 204 No Content when nothing matches
+    if response.status_code == 204:
+        return []
+    response.raise_for_status()
+    return [hit['identifier'] for hit in response.json().get('result_set', [])]
+
+
+def plan_pdb_entry_refresh(manifest, source, pdb_ids, holdings_url=rcsb_holdings_url,
+                           search_url=rcsb_search_url):
+    """
+    Prepare the manifest for an incremental PDB entry pull
+
+    New IDs in the current holdings are added, entries revised since the last
+    pull are queued again, and withdrawn entries are marked obsolete.
+
+    Returns:
+        List of every current PDB ID (pdb_ids plus new holdings)
+    """
+    since = manifest.last_pull(source)
+    current = fetch_current_entry_ids(holdings_url)
+    removed = set(i.upper() for i in fetch_removed_entry_ids(holdings_url))
+
+    # Keep the caller's spelling of known IDs, add new ones as the archive writes them
+    all_ids = {str(i).upper(): i for i in current}
+    all_ids.update({str(i).upper(): i for i in pdb_ids if str(i).upper() not in removed})
+    manifest.register(source, all_ids.values())
+
+    obsolete = [i for i in pdb_ids if str(i).upper() in removed]
+    manifest.mark_obsolete(source, obsolete)
+
+    revised = []
+    if since:
+        revised_upper = set(i.upper() for i in fetch_revised_entry_ids(since, search_url))
+        revised = [i for key, i in all_ids.items() if key in revised_upper]
+        manifest.mark_stale(source, revised)
+
+    logger.info(f"[{source}] Incremental refresh since {since}: {len(all_ids)} current, "
+                f"{len(revised)} revised, {len(obsolete)} withdrawn")
+    return list(all_ids.values())
+
+
+def plan_entity_refresh(manifest, entry_source, entity_source):
+    """
+    Queue polymer entities whose entry changed after the entity was last fetched
+
+    Entities of withdrawn entries are marked obsolete. Entity record IDs are
+    '{pdb_id}_{entity_id}'.
+    """
+    entry_changed = manifest.times(entry_source, 'last_changed')
+    obsolete_entries = set(manifest.ids(entry_source, 'obsolete'))
+    entity_success = manifest.times(entity_source, 'last_success')
+
+    stale = []
+    obsolete = []
+    for record_id, fetched_at in entity_success.items():
+        pdb_id = record_id.rsplit('_', 1)[0]
+        if pdb_id in obsolete_entries:
+            obsolete.append(record_id)
+        elif fetched_at and (entry_changed.get(pdb_id) or '') > fetched_at:
+            stale.append(record_id)
+
+    manifest.mark_stale(entity_source, stale)
+    manifest.mark_obsolete(entity_source, obsolete)
+    logger.info(f"[{entity_source}] Incremental refresh: {len(stale)} entities queued, {len(obsolete)} withdrawn")
+
+
+def plan_revalidation(manifest, source, record_ids):
+    """
+    Queue every fetched ID for a conditional GET
+
+    For archives without a change list (EMDB, EMPIAR) the ETag / Last-Modified
+    check is the change signal: unchanged records answer 304 and are not
+    rewritten, withdrawn ones answer 404 and are marked obsolete.
+    """
+    fetched = set(manifest.ids(source, OK))
+    to_check = [i for i in (str(r) for r in record_ids) if i in fetched]
+    manifest.mark_stale(source, to_check)
+    logger.info(f"[{source}] Incremental refresh: revalidating {len(to_check)} fetched records")
@@ -0,0 +1,255 @@
+import atexit
+import json
+import os
+import time
+from bisect import bisect_left
+from urllib.parse import urlsplit
+from progress import get_logger
+
+# Run metrics of the pullers and extractors. A script creates one RunMetrics named
+# after itself and counts or times its stages into it; every export_interval seconds
+# the metrics are written to <metrics dir>/<job>.prom in the Prometheus text format
+# (for node_exporter's textfile collector), and a JSON summary with rates and latency
+# percentiles goes to <metrics dir>/<job>.json when the run ends. Counters and
+# histograms carry labels (host and status for HTTP requests, table for flushes), and
+# gauges hold levels such as the adaptive concurrency limit of each host, so
+# a throttled host or a slow stage stands out without reading the logs.
+default_metrics_dir = "/home/zhn1744/AlphaFold/data/metrics"
+export_interval = 30
+metric_prefix = 'protein_science_'
+
+logger = get_logger('metrics')
+
+# Upper bounds in seconds of the histogram buckets, from sub-millisecond parses to
+# hung requests
+default_buckets = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+                   1, 2.5, 5, 10, 30, 60, 120)
+
+# Percentiles reported in the summary
+summary_percentiles = (50, 90, 99)
+
+# Metrics the scripts record: name -> (type, help)
+metric_help = {
+    'requests_total': ('counter', "HTTP responses by host and status (error: no response)"),
+    'request_seconds': ('histogram', "HTTP request latency by host"),
+    'retries_total': ('counter', "Requests scheduled again after a failed attempt, by host"),
+    'downloaded_bytes_total': ('counter', "Response bytes received with a 200, by host"),
+    'files_parsed_total': ('counter', "Source files extracted"),
+    'files_failed_total': ('counter', "Source files that failed to extract"),
+    'parse_seconds': ('histogram', "Time to load and extract one source file"),
+    'rows_written_total': ('counter', "Output rows written, by table"),
+    'flush_seconds': ('histogram', "Time to write one batch of rows, by table"),
+    'concurrency_limit': ('gauge', "Requests allowed in flight by the adaptive limiter, by host"),
+    'concurrency_decreases_total': ('counter', "Cuts of the adaptive concurrency limit, by host and reason"),
+}
+
+
+def url_host(url):
+    return urlsplit(url).netloc or 'unknown'
+
+
+def label_text(labels):
+    """Prometheus label set of a sorted (name, value) tuple, '' when there are none"""
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{k}="{v}"' for k, v in labels) + '}'
+
+
+class Histogram:
+    """Bucketed distribution of durations in seconds, with count, sum and maximum"""
+
+    def __init__(self, buckets=default_buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, value, count=1):
+        self.counts[bisect_left(self.buckets, value)] += count
+        self.count += count
+        self.sum += value * count
+        if value > self.max:
+            self.max = value
+
+    def percentile(self, p):
+        """Estimate the pth percentile by interpolating within its bucket"""
+        if self.count == 0:
+            return None
+        rank = self.count * p / 100
+        seen = 0
+        for index, n in enumerate(self.counts):
+            if n and seen + n >= rank:
+                lower = self.buckets[index - 1] if index > 0 else 0.0
+                upper = self.buckets[index] if index < len(self.buckets) else self.max
+                return min(self.max, lower + (upper - lower) * (rank - seen) / n)
+            seen += n
+        return self.max
+
+    def summary(self):
+        result = {'count': self.count, 'sum': round(self.sum, 6),
+                  'mean': round(self.sum / self.count, 6) if self.count else None, 'max': round(self.max, 6)}
+        for p in summary_percentiles:
+            value = self.percentile(p)
+            result[f'p{p}'] = round(value, 6) if value is not None else None
+        return result
+
+
+class RunMetrics:
+    """
+    Counters, gauges and histograms of one run of a script
+
+    Args:
+        job: Name of the run, used as the job label and the file names
+        directory: Where the .prom and .json files go, default_metrics_dir if None
+        interval: Seconds between textfile exports, export_interval if None
+    """
+
+    def __init__(self, job, directory=None, interval=None):
+        self.job = job
+        self.directory = directory if directory is not None else default_metrics_dir
+        self.interval = interval if interval is not None else export_interval
+        self.started = time.time()
+        self.start = time.monotonic()
+        self.next_export = self.start + self.interval
+        self.counters = {}
+        self.gauges = {}
+        self.histograms = {}
+        self.closed = False
+        os.makedirs(self.directory, exist_ok=True)
+        # An unattended run that dies still leaves its summary behind
+        atexit.register(self.close)
+
+    def count(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        self.counters[key] = self.counters.get(key, 0) + value
+        self.maybe_export()
+
+    def set(self, name, value, **labels):
+        """Set a gauge to its current level"""
+        self.gauges[(name, tuple(sorted(labels.items())))] = value
+        self.maybe_export()
+
+    def observe(self, name, seconds, count=1, **labels):
+        """Record a duration; count > 1 records it for that many items at once"""
+        key = (name, tuple(sorted(labels.items())))
+        histogram = self.histograms.get(key)
+        if histogram is None:
+            histogram = self.histograms[key] = Histogram()
+        histogram.observe(seconds, count)
+        self.maybe_export()
+
+    def timer(self, name, **labels):
+        return Timer(self, name, labels)
+
+    def total(self, name):
+        return sum(v for (n, _), v in self.counters.items() if n == name)
+
+    def maybe_export(self):
+        if time.monotonic() >= self.next_export:
+            self.export()
+
+    def prometheus_text(self):
+        elapsed = time.monotonic() - self.start
+        job = (('job', self.job),)
+        lines = []
+        families = sorted(set(n for n, _ in self.counters) | set(n for n, _ in self.gauges)
+                          | set(n for n, _ in self.histograms))
+        for name in families:
+            if any(n == name for n, _ in self.histograms):
+                default_kind = 'histogram'
+            elif any(n == name for n, _ in self.gauges):
+                default_kind = 'gauge'
+            else:
+                default_kind = 'counter'
+            kind, help_text = metric_help.get(name, (default_kind, name))
+            full_name = metric_prefix + name
+            lines.append(f"# HELP {full_name} {help_text}")
+            lines.append(f"# TYPE {full_name} {kind}")
+            for (n, labels), value in sorted(self.counters.items()) + sorted(self.gauges.items()):
+                if n == name:
+                    lines.append(f"{full_name}{label_text(job + labels)} {value}")
+            for (n, labels), histogram in sorted(self.histograms.items()):
+                if n != name:
+                    continue
+                cumulative = 0
+                for bound, n_bucket in zip(self.buckets_text(histogram), histogram.counts):
+                    cumulative += n_bucket
+                    lines.append(f"{full_name}_bucket{label_text(job + labels + (('le', bound),))} {cumulative}")
+                lines.append(f"{full_name}_sum{label_text(job + labels)} {histogram.sum:.6f}")
+                lines.append(f"{full_name}_count{label_text(job + labels)} {histogram.count}")
+        lines.append(f"# TYPE {metric_prefix}run_start_time_seconds gauge")
+        lines.append(f"{metric_prefix}run_start_time_seconds{label_text(job)} {self.started:.3f}")
+        lines.append(f"# TYPE {metric_prefix}run_elapsed_seconds gauge")
+        lines.append(f"{metric_prefix}run_elapsed_seconds{label_text(job)} {elapsed:.3f}")
+        return '\n'.join(lines) + '\n'
+
+    def buckets_text(self, histogram):
+        return [repr(float(b)) for b in histogram.buckets] + ['+Inf']
+
+    def export(self):
+        """Write the Prometheus textfile; renamed into place so a scrape never sees half a file"""
+        path = os.path.join(self.directory, f"{self.job}.prom")
+        with open(path + '.tmp', 'w') as f:
+            f.write(self.prometheus_text())
+        os.replace(path + '.tmp', path)
+        self.next_export = time.monotonic() + self.interval
+
+    def summary(self):
+        elapsed = time.monotonic() - self.start
+        counters = {}
+        for (name, labels), value in sorted(self.counters.items()):
+            counters.setdefault(name, {'total': 0, 'per_second': None, 'by_label': {}})
+            counters[name]['total'] += value
+            counters[name]['by_label'][','.join(f"{k}={v}" for k, v in labels)] = value
+        for counter in counters.values():
+            counter['per_second'] = round(counter['total'] / elapsed, 3) if elapsed > 0 else None
+        gauges = {}
+        for (name, labels), value in sorted(self.gauges.items()):
+            gauges.setdefault(name, {})[','.join(f"{k}={v}" for k, v in labels)] = value
+        histograms = {}
+        for (name, labels), histogram in sorted(self.histograms.items()):
+            histograms.setdefault(name, {})[','.join(f"{k}={v}" for k, v in labels)] = histogram.summary()
+        return {
+            'job': self.job,
+            'started': time.strftime('%Y-%m-%dT%H:%M:%S', time.localtime(self.started)),
+            'finished': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'seconds': round(elapsed, 3),
+            'counters': counters,
+            'gauges': gauges,
+            'histograms': histograms,
+        }
+
+    def close(self):
+        """
+        Write the final textfile and the JSON summary
+
+        Returns:
+            Path of the summary
+        """
+        path = os.path.join(self.directory, f"{self.job}.json")
+        if self.closed:
+            return path
+        self.closed = True
+        self.export()
+        with open(path, 'w') as f:
+            json.dump(self.summary(), f, indent=4)
+        logger.info(f"Metrics summary saved to {path}")
+        return path
+
+
+class Timer:
+    """Context manager that observes the seconds spent in its block"""
+
+    def __init__(self, metrics, name, labels):
+        self.metrics = metrics
+        self.name = name
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.metrics.observe(self.name, time.perf_counter() - self.start, **self.labels)
+        return False
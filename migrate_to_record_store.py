@@ -0,0 +1,61 @@
+import argparse
+import os
+from file_inventory import list_files
+from progress import ErrorLog, Progress, get_logger
+from record_store import RecordStore
+
+# Copies an existing directory of response_*.json files into a record store.
+# The source files are left in place; delete them once the extract scripts
+# have been pointed at the store and checked.
+
+logger = get_logger('migrate_to_record_store')
+
+
+def migrate(source_dir, store_path, prefix=''):
+    """
+    Append every JSON file in source_dir to the record store at store_path
+
+    Files already in the store under the same name are skipped, so an
+    interrupted migration can be started again.
+
+    Returns:
+        Number of files copied
+    """
+    store = RecordStore(store_path)
+    stored = set(store.names())
+    file_names = [f for f in list_files(source_dir, prefix, '.json') if f not in stored]
+    logger.info(f"Files to copy: {len(file_names)} ({len(stored)} already in the store)")
+
+    copied = 0
+    progress = Progress(len(file_names), logger)
+    errors = ErrorLog(None, logger, stage='copy')
+    for file_name in file_names:
+        with open(os.path.join(source_dir, file_name), 'rb') as f:
+            body = f.read()
+        try:
+            store.put(file_name, body)
+            copied += 1
+            progress.update()
+        except ValueError as e:
+            errors.record(file_name, e)
+            progress.update(skipped=1)
+
+    progress.finish()
+    errors.close()
+    store.close()
+    return copied
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Copy a directory of JSON responses into a record store")
+    parser.add_argument('--source-dir', required=True, help="Directory of response_*.json files")
+    parser.add_argument('--store', required=True, help="Record store directory (created if missing)")
+    parser.add_argument('--prefix', default="", help="Only copy files whose name starts with this")
+    args = parser.parse_args()
+
+    copied = migrate(args.source_dir, args.store, args.prefix)
+    logger.info(f"Migration complete. Copied {copied} files into {args.store}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,360 @@
+import argparse
+import asyncio
+import hashlib
+import json
+import math
+import os
+import random
+import re
+import time
+from collections import Counter, namedtuple
+from datetime import datetime, timezone
+from email.utils import format_datetime, parsedate_to_datetime
+from aiohttp import web
+
+# Local stand-in for data.rcsb.org and the EMDB / EMPIAR APIs that serves recorded
+# payloads, so the pullers can be exercised offline and load-tested without risking
+# a ban (run them with --base-url http://localhost:8080). Payloads use the puller
+# file names, looked up in each --payloads directory in turn:
+#   /rest/v1/core/entry/{pdb_id}                   response_entry_{pdb_id}.json
+#   /rest/v1/core/polymer_entity/{pdb_id}/{n}      response_entry_{pdb_id}_{n}.json
+#   /emdb/api/entry/{emdb_id}                      response_emdb_{emdb_id}.json
+#   /empiar/api/emdb_ref/{emdb_id}                 response_empiar_{emdb_id}.json
+# POST /graphql answers entries / polymer_entities queries from the same entry
+# files, keeping only the fields (and aliases) in the query's selection.
+# The directories of a synthetic_corpus.py corpus can be served as they are.
+# Payload files are re-read on every request, so editing one changes its ETag and
+# Last-Modified, and deleting one makes it answer 404.
+#
+# Faults can be injected into every archive request: added latency, random 404,
+# 429 (with Retry-After), 5xx answers and hung requests that outlast the client
+# timeout, and a server-wide rate limit that answers 429 past a number of requests
+# per second. GET /mock/stats returns the count of answers by status.
+
+# Fault injection settings. latency and jitter are in seconds; the *_rate fields
+# are the chance of each fault per request; hang_seconds is how long a "timed out"
+# request is held before the server gives up with 504; rate_limit is in requests
+# per second (None for no limit); retry_after is sent with injected 429 / 503.
+Faults = namedtuple('Faults', ['latency', 'jitter', 'not_found_rate', 'throttle_rate', 'error_rate',
+                               'timeout_rate', 'hang_seconds', 'rate_limit', 'retry_after'])
+no_faults = Faults(latency=0.0, jitter=0.0, not_found_rate=0.0, throttle_rate=0.0, error_rate=0.0,
+                   timeout_rate=0.0, hang_seconds=120.0, rate_limit=None, retry_after=1)
+
+
+class RateLimit:
+    """Token bucket that turns away requests past rate per second instead of queueing them"""
+
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity if capacity else max(1, rate)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+
+    def take(self):
+        """0 if the request may go ahead, otherwise the seconds until a token is free"""
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0
+        return (1 - self.tokens) / self.rate
+
+
+# Keys of the app state set up by make_app
+payloads_key = web.AppKey('payloads', list)
+fail_ids_key = web.AppKey('fail_ids', set)
+removed_ids_key = web.AppKey('removed_ids', set)
+faults_key = web.AppKey('faults', Faults)
+limiter_key = web.AppKey('limiter', RateLimit)
+random_key = web.AppKey('random', random.Random)
+stats_key = web.AppKey('stats', Counter)
+
+
+def payload_path(app, file_name):
+    """First --payloads directory holding file_name, or None"""
+    for directory in app[payloads_key]:
+        file_path = os.path.join(directory, file_name)
+        if os.path.exists(file_path):
+            return file_path
+    return None
+
+
+def load_payload(app, record_id):
+    file_path = payload_path(app, f'response_entry_{record_id}.json')
+    if file_path is None:
+        return None
+    with open(file_path, 'r') as f:
+        return json.load(f)
+
+
+def not_modified(request, etag, last_modified):
+    if_none_match = request.headers.get('If-None-Match')
+    if if_none_match is not None:
+        return if_none_match == etag
+    if_modified_since = request.headers.get('If-Modified-Since')
+    if if_modified_since is not None:
+        try:
+            return last_modified.replace(microsecond=0) <= parsedate_to_datetime(if_modified_since)
+        except (TypeError, ValueError):
+            return False
+    return False
+
+
+def serve_record(request, record_id, file_name):
+    """Answer a REST request with the recorded payload, honouring conditional GETs"""
+    if record_id in request.app[fail_ids_key]:
+        return web.Response(status=500)
+    file_path = payload_path(request.app, file_name)
+    if file_path is None:
+        return web.json_response({'status': 404, 'message': 'No data found'}, status=404)
+
+    with open(file_path, 'rb') as f:
+        body = f.read()
+    etag = '"' + hashlib.sha1(body).hexdigest() + '"'
+    last_modified = datetime.fromtimestamp(os.path.getmtime(file_path), timezone.utc)
+    headers = {'ETag': etag, 'Last-Modified': format_datetime(last_modified, usegmt=True)}
+
+    if not_modified(request, etag, last_modified):
+        return web.Response(status=304, headers=headers)
+    return web.Response(body=body, content_type='application/json', headers=headers)
+
+
+async def rest_entry(request):
+    pdb_id = request.match_info['pdb_id']
+    return serve_record(request, pdb_id, f'response_entry_{pdb_id}.json')
+
+
+async def rest_polymer_entity(request):
+    record_id = f"{request.match_info['pdb_id']}_{request.match_info['entity_id']}"
+    return serve_record(request, record_id, f'response_entry_{record_id}.json')
+
+
+async def emdb_entry(request):
+    emdb_id = request.match_info['emdb_id']
+    return serve_record(request, emdb_id, f'response_emdb_{emdb_id}.json')
+
+
+async def empiar_emdb_ref(request):
+    emdb_id = request.match_info['emdb_id']
+    return serve_record(request, emdb_id, f'response_empiar_{emdb_id}.json')
+
+
+def recorded_entry_ids(app):
+    names = set()
+    for directory in app[payloads_key]:
+        names.update(f[len('response_entry_'):-len('.json')] for f in os.listdir(directory)
+                     if f.startswith('response_entry_') and f.endswith('.json'))
+    return sorted(n for n in names if '_' not in n)
+
+
+async def holdings_current(request):
+    return web.json_response(recorded_entry_ids(request.app))
+
+
+async def holdings_removed(request):
+    return web.json_response(sorted(request.app[removed_ids_key]))
+
+
+async def search(request):
+    # Only the revision-date query used by incremental_refresh.py is supported;
+    # a payload counts as revised when its file changed after the given date
+    body = await request.json()
+    since = datetime.fromisoformat(body['query']['parameters']['value']).replace(tzinfo=timezone.utc)
+    hits = []
+    for record_id in recorded_entry_ids(request.app):
+        file_path = payload_path(request.app, f'response_entry_{record_id}.json')
+        modified = datetime.fromtimestamp(os.path.getmtime(file_path), timezone.utc)
+        if modified > since:
+            hits.append({'identifier': record_id, 'score': 1.0})
+    if not hits:
+        return web.Response(status=204)
+    return web.json_response({'total_count': len(hits), 'result_set': hits})
+
+
+def parse_selection(tokens, position):
+    """
+    Parse a GraphQL selection set starting at the '{' at tokens[position]
+
+    Returns:
+        (list of (alias, field, sub-selection or None), position past the closing '}')
+    """
+    fields = []
+    position += 1
+    while tokens[position] != '}':
+        alias = field = tokens[position]
+        position += 1
+        if tokens[position] == ':':
+            field = tokens[position + 1]
+            position += 2
+        selection = None
+        if tokens[position] == '{':
+            selection, position = parse_selection(tokens, position)
+        fields.append((alias, field, selection))
+    return fields, position + 1
+
+
+def field_key(name):
+    # GraphQL spells fields the mmCIF way (ls_R_factor_R_free), the recorded REST
+    # payloads in snake case (ls_rfactor_rfree)
+    return name.replace('_', '').lower()
+
+
+def select(value, selection):
+    """Project a recorded REST document onto a GraphQL selection, like the real endpoint"""
+    if value is None or selection is None:
+        return value
+    if isinstance(value, list):
+        return [select(item, selection) for item in value]
+    keys = {field_key(key): key for key in value}
+    record = {}
+    for alias, field, sub_selection in selection:
+        key = keys.get(field_key(field))
+        record[alias] = select(value[key], sub_selection) if key is not None else None
+    return record
+
+
+async def graphql(request):
+    body = await request.json()
+    query = body.get('query', '')
+    ids = body.get('variables', {}).get('ids', [])
+
+    # A batch containing a failing ID errors as a whole, like a resolver that crashes:
+    # GraphQL still answers 200, with errors and no data
+    if any(i in request.app[fail_ids_key] for i in ids):
+        return web.json_response({'data': None, 'errors': [{'message': 'Internal server error'}]})
+
+    root = 'polymer_entities' if 'polymer_entities' in query else 'entries'
+    # The record selection is the set that follows the root field's arguments
+    tokens = re.findall(r'[A-Za-z_][A-Za-z0-9_]*|[{}:]', query[query.index(')', query.index(root)) + 1:])
+    selection, _ = parse_selection(tokens, 0)
+    records = []
+    for record_id in ids:
+        payload = load_payload(request.app, record_id)
+        if payload is not None:
+            records.append(select(payload, selection))
+    return web.json_response({'data': {root: records}})
+
+
+async def stats(request):
+    counts = request.app[stats_key]
+    return web.json_response({'requests': sum(counts.values()),
+                              'statuses': {str(status): n for status, n in sorted(counts.items())}})
+
+
+async def injected_fault(app):
+    """Response for a request hit by a random fault, or None"""
+    faults = app[faults_key]
+    draw = app[random_key].random()
+    for rate, fault in ((faults.timeout_rate, 'hang'), (faults.throttle_rate, 429),
+                        (faults.error_rate, 'error'), (faults.not_found_rate, 404)):
+        if draw < rate:
+            break
+        draw -= rate
+    else:
+        return None
+
+    retry_after = {'Retry-After': str(faults.retry_after)}
+    if fault == 'hang':
+        # Hold the request past any sane client timeout, then give up like a stuck gateway
+        await asyncio.sleep(faults.hang_seconds)
+        return web.Response(status=504)
+    if fault == 429:
+        return web.json_response({'status': 429, 'message': 'Too many requests'}, status=429, headers=retry_after)
+    if fault == 404:
+        return web.json_response({'status': 404, 'message': 'No data found'}, status=404)
+    status = app[random_key].choice([500, 502, 503])
+    return web.Response(status=status, headers=retry_after if status == 503 else None)
+
+
+@web.middleware
+async def inject_faults(request, handler):
+    """Apply the rate limit and the configured faults to every archive request"""
+    if request.path.startswith('/mock/'):
+        return await handler(request)
+    app = request.app
+    faults = app[faults_key]
+
+    response = None
+    if app[limiter_key] is not None:
+        wait = app[limiter_key].take()
+        if wait:
+            response = web.json_response({'status': 429, 'message': 'Rate limit exceeded'}, status=429,
+                                         headers={'Retry-After': str(math.ceil(wait))})
+    if response is None:
+        if faults.latency or faults.jitter:
+            await asyncio.sleep(max(0.0, app[random_key].gauss(faults.latency, faults.jitter)))
+        response = await injected_fault(app)
+    if response is None:
+        response = await handler(request)
+    app[stats_key][response.status] += 1
+    return response
+
+
+def make_app(payloads, fail_ids=(), removed_ids=(), faults=no_faults, seed=None):
+    """
+    Args:
+        payloads: Directory, or list of directories searched in order, of recorded responses
+        fail_ids: Record IDs that always answer with HTTP 500
+        removed_ids: Entry IDs listed as withdrawn by the holdings endpoint
+        faults: Faults to inject, see Faults
+        seed: Seed of the fault draws, for repeatable runs
+    """
+    app = web.Application(middlewares=[inject_faults])
+    app[payloads_key] = [payloads] if isinstance(payloads, str) else list(payloads)
+    app[fail_ids_key] = set(fail_ids)
+    app[removed_ids_key] = set(removed_ids)
+    app[faults_key] = faults
+    app[limiter_key] = RateLimit(faults.rate_limit) if faults.rate_limit else None
+    app[random_key] = random.Random(seed)
+    app[stats_key] = Counter()
+    app.router.add_get('/rest/v1/core/entry/{pdb_id}', rest_entry)
+    app.router.add_get('/rest/v1/core/polymer_entity/{pdb_id}/{entity_id}', rest_polymer_entity)
+    app.router.add_get('/rest/v1/holdings/current/entry_ids', holdings_current)
+    app.router.add_get('/rest/v1/holdings/removed/entry_ids', holdings_removed)
+    app.router.add_post('/rcsbsearch/v2/query', search)
+    app.router.add_post('/graphql', graphql)
+    app.router.add_get('/emdb/api/entry/{emdb_id}', emdb_entry)
+    app.router.add_get('/empiar/api/emdb_ref/{emdb_id}', empiar_emdb_ref)
+    app.router.add_get('/mock/stats', stats)
+    return app
+
+
+def add_fault_arguments(parser):
+    """Fault injection options, shared with benchmark_pullers.py"""
+    parser.add_argument('--latency', type=float, default=0.0, help="Mean added latency in milliseconds")
+    parser.add_argument('--jitter', type=float, default=0.0, help="Standard deviation of the latency in milliseconds")
+    parser.add_argument('--not-found-rate', type=float, default=0.0, help="Share of requests answered with 404")
+    parser.add_argument('--throttle-rate', type=float, default=0.0, help="Share of requests answered with 429")
+    parser.add_argument('--error-rate', type=float, default=0.0, help="Share of requests answered with 500/502/503")
+    parser.add_argument('--timeout-rate', type=float, default=0.0, help="Share of requests held for --hang-seconds")
+    parser.add_argument('--hang-seconds', type=float, default=no_faults.hang_seconds)
+    parser.add_argument('--rate-limit', type=float, default=None, help="Requests per second before answering 429")
+    parser.add_argument('--retry-after', type=int, default=no_faults.retry_after,
+                        help="Retry-After seconds sent with injected 429 / 503 answers")
+
+
+def faults_from_args(args):
+    return Faults(latency=args.latency / 1000, jitter=args.jitter / 1000, not_found_rate=args.not_found_rate,
+                  throttle_rate=args.throttle_rate, error_rate=args.error_rate, timeout_rate=args.timeout_rate,
+                  hang_seconds=args.hang_seconds, rate_limit=args.rate_limit, retry_after=args.retry_after)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Serve recorded RCSB / EMDB / EMPIAR payloads for offline pulls")
+    parser.add_argument('--payloads', required=True, nargs='+',
+                        help="Directories of recorded response_*.json files, searched in order")
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--fail-ids', default="", help="Comma-separated IDs that answer with HTTP 500")
+    parser.add_argument('--removed-ids', default="", help="Comma-separated IDs listed as withdrawn")
+    parser.add_argument('--seed', type=int, default=None, help="Seed of the fault draws")
+    add_fault_arguments(parser)
+    args = parser.parse_args()
+
+    fail_ids = [i for i in args.fail_ids.split(',') if i]
+    removed_ids = [i for i in args.removed_ids.split(',') if i]
+    web.run_app(make_app(args.payloads, fail_ids, removed_ids, faults_from_args(args), args.seed), port=args.port)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,186 @@
+import json
+import os
+import shutil
+import pandas as pd
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+    pq = None
+
+# Parquet counterpart of the scripts' "append a batch to the CSV" pattern.
+# Columns get the types named in the script's schema (anything not listed is a
+# string), string columns are dictionary encoded, and batches are buffered into
+# row groups of about row_group_size rows. With partition_by set, rows are split
+# into hive-style release_year=YYYY directories, one file per year, which
+# pd.read_parquet / pyarrow.dataset read back as a release_year column.
+default_row_group_size = 100000
+unknown_partition = 'unknown'
+
+
+def arrow_type(type_name):
+    return {
+        'string': pa.string(),
+        'int64': pa.int64(),
+        'float64': pa.float64(),
+        'bool': pa.bool_(),
+        'timestamp': pa.timestamp('ms', tz='UTC'),
+    }[type_name]
+
+
+def to_string(value):
+    if value is None:
+        return None
+    if isinstance(value, str):
+        return value
+    if isinstance(value, (list, dict)):
+        return json.dumps(value)
+    return str(value)
+
+
+def to_number(value, type_name):
+    # The extractors use '' and 'N/A' for missing values; anything that is not
+    # a number becomes null rather than failing the batch
+    if value is None or isinstance(value, bool):
+        return None
+    try:
+        number = float(value)
+    except (TypeError, ValueError):
+        return None
+    if number != number:
+        return None
+    if type_name == 'int64':
+        return int(number) if number.is_integer() else None
+    return number
+
+
+def to_bool(value):
+    if isinstance(value, bool):
+        return value
+    if isinstance(value, str) and value.lower() in ('true', 'false'):
+        return value.lower() == 'true'
+    return None
+
+
+def column_array(values, type_name):
+    """Arrow array of one column, coercing values to type_name"""
+    if type_name == 'timestamp':
+        series = pd.to_datetime(pd.Series(values, dtype=object), utc=True, errors='coerce', format='ISO8601')
+        return pa.Array.from_pandas(series, type=arrow_type(type_name))
+    if type_name in ('int64', 'float64'):
+        values = [to_number(v, type_name) for v in values]
+    elif type_name == 'bool':
+        values = [to_bool(v) for v in values]
+    else:
+        values = [to_string(v) for v in values]
+    return pa.array(values, type=arrow_type(type_name))
+
+
+def release_year(value):
+    text = to_string(value)
+    if text and len(text) >= 4 and text[:4].isdigit():
+        return text[:4]
+    return unknown_partition
+
+
+class ParquetBatchWriter:
+    """
+    Appends row batches to a Parquet file (or a directory of year partitions)
+
+    Args:
+        path: Output file, or output directory when partitioning
+        columns: Column names in output order
+        types: Dictionary of column -> 'string', 'int64', 'float64', 'bool' or
+            'timestamp'; unlisted columns are strings
+        partition_by: Date column whose year partitions the output, or None
+        row_group_size: Rows buffered per row group
+    """
+
+    def __init__(self, path, columns, types=None, partition_by=None, row_group_size=default_row_group_size):
+        if pa is None:
+            raise ImportError("pyarrow is required for Parquet output")
+        self.path = path
+        self.columns = list(columns)
+        self.types = {col: (types or {}).get(col, 'string') for col in self.columns}
+        self.schema = pa.schema([(col, arrow_type(self.types[col])) for col in self.columns])
+        self.partition_by = partition_by
+        self.row_group_size = row_group_size
+        self.writers = {}
+        self.pending = {}
+        self.pending_rows = {}
+        self.row_count = 0
+
+        # Start a fresh output, as the scripts do with their CSVs
+        if os.path.isdir(path):
+            shutil.rmtree(path)
+        elif os.path.exists(path):
+            os.remove(path)
+        if partition_by is not None:
+            os.makedirs(path, exist_ok=True)
+
+    def write_columns(self, data):
+        """Append a batch given as a dictionary of column -> list of values"""
+        lengths = [len(v) for v in data.values()]
+        size = lengths[0] if lengths else 0
+        if size == 0:
+            return
+        arrays = [column_array(data[col], self.types[col]) if col in data else pa.nulls(size, self.schema.field(col).type)
+                  for col in self.columns]
+        table = pa.Table.from_arrays(arrays, schema=self.schema)
+
+        if self.partition_by is None:
+            self.add(None, table)
+        else:
+            years = [release_year(v) for v in data.get(self.partition_by, [None] * size)]
+            for year in sorted(set(years)):
+                mask = pa.array([y == year for y in years])
+                self.add(year, table.filter(mask))
+        self.row_count += size
+
+    def write_rows(self, rows):
+        """Append a batch given as a list of row dictionaries"""
+        self.write_columns({col: [row.get(col) for row in rows] for col in self.columns})
+
+    def write_frame(self, df):
+        self.write_columns({col: df[col].tolist() for col in df.columns})
+
+    def add(self, partition, table):
+        self.pending.setdefault(partition, []).append(table)
+        self.pending_rows[partition] = self.pending_rows.get(partition, 0) + table.num_rows
+        if self.pending_rows[partition] >= self.row_group_size:
+            self.write_pending(partition)
+
+    def write_pending(self, partition):
+        tables = self.pending.pop(partition, [])
+        self.pending_rows.pop(partition, None)
+        if not tables:
+            return
+        writer = self.writers.get(partition)
+        if writer is None:
+            writer = pq.ParquetWriter(self.file_path(partition), self.schema, compression='zstd',
+                                      use_dictionary=[c for c in self.columns if self.types[c] == 'string'])
+            self.writers[partition] = writer
+        writer.write_table(pa.concat_tables(tables), row_group_size=self.row_group_size)
+
+    def file_path(self, partition):
+        if partition is None:
+            return self.path
+        directory = os.path.join(self.path, f"release_year={partition}")
+        os.makedirs(directory, exist_ok=True)
+        return os.path.join(directory, 'part-0.parquet')
+
+    def close(self):
+        """
+        Write the buffered rows and finish every file
+
+        Returns:
+            Number of rows written
+        """
+        for partition in list(self.pending):
+            self.write_pending(partition)
+        for writer in self.writers.values():
+            writer.close()
+        self.writers = {}
+        return self.row_count
@@ -1,103 +1,318 @@
 import os
 import json
+import time
 import pandas as pd
+from collections import deque
 from concurrent.futures import ProcessPoolExecutor
+from catalog import CatalogTable
+from incremental_extract import ExtractionState
+from metrics import RunMetrics
+from parquet_output import ParquetBatchWriter
+from progress import ErrorLog, Progress, error_log_path, get_logger
+from row_accumulator import ColumnarAccumulator
+from record_decoding import RecordDecoder
+from record_store import list_records
 
-# Initialize an empty list to temporarily store rows
-buffer = []
-
-# Set the folder path where the JSON files are located
+# Set the folder path (or record store) where the JSON files are located
 json_folder = '/kellogg/proj/rrh3749/Working_Projects/AlphaFold/data/pdb_entity_json'
 
 csv_output = "/home/zhn1744/AlphaFold/data/pdb_entities_v3.csv"
 failed_output = "/home/zhn1744/AlphaFold/data/failed/pdb_entities_failed_v3.csv"
-cursor_index = 0
 
-# Remove existing output files, if any
-try:
-    os.remove(csv_output)
-except:
-    pass
+# "csv", "parquet" or "both"
+output_format = "csv"
+parquet_output = "/home/zhn1744/AlphaFold/data/pdb_entities_v3.parquet"
+
+# Also load the rows into the SQLite catalog (see catalog.py)
+load_catalog = False
+
+# Only extract files that are new or changed since the last run, keeping the
+# rows of every file in state_output (see incremental_extract.py)
+incremental = False
+state_output = "/home/zhn1744/AlphaFold/data/pdb_entities_v3.state.sqlite"
+
+# Output columns and their Parquet types (columns not listed are strings)
+entity_columns = ['organism', 'expression_system', 'gene_name', 'mutation_count', 'rcsb_id',
+                  'rcsb_polymer_entity_name_pdb', 'pdbx_num_of_molecules', 'uniprot_acc', 'uniprot_ref']
+entity_types = {'mutation_count': 'int64', 'pdbx_num_of_molecules': 'int64'}
+
+# Rows collected before they are written out
+buffer_rows = 5000
+
+# Workers take chunks of files and return one columnar block per chunk instead
+# of one pickled row per file. The chunk size adapts so that each task takes
+# about target_task_seconds; it starts small so results arrive early.
+# batched_workers = False dispatches one file per task, as before.
+batched_workers = True
+initial_chunk_size = 64
+min_chunk_size = 16
+max_chunk_size = 4096
+target_task_seconds = 0.5
+# Chunks in flight per worker, so workers keep going while the parent writes
+tasks_per_worker = 2
+
+# Only decode the fields extract_row reads
+decoder = RecordDecoder('polymer_entity')
+
+# Throttled progress lines (see progress.py)
+logger = get_logger('pdb_entity_extract_v3')
+
+
+# Build the output row for one polymer entity document
+def extract_row(data):
+    rcsb_polymer_entity_align_object = data.get("rcsb_polymer_entity_align", [{}])[0] if len(data.get("rcsb_polymer_entity_align", [])) > 0 else {}
+    uniprot_acc = rcsb_polymer_entity_align_object.get("reference_database_accession", "N/A")
+    uniprot_ref = rcsb_polymer_entity_align_object.get("reference_database_name", "N/A")
+    rcsb_polymer_entity = data.get("rcsb_polymer_entity", {})
+    rcsb_macromolecular_names_combined = rcsb_polymer_entity.get("rcsb_macromolecular_names_combined", ["N/A"])[0]
+    rcsb_id = data.get("rcsb_id", "N/A")
+
+    rcsb_entity_source_organism = data.get("rcsb_entity_source_organism")
+    rcsb_entity_host_organism = data.get("rcsb_entity_host_organism")
+    organism_string = ""
+    expression_string = ""
+    gene_name = ""
+
+    if rcsb_entity_source_organism is not None:
+        for organism_object in rcsb_entity_source_organism:
+            organism_string += organism_object.get("ncbi_scientific_name", "N/A") + "%" + str(organism_object.get("ncbi_taxonomy_id", "0")) + "#"
+            gene_names = organism_object.get("rcsb_gene_name", [])
+            gene_name += "#".join(g.get("value", "N/A") for g in gene_names) + "#"
+    
+    if rcsb_entity_host_organism is not None:
+        for organism_object in rcsb_entity_host_organism:
+            expression_string += organism_object.get("ncbi_scientific_name", "N/A") + "%" + str(organism_object.get("ncbi_taxonomy_id", "0")) + "#"
+
+    entity_poly = data.get("entity_poly", {})
+
+    # Return processed data as a dictionary
+    return {
+        'organism': organism_string,
+        'expression_system': expression_string,
+        'gene_name': gene_name,
+        'mutation_count': entity_poly.get("rcsb_mutation_count"),
+        'rcsb_id': rcsb_id,
+        "rcsb_polymer_entity_name_pdb": rcsb_polymer_entity.get("pdbx_description", "N/A"),
+        "pdbx_num_of_molecules": rcsb_polymer_entity.get("pdbx_number_of_molecules", "N/A"),
+        'uniprot_acc': uniprot_acc,
+        'uniprot_ref': uniprot_ref
+    }
 
-# Get list of JSON file paths
-file_paths = [os.path.join(json_folder, f) for f in os.listdir(json_folder)
-              if f.startswith("response_entry_") and f.endswith(".json")]
-total_files = len(file_paths)
-print(total_files)
 
 # Function to process a single file
-def process_file(file_path):
+def process_file(record):
     try:
-        with open(file_path, "r") as f:
-            data = json.load(f)
-        
-        rcsb_polymer_entity_align_object = data.get("rcsb_polymer_entity_align", [{}])[0] if len(data.get("rcsb_polymer_entity_align", [])) > 0 else {}
-        uniprot_acc = rcsb_polymer_entity_align_object.get("reference_database_accession", "N/A")
-        uniprot_ref = rcsb_polymer_entity_align_object.get("reference_database_name", "N/A")
-        rcsb_polymer_entity = data.get("rcsb_polymer_entity", {})
-        rcsb_macromolecular_names_combined = rcsb_polymer_entity.get("rcsb_macromolecular_names_combined", ["N/A"])[0]
-        rcsb_id = data.get("rcsb_id", "N/A")
-
-        rcsb_entity_source_organism = data.get("rcsb_entity_source_organism")
-        rcsb_entity_host_organism = data.get("rcsb_entity_host_organism")
-        organism_string = ""
-        expression_string = ""
-        gene_name = ""
-
-        if rcsb_entity_source_organism is not None:
-            for organism_object in rcsb_entity_source_organism:
-                organism_string += organism_object.get("ncbi_scientific_name", "N/A") + "%" + str(organism_object.get("ncbi_taxonomy_id", "0")) + "#"
-                gene_names = organism_object.get("rcsb_gene_name", [])
-                gene_name += "#".join(g.get("value", "N/A") for g in gene_names) + "#"
-        
-        if rcsb_entity_host_organism is not None:
-            for organism_object in rcsb_entity_host_organism:
-                expression_string += organism_object.get("ncbi_scientific_name", "N/A") + "%" + str(organism_object.get("ncbi_taxonomy_id", "0")) + "#"
-
-        entity_poly = data.get("entity_poly", {})
-
-        # Return processed data as a dictionary
-        return {
-            'organism': organism_string,
-            'expression_system': expression_string,
-            'gene_name': gene_name,
-            'mutation_count': entity_poly.get("rcsb_mutation_count"),
-            'rcsb_id': rcsb_id,
-            "rcsb_polymer_entity_name_pdb": rcsb_polymer_entity.get("pdbx_description", "N/A"),
-            "pdbx_num_of_molecules": rcsb_polymer_entity.get("pdbx_number_of_molecules", "N/A"),
-            'uniprot_acc': uniprot_acc,
-            'uniprot_ref': uniprot_ref
-        }
+        return extract_row(decoder.load(record))
     except Exception as e:
-        print(f"Error processing {file_path}: {e}")
-        return {"failed_file": os.path.basename(file_path)}
-
-# Process files with concurrent.futures
-failed_filenames = []
-with ProcessPoolExecutor() as executor:
-    for index, result in enumerate(executor.map(process_file, file_paths), start=1):
-        if index % 1000 == 0:
-            print(f"{index} of {total_files} processed")
-        
-        # Check if the result indicates a failure
+        return {"failed_file": record.name, "error": str(e)}
+
+
+def entity_rows(record):
+    """Rows of one file for the incremental state; raises on failure"""
+    return [extract_row(decoder.load(record))]
+
+
+def process_chunk(records):
+    """
+    Process a chunk of files in a worker
+
+    Returns:
+        (column -> values for the extracted rows, (failed file name, error) pairs, seconds taken)
+    """
+    start = time.perf_counter()
+    rows = ColumnarAccumulator(entity_columns, capacity=max(1, len(records)))
+    failed = []
+    for record in records:
+        result = process_file(record)
         if "failed_file" in result:
-            failed_filenames.append(result["failed_file"])
+            failed.append((result["failed_file"], result["error"]))
         else:
-            buffer.append(result)
+            rows.add(result)
+    return rows.to_columns(), failed, time.perf_counter() - start
+
+
+def next_chunk_size(chunk_size, files, seconds):
+    # Move halfway (geometrically) towards the size that would take
+    # target_task_seconds, so one slow or fast chunk does not swing it
+    if files == 0 or seconds <= 0:
+        return chunk_size
+    ideal = target_task_seconds * files / seconds
+    return int(min(max_chunk_size, max(min_chunk_size, (chunk_size * ideal) ** 0.5)))
+
+
+def extract_blocks(executor, records, workers):
+    """
+    Run records through the pool in adaptively sized chunks
+
+    Blocks are yielded in file order, with up to tasks_per_worker chunks per
+    worker queued behind the one being consumed.
+
+    Yields:
+        (column -> values, (failed file name, error) pairs, worker seconds) per chunk
+    """
+    pending = deque()
+    position = 0
+    chunk_size = initial_chunk_size
+    while position < len(records) or pending:
+        while position < len(records) and len(pending) < workers * tasks_per_worker:
+            chunk = records[position:position + chunk_size]
+            pending.append((len(chunk), executor.submit(process_chunk, chunk)))
+            position += len(chunk)
+        files, future = pending.popleft()
+        columns, failed, seconds = future.result()
+        chunk_size = next_chunk_size(chunk_size, files, seconds)
+        yield columns, failed, seconds
+
+
+def extract_per_file(executor, records):
+    """One task per file, the behaviour before batched_workers; same output as extract_blocks, untimed"""
+    for result in executor.map(process_file, records):
+        if "failed_file" in result:
+            yield {col: [] for col in entity_columns}, [(result["failed_file"], result["error"])], None
+        else:
+            yield {col: [result.get(col)] for col in entity_columns}, [], None
+
+
+def write_buffer(blocks, write_csv, parquet_writer, catalog_table=None, metrics=None):
+    """Write a list of column blocks as one batch"""
+    data = {col: [value for block in blocks for value in block[col]] for col in entity_columns}
+    if not data[entity_columns[0]]:
+        return
+    start = time.perf_counter()
+    if write_csv:
+        protein_data = pd.DataFrame(data, columns=entity_columns, dtype=object)
+        protein_data.to_csv(csv_output, mode='a', index=False, header=not os.path.exists(csv_output))
+    if parquet_writer is not None:
+        parquet_writer.write_columns(data)
+    if catalog_table is not None:
+        catalog_table.write_columns(data)
+    if metrics is not None:
+        metrics.observe('flush_seconds', time.perf_counter() - start, table='entity')
+        metrics.count('rows_written_total', len(data[entity_columns[0]]), table='entity')
+
+
+def write_from_state(state, write_csv, parquet_writer, catalog_table=None, metrics=None):
+    """
+    Write the output from every row kept in the incremental state
+
+    Returns:
+        Number of rows written
+    """
+    rows = ColumnarAccumulator(entity_columns, capacity=buffer_rows)
+    written = 0
+    for row in state.rows():
+        rows.add(row)
+        written += 1
+        if rows.full():
+            write_buffer([rows.to_columns()], write_csv, parquet_writer, catalog_table, metrics)
+            rows.clear()
+    write_buffer([rows.to_columns()], write_csv, parquet_writer, catalog_table, metrics)
+    return written
+
+
+def extract_all(records, workers, write_csv, parquet_writer, failed_filenames, catalog_table=None, metrics=None,
+                errors=None):
+    """
+    Extract every record and write the rows in batches of buffer_rows
+
+    Returns:
+        Number of files processed
+    """
+    # Column blocks waiting to be written, and the rows they hold
+    buffer = []
+    buffered_rows = 0
+    processed = 0
+    progress = Progress(len(records), logger)
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        if batched_workers:
+            blocks = extract_blocks(executor, records, workers)
+        else:
+            blocks = extract_per_file(executor, records)
+
+        for columns, failed, seconds in blocks:
+            rows = len(columns[entity_columns[0]])
+            for name, error in failed:
+                failed_filenames.append(name)
+                if errors is not None:
+                    errors.record(name, error)
+            if metrics is not None:
+                # Workers time whole chunks, so each file is recorded at its chunk's mean
+                if seconds is not None and rows + len(failed):
+                    metrics.observe('parse_seconds', seconds / (rows + len(failed)), count=rows + len(failed))
+                metrics.count('files_parsed_total', rows)
+                metrics.count('files_failed_total', len(failed))
+            buffer.append(columns)
+            buffered_rows += rows
+
+            progress.update(rows + len(failed), failed=len(failed))
+            processed += rows + len(failed)
+
+            # Write when the buffer reaches 5000 rows
+            if buffered_rows >= buffer_rows:
+                write_buffer(buffer, write_csv, parquet_writer, catalog_table, metrics)
+                buffer = []
+                buffered_rows = 0
+
+    progress.finish()
+
+    # Write remaining rows in buffer, if any
+    write_buffer(buffer, write_csv, parquet_writer, catalog_table, metrics)
+    return processed
+
+
+def main():
+    # Remove existing output files, if any
+    try:
+        os.remove(csv_output)
+    except:
+        pass
+
+    # Get list of JSON records
+    records = list_records(json_folder, "response_entry_")
+    total_files = len(records)
+    logger.info(f"Total files to process: {total_files}")
+
+    write_csv = output_format in ("csv", "both")
+    parquet_writer = None
+    if output_format in ("parquet", "both"):
+        parquet_writer = ParquetBatchWriter(parquet_output, entity_columns, entity_types)
+    catalog_table = CatalogTable('entity', replace=True) if load_catalog else None
+
+    # Files/s, parse and flush times go to the metrics textfile and summary (see metrics.py)
+    metrics = RunMetrics('pdb_entity_extract_v3')
+    # One JSON line per failed file next to failed_output (see progress.py)
+    errors = ErrorLog(error_log_path(failed_output), logger, stage='extract')
+
+    # Process files with concurrent.futures
+    failed_filenames = []
+    workers = os.cpu_count() or 1
+    start = time.perf_counter()
+    if incremental:
+        # Extract new and changed files only, then rewrite the output from the state
+        state = ExtractionState(state_output)
+        failed_filenames = state.update(records, entity_rows, processes=workers, metrics=metrics,
+                                        errors=errors)
+        write_from_state(state, write_csv, parquet_writer, catalog_table, metrics)
+        state.close()
+        processed = total_files
+    else:
+        processed = extract_all(records, workers, write_csv, parquet_writer, failed_filenames, catalog_table,
+                                metrics, errors)
 
-        # Write to CSV when buffer reaches size of 5000 or at the end
-        if len(buffer) >= 5000 or cursor_index == total_files - 1:
-            protein_data = pd.DataFrame(buffer)
-            protein_data.to_csv(csv_output, mode='a', index=False, header=not os.path.exists(csv_output))
-            buffer.clear()  # Clear the buffer
+    if parquet_writer is not None:
+        parquet_writer.close()
+    if catalog_table is not None:
+        catalog_table.close()
+    elapsed = time.perf_counter() - start
+    logger.info(f"Processed {processed} files in {elapsed:.1f} s ({processed / max(elapsed, 1e-6):.0f} files/s)")
 
-        cursor_index += 1
+    # Write failed filenames to a CSV
+    if failed_filenames:
+        pd.DataFrame({'failed_filenames': failed_filenames}).to_csv(failed_output, index=False)
+    errors.close()
+    metrics.close()
 
-# Write remaining rows in buffer, if any
-if buffer:
-    protein_data = pd.DataFrame(buffer)
-    protein_data.to_csv(csv_output, mode='a', index=False, header=not os.path.exists(csv_output))
 
-# Write failed filenames to a CSV
-if failed_filenames:
-    pd.DataFrame({'failed_filenames': failed_filenames}).to_csv(failed_output, index=False)
+if __name__ == "__main__":
+    main()
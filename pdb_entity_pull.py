@@ -1,89 +1,256 @@
-import requests
-import json
+import argparse
 import pandas as pd
-from datetime import datetime, timedelta
+import json
 import os
-import csv
-import time
+from fetch_engine import run_fetch, append_failed_ids
+from fetch_manifest import OK, FetchManifest
+from incremental_refresh import plan_entity_refresh
+from metrics import RunMetrics
+from progress import ErrorLog, error_log_path, get_logger
+from rcsb_graphql import run_graphql_fetch
+from pdb_entity_extract_v3 import extract_row
+from record_store import RecordStore, is_record_store, reconcile_manifest
+from retry_scheduler import RetryScheduler
+from stream_extract import RowSink
 
 
 output = '/kellogg/proj/rrh3749/Working_Projects/AlphaFold/data/pdb_json_entities'
+entry_json_folder = '/kellogg/proj/rrh3749/Working_Projects/AlphaFold/data/pdb_json_structures'
 pdb_ids = "/home/zhn1744/AlphaFold/data/pdb_ids_v3.csv"
 failed_ids_path = "/home/zhn1744/AlphaFold/data/pdb_entity_pull_failed_ids_v3.csv"
+manifest_path = "/home/zhn1744/AlphaFold/data/fetch_manifest.sqlite"
+source = 'pdb_entity'
+
+# Server the requests go to; --base-url sends them elsewhere, e.g. to a
+# mock_archive_server.py for load tests
+rcsb_base_url = "https://data.rcsb.org"
+
+# Requests in flight and requests started per second against data.rcsb.org
+concurrency = 20
+requests_per_second = 20
+
+# Read polymer_entity_ids from the entry files written by pdb_entry_pull.py.
+# Entries without a local entry file fall back to probing entity numbers.
+use_entry_files = True
+
+# "rest" sends one request per entity, "graphql" sends graphql_batch_size entities per
+# request. GraphQL needs the entity IDs up front, so it only applies to entries with
+# an entry file; the rest are probed over REST. GraphQL records only hold the fields
+# pdb_entity_extract_v3.py reads (see rcsb_graphql.py); v2pdb_async_entities_combined.py
+# needs "rest".
+fetch_mode = "rest"
+graphql_batch_size = 100
+
+# Failed requests are retried within the one pass, up to max_attempts tries per ID,
+# waiting out Retry-After or an exponential backoff in the fetch engine's delay queue
+max_attempts = 6
+
+# Only re-fetch entities of entries that changed since the entities were last pulled
+# (run pdb_entry_pull.py first), revalidating with conditional GETs
+incremental = False
+
+# Append responses to compressed shards in output instead of writing one file per ID
+use_record_store = False
+
+# Turn each entity into a stream_output row as it arrives (same row layout as
+# pdb_entity_extract_v3.py). keep_raw_json = False drops the raw JSON and only writes rows.
+stream_rows = False
+stream_output = "/home/zhn1744/AlphaFold/data/pdb_entities_stream.csv"
+stream_failed_output = "/home/zhn1744/AlphaFold/data/failed/pdb_entities_stream_failed.csv"
+keep_raw_json = True
+
+
+# Run messages and the error log's warnings (see progress.py)
+logger = get_logger('pdb_entity_pull')
+
+def entity_url(pdb_id, entity_id):
+    return f"{rcsb_base_url}/rest/v1/core/polymer_entity/{pdb_id}/{entity_id}"
+
+
+def entity_file_path(pdb_id, entity_id):
+    return os.path.join(output, f'response_entry_{pdb_id}_{entity_id}.json')
+
+
+def job_file_path(pdb_id, entity_id, sink=None):
+    """Where a fetched entity is saved; None when only streamed rows are kept"""
+    if sink is not None and not keep_raw_json:
+        return None
+    return entity_file_path(pdb_id, entity_id)
 
 
-os.makedirs(output, exist_ok=True)
+def record_file_name(record_id):
+    return f'response_entry_{record_id}.json'
 
 
-# Grab all SwissProt IDs from Uniprot
-pdb_ids = pd.read_csv(pdb_ids)
-#pdb_ids = pdb_ids.iloc[:2]
-pdb_ids.reset_index(drop=True, inplace=True)  # Reset index after slicing
-cursor_index = 1
-failed_index = 0
-failed_ids = []
+def split_record_id(record_id):
+    """'4HHB_1' -> ('4HHB', '1'); the entity number is always after the last underscore"""
+    pdb_id, entity_id = record_id.rsplit('_', 1)
+    return pdb_id, entity_id
 
 
-for i, row in pdb_ids.iterrows():
+def read_polymer_entity_ids(pdb_id, entry_store=None):
+    """
+    Look up the polymer entity IDs of an entry from its local entry JSON
+
+    Args:
+        pdb_id: PDB ID
+        entry_store: RecordStore holding the entries, if they are not plain files
+
+    Returns:
+        List of entity ID strings, or None if there is no usable entry file
+    """
+    file_name = f'response_entry_{pdb_id}.json'
+    try:
+        if entry_store is not None:
+            data = json.loads(entry_store.get(file_name))
+        else:
+            with open(os.path.join(entry_json_folder, file_name), "r") as f:
+                data = json.load(f)
+        return data['rcsb_entry_container_identifiers'].get('polymer_entity_ids') or []
+    except Exception:
+        return None
+
+
+def pull_from_entry_files(pdb_ids, manifest, store=None, sink=None, metrics=None, errors=None):
+    """
+    Request every listed polymer entity of every entry in one pass
+
+    Returns:
+        (failed PDB IDs, PDB IDs that have no local entry file)
+    """
+    record_ids = []
+    unlisted = []
+    entry_store = RecordStore(entry_json_folder) if is_record_store(entry_json_folder) else None
+    for pdb_id in pdb_ids:
+        entity_ids = read_polymer_entity_ids(pdb_id, entry_store)
+        if entity_ids is None:
+            unlisted.append(pdb_id)
+            continue
+        for entity_id in entity_ids:
+            record_ids.append(f"{pdb_id}_{entity_id}")
+    if entry_store is not None:
+        entry_store.close()
+
+    logger.info(f"{len(record_ids)} listed entities, {len(unlisted)} entries have no entry file")
+    if store is None and manifest.count(source) == 0:
+        adopted = manifest.import_existing(source, record_ids, lambda i: entity_file_path(*split_record_id(i)))
+        logger.info(f"Adopted {adopted} existing files")
+    manifest.register(source, record_ids)
+
+    # One pass over everything not yet fetched; failures are retried inside it
+    to_process = manifest.pending(source, record_ids)
+    if fetch_mode == "graphql":
+        keep_output = output if sink is None or keep_raw_json else None
+        run_graphql_fetch(to_process, 'polymer_entity', keep_output, batch_size=graphql_batch_size,
+                          concurrency=concurrency, rate=requests_per_second, url=f"{rcsb_base_url}/graphql",
+                          manifest=manifest, source=source, retry=RetryScheduler(max_attempts=max_attempts),
+                          store=store, sink=sink, metrics=metrics, errors=errors)
+    else:
+        # Jobs for one entry sit next to each other in the queue, so they go out together
+        jobs = []
+        for record_id in sorted(to_process):
+            pdb_id, entity_id = split_record_id(record_id)
+            jobs.append((record_id, entity_url(pdb_id, entity_id), job_file_path(pdb_id, entity_id, sink)))
+        run_fetch(jobs, concurrency=concurrency, rate=requests_per_second,
+                  retry=RetryScheduler(max_attempts=max_attempts),
+                  manifest=manifest, source=source, conditional=incremental, store=store, sink=sink,
+                  metrics=metrics, errors=errors)
+
+    failed = sorted(set(split_record_id(i)[0] for i in manifest.not_fetched(source, record_ids)))
+    return failed, unlisted
+
+
+def pull_by_probing(pdb_ids, manifest, store=None, sink=None, metrics=None, errors=None):
+    """
+    Probe entity numbers in rounds: round n requests entity n of every entry that
+    still answered in round n - 1, so all entries are pulled concurrently. Entities
+    the manifest already has as fetched or missing are not requested again.
+
+    Returns:
+        List of failed PDB IDs
+    """
+    failed = []
+    remaining = list(pdb_ids)
     entity_id = 0
-    retry_count = 0
-    working = True
-    print(f"Pull {i} of {len(pdb_ids)}")
-    pdb_id = row["pdb_id"]    
-    # Wait time ensures compliance with API rate limit
-    wait_time = 0.05
-    last_request_time = datetime.now()
-
-    # Start the request
-    #start_time = datetime.now()
-    #print(f"Request started at: {start_time}")
-    while working == True:
+    while remaining:
         entity_id += 1
-        URL = f"https://data.rcsb.org/rest/v1/core/polymer_entity/{pdb_id}/{entity_id}"
-        
-        while True:
-            try:
-                response = requests.get(URL)
-                response.raise_for_status()  # Raise an error for bad status codes
-                break  # Break out of the loop since we got a successful response
-            except:
-                retry_count +=1
-                # If error code is 404, there are no more entries for this PDB ID
-                if response.status_code == 404 & entity_id == 1:
-                    print("HTTP Error 404: Resource not found")
-                    working = False
-                    failed_index += 1
-                    print(f"Failed. Failed count is now {failed_index}")
-                    failed_ids.append(pdb_id)
-                    break  # Break out of the loop since the resource is not found
-                else:
-                    # If error code is not 404, there is likely a connection error
-                    if retry_count == 0:
-                        pass # Try the connection one msore time
-                    else:
-                        working = False
-                        break
-
-
-        if response.status_code != 404:
-            print(URL)
-            # Define the path to save the file, incorporating the output directory
-            file_path = os.path.join(output, f'response_entry_{pdb_id}_{entity_id}.json')
-            # Save the response as JSON
-            with open(file_path, 'wb') as f:
-                f.write(response.content)
-
-
-    # Calculate the time to wait, ensuring at least `wait_time` seconds have passed since the last request
-    time_elapsed = datetime.now() - last_request_time
-    if time_elapsed < timedelta(seconds=wait_time):
-        time_to_wait = (timedelta(seconds=wait_time) - time_elapsed).total_seconds()
-        time.sleep(time_to_wait)
-
-if failed_ids:
-    failed_data = pd.DataFrame(data={'failed_ids': failed_ids})
-    failed_data.to_csv(failed_ids_path, mode='a', index=False, header=not os.path.exists(failed_ids_path))
+        record_ids = [f"{pdb_id}_{entity_id}" for pdb_id in remaining]
+        manifest.register(source, record_ids)
+        # Entities finished in an earlier run are not requested again
+        to_process = set(manifest.pending(source, record_ids))
+        jobs = [(record_id, entity_url(pdb_id, entity_id), job_file_path(pdb_id, entity_id, sink))
+                for record_id, pdb_id in zip(record_ids, remaining) if record_id in to_process]
+
+        logger.info(f"Pulling entity {entity_id} for {len(jobs)} entries, "
+                    f"{len(record_ids) - len(jobs)} already fetched")
+        results = {}
+        if jobs:
+            results = run_fetch(jobs, concurrency=concurrency, rate=requests_per_second,
+                                retry=RetryScheduler(max_attempts=max_attempts),
+                                manifest=manifest, source=source, conditional=incremental, store=store,
+                                sink=sink, metrics=metrics, errors=errors)
+        # Skipped entities answer as they did last time: fetched, or not in the archive
+        fetched = set(manifest.ids(source, OK))
+
+        remaining = []
+        for record_id in record_ids:
+            status = results.get(record_id, 200 if record_id in fetched else 404)
+            pdb_id = split_record_id(record_id)[0]
+            if status in (200, 304):
+                remaining.append(pdb_id)
+            elif status == 404 and entity_id > 1:
+                # If error code is 404, there are no more entities for this PDB ID
+                continue
+            else:
+                # Either the entry has no polymer entities or the connection failed
+                failed.append(pdb_id)
+    return failed
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Download RCSB polymer entity JSON")
+    parser.add_argument('--base-url', default=None,
+                        help="Send every request to this server, e.g. http://localhost:8080 for mock_archive_server.py")
+    args = parser.parse_args()
+    if args.base_url:
+        rcsb_base_url = args.base_url.rstrip('/')
+    metrics = RunMetrics('pdb_entity_pull')
+    # Requests that raised and records that failed to stream, one JSON line each
+    errors = ErrorLog(error_log_path(failed_ids_path), logger, stage='fetch')
+
+    os.makedirs(output, exist_ok=True)
 
+    # Grab all PDB IDs
+    pdb_ids = pd.read_csv(pdb_ids)
+    #pdb_ids = pdb_ids.iloc[:2]
+    pdb_ids.reset_index(drop=True, inplace=True)  # Reset index after slicing
+    pdb_ids = list(pdb_ids["pdb_id"])
 
+    sink = None
+    if stream_rows:
+        sink = RowSink(extract_row, stream_output, stream_failed_output, metrics=metrics, errors=errors)
 
+    manifest = FetchManifest(manifest_path)
+    store = RecordStore(output) if use_record_store and (keep_raw_json or sink is None) else None
+    if store is not None:
+        logger.info(f"Re-queued {reconcile_manifest(store, manifest, source, record_file_name)} IDs missing from the store")
+    if incremental:
+        plan_entity_refresh(manifest, 'pdb_entry', source)
+    failed_ids = []
+    if use_entry_files:
+        failed_ids, unlisted = pull_from_entry_files(pdb_ids, manifest, store, sink, metrics, errors)
+        if unlisted:
+            failed_ids += pull_by_probing(unlisted, manifest, store, sink, metrics, errors)
+    else:
+        failed_ids = pull_by_probing(pdb_ids, manifest, store, sink, metrics, errors)
+    if store is not None:
+        store.close()
+    if sink is not None:
+        logger.info(f"Streamed {sink.close()} rows to {stream_output}")
+    manifest.report(source)
+    manifest.close()
 
+    logger.info(f"Failed count is {len(failed_ids)}")
+    append_failed_ids(failed_ids, failed_ids_path)
+    errors.close()
+    metrics.close()
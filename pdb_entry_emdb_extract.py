@@ -1,76 +1,166 @@
 import os
 import json
+import time
 import pandas as pd
 from concurrent.futures import ProcessPoolExecutor
 from functools import partial
+from catalog import CatalogTable
+from incremental_extract import ExtractionState
+from metrics import RunMetrics
+from parquet_output import ParquetBatchWriter
+from progress import ErrorLog, Progress, error_log_path, get_logger
+from record_decoding import RecordDecoder
+from record_store import list_records
 
 # Initialize paths
 json_folder = '/kellogg/proj/rrh3749/Working_Projects/AlphaFold/data/pdb_entry_json'
 emdb_output = "/home/zhn1744/AlphaFold/data/pdb_entries_emdb_ids.csv"
 failed_output = "/home/zhn1744/AlphaFold/data/failed/emdb_entries_failed.csv"
 
+# "csv", "parquet" or "both"
+output_format = "csv"
+parquet_output = "/home/zhn1744/AlphaFold/data/pdb_entries_emdb_ids.parquet"
+# Write the Parquet output as release_year=YYYY directories instead of one file
+partition_by_release_year = False
+
+# Also load the rows, and the PDB <-> EMDB links, into the SQLite catalog (see catalog.py)
+load_catalog = False
+
+# Only extract files that are new or changed since the last run, keeping the
+# rows of every file in state_output (see incremental_extract.py)
+incremental = False
+state_output = "/home/zhn1744/AlphaFold/data/pdb_entries_emdb_ids.state.sqlite"
+
+# Output columns and their Parquet types (columns not listed are strings)
+emdb_columns = ['pdb_id', 'emdb_ids', 'deposition_date', 'release_date', 'resolution', 'num_particles']
+emdb_types = {'deposition_date': 'timestamp', 'release_date': 'timestamp',
+              'resolution': 'float64', 'num_particles': 'int64'}
+
+# Only decode the identifiers, dates and EM reconstruction
+decoder = RecordDecoder('entry_emdb')
+
 # Clean up previous output
 try:
     os.remove(emdb_output)
 except:
     pass
 
-def process_batch(file_paths):
+def extract_emdb_row(data):
+    pdb_id = data['rcsb_entry_container_identifiers']['entry_id']
+    deposition_date = data['pdbx_database_status']['recvd_initial_deposition_date']
+    release_date = data['rcsb_accession_info']['initial_release_date']
+    emdb_ids = data['rcsb_entry_container_identifiers'].get('emdb_ids', [])
+    
+    resolution = None
+    num_particles = None
+    if 'em3d_reconstruction' in data:
+        em_recon = data['em3d_reconstruction'][0]
+        resolution = em_recon.get('resolution')
+        num_particles = em_recon.get('num_particles')
+    
+    return {
+        'pdb_id': pdb_id,
+        'emdb_ids': ','.join(emdb_ids) if emdb_ids else None,
+        'deposition_date': deposition_date,
+        'release_date': release_date,
+        'resolution': resolution,
+        'num_particles': num_particles
+    }
+
+def emdb_rows(record):
+    """Rows of one file for the incremental state; raises on failure"""
+    return [extract_emdb_row(decoder.load(record))]
+
+def process_batch(batch):
+    start = time.perf_counter()
     records = []
     failed = []
     
-    for file_path in file_paths:
+    for record in batch:
         try:
-            with open(file_path, "r") as f:
-                data = json.load(f)
-            
-            pdb_id = data['rcsb_entry_container_identifiers']['entry_id']
-            deposition_date = data['pdbx_database_status']['recvd_initial_deposition_date']
-            release_date = data['rcsb_accession_info']['initial_release_date']
-            emdb_ids = data['rcsb_entry_container_identifiers'].get('emdb_ids', [])
-            
-            resolution = None
-            num_particles = None
-            if 'em3d_reconstruction' in data:
-                em_recon = data['em3d_reconstruction'][0]
-                resolution = em_recon.get('resolution')
-                num_particles = em_recon.get('num_particles')
-            
-            records.append({
-                'pdb_id': pdb_id,
-                'emdb_ids': ','.join(emdb_ids) if emdb_ids else None,
-                'deposition_date': deposition_date,
-                'release_date': release_date,
-                'resolution': resolution,
-                'num_particles': num_particles
-            })
-            
+            records.append(extract_emdb_row(decoder.load(record)))
         except Exception as e:
-            failed.append(os.path.basename(file_path))
+            failed.append((record.name, str(e)))
     
-    return records, failed
+    return records, failed, time.perf_counter() - start
 
-# Get list of JSON files
-file_paths = [os.path.join(json_folder, f) for f in os.listdir(json_folder)
-              if f.startswith("response_entry_") and f.endswith(".json")]
-total_files = len(file_paths)
-print(f"Processing {total_files} files")
+def write_rows(batch_records, parquet_writer, catalog_table=None):
+    with metrics.timer('flush_seconds', table='entry_emdb'):
+        write_batch(batch_records, parquet_writer, catalog_table)
+    metrics.count('rows_written_total', len(batch_records), table='entry_emdb')
+
+def write_batch(batch_records, parquet_writer, catalog_table=None):
+    if batch_records and output_format in ("csv", "both"):
+        df = pd.DataFrame(batch_records)
+        df.to_csv(emdb_output, mode='a', index=False, header=not os.path.exists(emdb_output))
+    if batch_records and parquet_writer is not None:
+        parquet_writer.write_rows(batch_records)
+    if batch_records and catalog_table is not None:
+        catalog_table.write_rows(batch_records)
+
+# Throttled progress lines and run messages (see progress.py)
+logger = get_logger('pdb_entry_emdb_extract')
+
+# Get list of JSON records (plain directory or record store)
+file_records = list_records(json_folder, "response_entry_")
+total_files = len(file_records)
+logger.info(f"Processing {total_files} files")
 
 # Split files into batches
 batch_size = 1000
-batches = [file_paths[i:i + batch_size] for i in range(0, len(file_paths), batch_size)]
+batches = [file_records[i:i + batch_size] for i in range(0, len(file_records), batch_size)]
+
+parquet_writer = None
+if output_format in ("parquet", "both"):
+    parquet_writer = ParquetBatchWriter(parquet_output, emdb_columns, emdb_types,
+                                        'release_date' if partition_by_release_year else None)
+
+catalog_table = CatalogTable('entry_emdb', replace=True) if load_catalog else None
+
+# Files/s, parse and flush times go to the metrics textfile and summary (see metrics.py)
+metrics = RunMetrics('pdb_entry_emdb_extract')
+
+# One JSON line per failed file next to failed_output (see progress.py)
+errors = ErrorLog(error_log_path(failed_output), logger, stage='extract')
 
 failed_filenames = []
-with ProcessPoolExecutor() as executor:
-    for i, (batch_records, batch_failed) in enumerate(executor.map(process_batch, batches), 1):
-        if batch_records:
-            df = pd.DataFrame(batch_records)
-            df.to_csv(emdb_output, mode='a', index=False, header=not os.path.exists(emdb_output))
-        
-        failed_filenames.extend(batch_failed)
-        print(f"Processed batch {i} of {len(batches)}")
+if incremental:
+    # Extract new and changed files only, then rewrite the output from the state
+    state = ExtractionState(state_output)
+    failed_filenames = state.update(file_records, emdb_rows, metrics=metrics, errors=errors)
+    batch_records = []
+    for row in state.rows():
+        batch_records.append(row)
+        if len(batch_records) >= batch_size:
+            write_rows(batch_records, parquet_writer, catalog_table)
+            batch_records = []
+    write_rows(batch_records, parquet_writer, catalog_table)
+    state.close()
+else:
+    progress = Progress(total_files, logger)
+    with ProcessPoolExecutor() as executor:
+        for batch_records, batch_failed, seconds in executor.map(process_batch, batches):
+            # Workers time whole batches, so each file is recorded at its batch's mean
+            batch_files = len(batch_records) + len(batch_failed)
+            if batch_files:
+                metrics.observe('parse_seconds', seconds / batch_files, count=batch_files)
+            metrics.count('files_parsed_total', len(batch_records))
+            metrics.count('files_failed_total', len(batch_failed))
+            write_rows(batch_records, parquet_writer, catalog_table)
+            for name, error in batch_failed:
+                errors.record(name, error)
+                failed_filenames.append(name)
+            progress.update(batch_files, failed=len(batch_failed))
+    progress.finish()
+
+if parquet_writer is not None:
+    parquet_writer.close()
+if catalog_table is not None:
+    catalog_table.close()
 
 # Write failed files
 if failed_filenames:
     pd.DataFrame({'failed_filenames': failed_filenames}).to_csv(failed_output, index=False)
-    print(f"Failed to process {len(failed_filenames)} files")
\ No newline at end of file
+    logger.warning(f"Failed to process {len(failed_filenames)} files")
+errors.close()
+metrics.close()
\ No newline at end of file
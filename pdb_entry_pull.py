@@ -1,70 +1,136 @@
-import requests
-import json
+import argparse
 import pandas as pd
-from datetime import datetime, timedelta
 import os
-import csv
-import time
+from fetch_engine import run_fetch, append_failed_ids
+from fetch_manifest import FetchManifest
+from incremental_refresh import plan_pdb_entry_refresh
+from metrics import RunMetrics
+from progress import ErrorLog, error_log_path, get_logger
+from rcsb_graphql import run_graphql_fetch
+from record_store import RecordStore, reconcile_manifest
+from retry_scheduler import RetryScheduler
+from stream_extract import RowSink
+from v2pdb_structures_combined import extract_entry
 
 
 output = '/kellogg/proj/rrh3749/Working_Projects/AlphaFold/data/pdb_json_structures'
 pdb_ids = "/home/zhn1744/AlphaFold/data/pdb_ids_v3.csv"
 failed_ids_path = "/home/zhn1744/AlphaFold/data/pdb_pull_failed_ids_v3.csv"
-
-
-os.makedirs(output, exist_ok=True)
-
-
-# Grab all SwissProt IDs from Uniprot
-pdb_ids = pd.read_csv(pdb_ids)
-#pdb_ids = pdb_ids.iloc[:1]
-pdb_ids.reset_index(drop=True, inplace=True)  # Reset index after slicing
-cursor_index = 1
-failed_index = 0
-failed_ids = []
-
-
-for i, row in pdb_ids.iterrows():
-    print(f"Pull {i} of {len(pdb_ids)}")
-    pdb_id = row["pdb_id"]
-    URL = "https://data.rcsb.org/rest/v1/core/entry/" + pdb_id
-    
-    # Wait time ensures compliance with API rate limit
-    wait_time = 0.05
-    last_request_time = datetime.now()
-
-    # Start the request
-    print(URL)
-    #start_time = datetime.now()
-    #print(f"Request started at: {start_time}")
-    try:
-        response = requests.get(URL)
-        #mid_time = datetime.now()
-        #print(f"Request middle at: {mid_time}")
-        # Define the path to save the file, incorporating the output directory
-        file_path = os.path.join(output, f'response_entry_{pdb_id}.json')
-        # Save the response as JSON
-        with open(file_path, 'wb') as f:
-            f.write(response.content)
-        #end_time = datetime.now()
-        #print(f"Request ended at: {end_time}")
-
-    except:
-        failed_index += 1
-        print(f"Failed. Failed count is now {failed_index}")
-        failed_ids.append(pdb_id)
-
-
-    # Calculate the time to wait, ensuring at least `wait_time` seconds have passed since the last request
-    time_elapsed = datetime.now() - last_request_time
-    if time_elapsed < timedelta(seconds=wait_time):
-        time_to_wait = (timedelta(seconds=wait_time) - time_elapsed).total_seconds()
-        time.sleep(time_to_wait)
-
-if failed_ids:
-    failed_data = pd.DataFrame(data={'failed_ids': failed_ids})
-    failed_data.to_csv(failed_ids_path, mode='a', index=False, header=not os.path.exists(failed_ids_path))
-
-
-
-
+manifest_path = "/home/zhn1744/AlphaFold/data/fetch_manifest.sqlite"
+source = 'pdb_entry'
+
+# Servers the requests go to; --base-url sends them all to one server instead,
+# e.g. a mock_archive_server.py for load tests
+rcsb_base_url = "https://data.rcsb.org"
+rcsb_search_base_url = "https://search.rcsb.org"
+
+# Requests in flight and requests started per second against data.rcsb.org
+concurrency = 20
+requests_per_second = 20
+
+# "rest" sends one request per entry, "graphql" sends graphql_batch_size entries per request.
+# GraphQL records only hold the fields pdb_entry_extract_v2.py and pdb_entry_emdb_extract.py
+# read (see rcsb_graphql.py); v2pdb_structures_combined.py, and so stream_rows, need "rest".
+fetch_mode = "rest"
+graphql_batch_size = 100
+
+# Failed requests are retried within the one pass, up to max_attempts tries per ID,
+# waiting out Retry-After or an exponential backoff in the fetch engine's delay queue
+max_attempts = 6
+
+# Only fetch entries that are new or revised since the last pull (RCSB holdings and
+# revision dates), revalidating with conditional GETs; withdrawn entries are marked obsolete
+incremental = False
+
+# Append responses to compressed shards in output instead of writing one file per ID
+use_record_store = False
+
+# Flatten each entry into a stream_output row as it arrives (same row layout as
+# v2pdb_structures_combined.py). keep_raw_json = False drops the raw JSON and only writes rows.
+stream_rows = False
+stream_output = "/home/zhn1744/AlphaFold/data/pdb/pdb_structures_stream.csv"
+stream_failed_output = "/home/zhn1744/AlphaFold/data/failed/pdb_structures_stream_failed.csv"
+keep_raw_json = True
+
+
+# Run messages and the error log's warnings (see progress.py)
+logger = get_logger('pdb_entry_pull')
+
+def entry_url(pdb_id):
+    return f"{rcsb_base_url}/rest/v1/core/entry/{pdb_id}"
+
+
+def entry_file_name(pdb_id):
+    return f'response_entry_{pdb_id}.json'
+
+
+def entry_file_path(pdb_id):
+    return os.path.join(output, entry_file_name(pdb_id))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Download RCSB entry JSON")
+    parser.add_argument('--base-url', default=None,
+                        help="Send every request to this server, e.g. http://localhost:8080 for mock_archive_server.py")
+    args = parser.parse_args()
+    if args.base_url:
+        rcsb_base_url = rcsb_search_base_url = args.base_url.rstrip('/')
+    if fetch_mode == "graphql" and stream_rows:
+        raise ValueError("stream_rows flattens whole entry documents (v2pdb_structures_combined.py); "
+                         "GraphQL records only hold the selected fields, use fetch_mode = \"rest\"")
+    metrics = RunMetrics('pdb_entry_pull')
+    # Requests that raised and records that failed to stream, one JSON line each
+    errors = ErrorLog(error_log_path(failed_ids_path), logger, stage='fetch')
+
+    os.makedirs(output, exist_ok=True)
+
+    # Grab all PDB IDs
+    pdb_ids = pd.read_csv(pdb_ids)
+    #pdb_ids = pdb_ids.iloc[:1]
+    pdb_ids.reset_index(drop=True, inplace=True)  # Reset index after slicing
+    pdb_ids = list(pdb_ids["pdb_id"])
+
+    # Without streamed rows the raw JSON is the only output, so it is always kept
+    keep_raw = keep_raw_json or not stream_rows
+    sink = None
+    if stream_rows:
+        sink = RowSink(extract_entry, stream_output, stream_failed_output, metrics=metrics, errors=errors)
+
+    manifest = FetchManifest(manifest_path)
+    store = RecordStore(output) if use_record_store and keep_raw else None
+    if store is not None:
+        logger.info(f"Re-queued {reconcile_manifest(store, manifest, source, entry_file_name)} IDs missing from the store")
+    elif manifest.count(source) == 0:
+        logger.info(f"Adopted {manifest.import_existing(source, pdb_ids, entry_file_path)} existing files")
+    manifest.register(source, pdb_ids)
+    if incremental:
+        pdb_ids = plan_pdb_entry_refresh(manifest, source, pdb_ids, f"{rcsb_base_url}/rest/v1/holdings",
+                                         f"{rcsb_search_base_url}/rcsbsearch/v2/query")
+    manifest.report(source)
+
+    # One pass over everything not yet fetched; failures are retried inside it
+    to_process = manifest.pending(source, pdb_ids)
+    retry = RetryScheduler(max_attempts=max_attempts)
+    if fetch_mode == "graphql":
+        run_graphql_fetch(to_process, 'entry', output if keep_raw else None, batch_size=graphql_batch_size,
+                          concurrency=concurrency, rate=requests_per_second, url=f"{rcsb_base_url}/graphql",
+                          manifest=manifest, source=source, retry=retry, store=store, sink=sink, metrics=metrics,
+                          errors=errors)
+    else:
+        jobs = [(pdb_id, entry_url(pdb_id), entry_file_path(pdb_id) if keep_raw else None)
+                for pdb_id in to_process]
+        run_fetch(jobs, concurrency=concurrency, rate=requests_per_second, retry=retry,
+                  manifest=manifest, source=source, conditional=incremental, store=store, sink=sink,
+                  metrics=metrics, errors=errors)
+    manifest.report(source)
+
+    if store is not None:
+        store.close()
+    if sink is not None:
+        logger.info(f"Streamed {sink.close()} rows to {stream_output}")
+    failed_ids = manifest.not_fetched(source, pdb_ids)
+    manifest.close()
+    logger.info(f"Failed count is {len(failed_ids)}")
+    append_failed_ids(failed_ids, failed_ids_path)
+    errors.close()
+    metrics.close()
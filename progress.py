@@ -0,0 +1,136 @@
+import json
+import logging
+import os
+import sys
+import time
+
+# Progress and log output of the pullers and extractors. Hot loops call
+# Progress.update() for every item, which only prints when progress_interval seconds
+# have passed, so a 200k-file run writes a few dozen progress lines instead of a line
+# per file. Per-item messages are logged at DEBUG (LOG_LEVEL=DEBUG to see them), and
+# per-file errors go to a JSON-lines error log next to the failed-IDs CSV, with only
+# the first max_logged_errors echoed to stdout.
+log_level = os.environ.get('LOG_LEVEL', 'INFO').upper()
+log_format = '%(asctime)s %(levelname)s %(name)s: %(message)s'
+progress_interval = 15
+max_logged_errors = 20
+
+
+def get_logger(name):
+    """Logger writing to stdout at log_level, configured on first use"""
+    if not logging.getLogger().handlers:
+        logging.basicConfig(level=log_level, format=log_format, datefmt='%Y-%m-%d %H:%M:%S', stream=sys.stdout)
+    return logging.getLogger(name)
+
+
+def error_log_path(failed_path):
+    """Error log kept next to a failed-IDs CSV: failed.csv -> failed.errors.jsonl"""
+    return os.path.splitext(failed_path)[0] + '.errors.jsonl'
+
+
+def format_duration(seconds):
+    seconds = int(seconds)
+    return f"{seconds // 3600}:{seconds // 60 % 60:02d}:{seconds % 60:02d}"
+
+
+class Progress:
+    """
+    Throttled progress lines with rate and ETA
+
+    Args:
+        total: Number of items expected, or None if unknown
+        logger: Logger the lines go to (INFO)
+        label: What is being counted, e.g. 'files'
+        interval: Seconds between lines, progress_interval if None
+    """
+
+    def __init__(self, total, logger, label='files', interval=None):
+        self.total = total
+        self.logger = logger
+        self.label = label
+        self.interval = interval if interval is not None else progress_interval
+        self.done = 0
+        self.counts = {}
+        self.start = time.monotonic()
+        self.next_report = self.start + self.interval
+
+    def update(self, n=1, **counts):
+        """Count n items done, plus named counts (failed=1, retrying=...) shown on the line"""
+        self.done += n
+        for name, value in counts.items():
+            self.counts[name] = self.counts.get(name, 0) + value
+        if time.monotonic() >= self.next_report:
+            self.report()
+
+    def set(self, **counts):
+        """Replace named counts that are levels rather than totals, e.g. queue lengths"""
+        self.counts.update(counts)
+
+    def line(self):
+        elapsed = time.monotonic() - self.start
+        rate = self.done / elapsed if elapsed > 0 else 0
+        text = f"{self.done}"
+        if self.total:
+            text += f" of {self.total} {self.label} ({100 * self.done / self.total:.1f}%)"
+        else:
+            text += f" {self.label}"
+        text += f", {rate:.0f}/s"
+        if self.total and rate > 0 and self.done < self.total:
+            text += f", ETA {format_duration((self.total - self.done) / rate)}"
+        extra = ', '.join(f"{value} {name}" for name, value in self.counts.items() if value)
+        return text + (f", {extra}" if extra else '')
+
+    def report(self):
+        self.logger.info(self.line())
+        self.next_report = time.monotonic() + self.interval
+
+    def finish(self):
+        """Log the final line with the elapsed time"""
+        self.logger.info(f"Done in {format_duration(time.monotonic() - self.start)}: {self.line()}")
+
+
+class ErrorLog:
+    """
+    Per-item errors as JSON lines: time, stage, name, error type and message
+
+    The file is only created once an error is recorded, and is appended to, so
+    resumed runs add to it. The first max_logged errors are also logged as
+    warnings; the rest are only counted on stdout.
+
+    Args:
+        path: JSON-lines file, or None to only log
+        logger: Logger for the warnings
+        stage: Default stage written with each error, e.g. 'parse' or 'fetch'
+        max_logged: Errors echoed to the logger, max_logged_errors if None
+    """
+
+    def __init__(self, path, logger, stage=None, max_logged=None):
+        self.path = path
+        self.logger = logger
+        self.stage = stage
+        self.max_logged = max_logged if max_logged is not None else max_logged_errors
+        self.count = 0
+        self.file = None
+
+    def record(self, name, error, stage=None):
+        self.count += 1
+        stage = stage or self.stage
+        error_type = type(error).__name__ if isinstance(error, BaseException) else None
+        if self.count <= self.max_logged:
+            self.logger.warning(f"{stage or 'error'} {name}: {error}")
+            if self.count == self.max_logged:
+                self.logger.warning(f"Further errors are only written to {self.path}" if self.path
+                                    else "Further errors are only counted")
+        if self.path is not None:
+            if self.file is None:
+                self.file = open(self.path, 'a')
+            self.file.write(json.dumps({'time': time.strftime('%Y-%m-%dT%H:%M:%S'), 'stage': stage,
+                                        'name': str(name), 'type': error_type, 'error': str(error)}) + '\n')
+            self.file.flush()
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+        if self.count:
+            self.logger.info(f"{self.count} errors" + (f" written to {self.path}" if self.path else ''))
@@ -0,0 +1,270 @@
+import aiohttp
+import asyncio
+import json
+import os
+import time
+from fetch_engine import TokenBucket, default_concurrency, default_rate, default_timeout, record_request
+from metrics import url_host
+from progress import ErrorLog, Progress, get_logger
+from retry_scheduler import THROTTLED, TRANSIENT, DelayQueue, RetryScheduler, classify, parse_retry_after
+
+graphql_url = "https://data.rcsb.org/graphql"
+
+logger = get_logger('rcsb_graphql')
+
+# Number of IDs sent in one GraphQL request
+default_batch_size = 100
+
+# GraphQL only returns the fields that are asked for. The selections cover the
+# fields read by pdb_entry_extract_v2.py, pdb_entry_emdb_extract.py and (for
+# entities) pdb_entity_extract_v3.py, plus the polymer_entity_ids that
+# pdb_entity_pull.py fans out from. GraphQL spells fields the mmCIF way
+# (ls_R_factor_R_free, pdbx_database_id_PubMed) where the REST documents use snake
+# case (ls_rfactor_rfree, pdbx_database_id_pub_med), so those fields are aliased to
+# their REST names and the extractors read the records like REST files.
+# v2pdb_structures_combined.py and v2pdb_async_entities_combined.py flatten every
+# key of a document, so they would get fewer columns from these records: feed them
+# REST pulls only.
+citation_fields = """
+        country id journal_abbrev journal_id_astm: journal_id_ASTM journal_id_csd: journal_id_CSD
+        journal_id_issn: journal_id_ISSN journal_volume page_first page_last
+        pdbx_database_id_doi: pdbx_database_id_DOI pdbx_database_id_pub_med: pdbx_database_id_PubMed
+        rcsb_authors rcsb_journal_abbrev title year
+"""
+
+entry_fields = f"""
+    rcsb_id
+    rcsb_entry_container_identifiers {{ entry_id emdb_ids polymer_entity_ids entity_ids }}
+    pdbx_database_status {{ recvd_initial_deposition_date status_code }}
+    rcsb_accession_info {{ deposit_date initial_release_date revision_date major_revision minor_revision status_code }}
+    struct {{ title pdbx_descriptor }}
+    struct_keywords {{ pdbx_keywords text }}
+    exptl {{ method }}
+    em3d_reconstruction {{ resolution resolution_method num_particles symmetry_type }}
+    audit_author {{ name pdbx_ordinal identifier_orcid: identifier_ORCID }}
+    pdbx_database_related {{ db_id db_name content_type details }}
+    rcsb_primary_citation {{ {citation_fields} }}
+    citation {{ {citation_fields} }}
+    refine {{
+        ls_rfactor_rfree: ls_R_factor_R_free ls_rfactor_rwork: ls_R_factor_R_work
+        ls_rfactor_obs: ls_R_factor_obs ls_dres_high: ls_d_res_high ls_dres_low: ls_d_res_low
+        ls_number_reflns_rfree: ls_number_reflns_R_free ls_number_reflns_obs
+        ls_percent_reflns_rfree: ls_percent_reflns_R_free ls_percent_reflns_obs
+        pdbx_rfree_selection_details: pdbx_R_Free_selection_details
+        pdbx_data_cutoff_high_rms_abs_f: pdbx_data_cutoff_high_rms_absF pdbx_ls_cross_valid_method
+        pdbx_ls_sigma_f: pdbx_ls_sigma_F pdbx_method_to_determine_struct pdbx_refine_id
+        solvent_model_details solvent_model_param_bsol solvent_model_param_ksol biso_mean: B_iso_mean
+    }}
+    rcsb_entry_info {{
+        assembly_count branched_entity_count cis_peptide_count deposited_atom_count
+        deposited_deuterated_water_count deposited_hydrogen_atom_count deposited_model_count
+        deposited_modeled_polymer_monomer_count deposited_nonpolymer_entity_instance_count
+        deposited_polymer_entity_instance_count deposited_polymer_monomer_count
+        deposited_solvent_atom_count deposited_unmodeled_polymer_monomer_count
+        diffrn_radiation_wavelength_maximum diffrn_radiation_wavelength_minimum disulfide_bond_count
+        entity_count experimental_method experimental_method_count inter_mol_covalent_bond_count
+        inter_mol_metalic_bond_count molecular_weight na_polymer_entity_types
+        nonpolymer_bound_components nonpolymer_entity_count nonpolymer_molecular_weight_maximum
+        nonpolymer_molecular_weight_minimum polymer_composition polymer_entity_count
+        polymer_entity_count_dna: polymer_entity_count_DNA polymer_entity_count_rna: polymer_entity_count_RNA
+        polymer_entity_count_nucleic_acid polymer_entity_count_nucleic_acid_hybrid
+        polymer_entity_count_protein polymer_entity_taxonomy_count polymer_molecular_weight_maximum
+        polymer_molecular_weight_minimum polymer_monomer_count_maximum polymer_monomer_count_minimum
+        resolution_combined selected_polymer_entity_types software_programs_combined
+        solvent_entity_count structure_determination_methodology
+        structure_determination_methodology_priority
+        diffrn_resolution_high {{ provenance_source value }}
+    }}
+"""
+
+polymer_entity_fields = """
+    rcsb_id
+    rcsb_polymer_entity_container_identifiers { entry_id entity_id asym_ids auth_asym_ids uniprot_ids }
+    rcsb_polymer_entity {
+        pdbx_description pdbx_number_of_molecules formula_weight
+        rcsb_macromolecular_names_combined { name provenance_code provenance_source }
+    }
+    rcsb_polymer_entity_align {
+        reference_database_accession reference_database_name provenance_source
+        aligned_regions { entity_beg_seq_id length ref_beg_seq_id }
+    }
+    rcsb_entity_source_organism {
+        ncbi_scientific_name ncbi_taxonomy_id ncbi_common_names
+        rcsb_gene_name { value provenance_source }
+        taxonomy_lineage { depth id name }
+    }
+    rcsb_entity_host_organism { ncbi_scientific_name ncbi_taxonomy_id }
+    entity_poly {
+        type rcsb_entity_polymer_type rcsb_mutation_count rcsb_sample_sequence_length
+        pdbx_seq_one_letter_code_can
+    }
+    rcsb_cluster_membership { cluster_id identity }
+"""
+
+# kind -> (root query field, ID argument name, field selection)
+queries = {
+    'entry': ('entries', 'entry_ids', entry_fields),
+    'polymer_entity': ('polymer_entities', 'entity_ids', polymer_entity_fields),
+}
+
+
+def build_query(kind):
+    root, argument, fields = queries[kind]
+    return f"query($ids: [String!]!) {{ {root}({argument}: $ids) {{ {fields} }} }}"
+
+
+def split_response(kind, payload, batch_ids):
+    """
+    Split a GraphQL response into one record per requested ID
+
+    Args:
+        kind: 'entry' or 'polymer_entity'
+        payload: Decoded GraphQL response body
+        batch_ids: IDs sent in the request, in the caller's spelling
+
+    Returns:
+        (dictionary of requested ID -> record, list of IDs missing from the response)
+    """
+    root = queries[kind][0]
+    records = (payload.get('data') or {}).get(root) or []
+
+    # RCSB answers with upper-case rcsb_ids, map them back to the IDs we asked for
+    requested = {str(i).upper(): i for i in batch_ids}
+    found = {}
+    for record in records:
+        if not record or not record.get('rcsb_id'):
+            continue
+        requested_id = requested.get(record['rcsb_id'].upper())
+        if requested_id is not None:
+            found[requested_id] = record
+
+    missing = [i for i in batch_ids if i not in found]
+    return found, missing
+
+
+async def fetch_graphql_batches(ids, kind, output, batch_size=default_batch_size,
+                                concurrency=default_concurrency, rate=default_rate,
+                                timeout=default_timeout, url=graphql_url, manifest=None, source=None,
+                                retry=None, store=None, sink=None, metrics=None, errors=None):
+    """
+    Download records in batches through the RCSB data GraphQL endpoint
+
+    Each record is written to output/response_entry_{id}.json, the same name the
+    REST pullers use ('4HHB' for entries, '4HHB_1' for polymer entities). A batch
+    that is throttled, dropped or answered with a server error is resent after the
+    delay chosen by the retry scheduler, and fails as a whole once its retries run
+    out. A batch refused with a permanent error, or answered without data, is split
+    in half and the halves start over, so one bad ID cannot sink the rest of it. Outcomes are recorded in manifest under source
+    when a FetchManifest is given. With a RecordStore the records are appended
+    to the store under the same file names; with output None they are not kept.
+    A sink is called with (ID, record bytes) for every record received. With a
+    metrics.RunMetrics each POST is recorded like a fetch_engine request, and
+    batches that raise go to the progress.ErrorLog errors.
+
+    Returns:
+        Dictionary mapping ID to status code: 200 when written, 404 when the ID is
+        not in the archive, or the HTTP status / None of the failed request
+    """
+    retry = retry if retry is not None else RetryScheduler()
+    query = build_query(kind)
+    queue = DelayQueue()
+    ids = list(ids)
+    for i in range(0, len(ids), batch_size):
+        queue.add((ids[i:i + batch_size], 1))
+
+    results = {}
+    bucket = TokenBucket(rate)
+    host = url_host(url)
+    errors = errors if errors is not None else ErrorLog(None, logger, stage='fetch')
+    progress = Progress(len(ids), logger, label='records')
+
+    async def post_batch(session, batch_ids):
+        await bucket.acquire()
+        start = time.monotonic()
+        recorded = False
+        try:
+            async with session.post(url, json={'query': query, 'variables': {'ids': batch_ids}}) as response:
+                body = await response.read()
+                if metrics is not None:
+                    recorded = True
+                    record_request(metrics, host, response.status, time.monotonic() - start,
+                                   len(body) if response.status == 200 else 0)
+                if response.status != 200:
+                    return response.status, None, parse_retry_after(response.headers.get('Retry-After'))
+                return 200, json.loads(body), None
+        except Exception as e:
+            errors.record(f"batch starting at {batch_ids[0]}", repr(e))
+            if metrics is not None and not recorded:
+                record_request(metrics, host, None, time.monotonic() - start, 0)
+            return None, None, None
+
+    def finish(record_id, status, content=None):
+        results[record_id] = status
+        progress.update(not_fetched=int(status != 200))
+        if manifest is not None:
+            manifest.record(source, record_id, status, content)
+
+    async def worker(session):
+        while True:
+            item = await queue.get()
+            if item is None:
+                return
+            batch_ids, attempt = item
+            status, payload, retry_after = await post_batch(session, batch_ids)
+
+            if payload is None or payload.get('data') is None:
+                # Throttling, dropped connections and short outages hit the batch as a
+                # whole, so back off and resend it; once the retries run out the whole
+                # batch fails, as splitting it would only add load to a struggling host.
+                # A permanent error, or a query answered without data, may come from
+                # one ID, so then the batch is split to isolate it.
+                error_class = classify(status)
+                delay = retry.next_delay(status, attempt, retry_after)
+                if delay is not None:
+                    queue.put((batch_ids, attempt + 1), delay)
+                    if metrics is not None:
+                        metrics.count('retries_total', host=host)
+                    continue
+                if error_class in (THROTTLED, TRANSIENT) or len(batch_ids) == 1:
+                    for record_id in batch_ids:
+                        finish(record_id, status if status != 200 else None)
+                else:
+                    middle = len(batch_ids) // 2
+                    queue.add((batch_ids[:middle], 1))
+                    queue.add((batch_ids[middle:], 1))
+                queue.done()
+                continue
+
+            found, missing = split_response(kind, payload, batch_ids)
+            for record_id, record in found.items():
+                file_name = f'response_entry_{record_id}.json'
+                content = json.dumps(record).encode('utf-8')
+                if store is not None:
+                    store.put(file_name, content)
+                elif output is not None:
+                    # Renamed into place, like fetch_engine.fetch_and_save
+                    file_path = os.path.join(output, file_name)
+                    with open(file_path + '.tmp', 'wb') as f:
+                        f.write(content)
+                    os.replace(file_path + '.tmp', file_path)
+                if sink is not None:
+                    sink(record_id, content)
+                finish(record_id, 200, content)
+            for record_id in missing:
+                finish(record_id, 404)
+            queue.done()
+
+    connector = aiohttp.TCPConnector(limit=concurrency)
+    client_timeout = aiohttp.ClientTimeout(total=timeout)
+    async with aiohttp.ClientSession(connector=connector, timeout=client_timeout) as session:
+        await asyncio.gather(*(worker(session) for _ in range(concurrency)))
+    progress.finish()
+
+    if manifest is not None:
+        manifest.commit()
+    return results
+
+
+def run_graphql_fetch(ids, kind, output, **kwargs):
+    """Blocking wrapper around fetch_graphql_batches for the synchronous pull scripts"""
+    return asyncio.run(fetch_graphql_batches(ids, kind, output, **kwargs))
@@ -0,0 +1,154 @@
+import json
+from typing import Any, List, Optional, TypedDict
+
+try:
+    import msgspec
+except ImportError:
+    msgspec = None
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# Decoding layer for the extract scripts. Each schema lists only the fields one
+# extractor reads; msgspec skips everything else in the document without building
+# Python objects for it, which is most of an RCSB or EMDB response. The schemas are
+# TypedDicts, so decoded records are plain dicts and the extractors' .get() chains
+# work unchanged. Without msgspec, or when a document does not match its schema,
+# the whole document is decoded with the fastest generic decoder available.
+available_backends = [name for name, module in (('msgspec', msgspec), ('orjson', orjson)) if module is not None] + ['json']
+default_backend = available_backends[0]
+
+
+# Polymer entity fields read by pdb_entity_extract_v3.py
+EntityAlign = TypedDict('EntityAlign', {
+    'reference_database_accession': Any,
+    'reference_database_name': Any,
+}, total=False)
+GeneName = TypedDict('GeneName', {'value': Any}, total=False)
+Organism = TypedDict('Organism', {
+    'ncbi_scientific_name': Any,
+    'ncbi_taxonomy_id': Any,
+    'rcsb_gene_name': Optional[List[GeneName]],
+}, total=False)
+PolymerEntityInfo = TypedDict('PolymerEntityInfo', {
+    'pdbx_description': Any,
+    'pdbx_number_of_molecules': Any,
+    'rcsb_macromolecular_names_combined': Any,
+}, total=False)
+EntityPoly = TypedDict('EntityPoly', {'rcsb_mutation_count': Any}, total=False)
+polymer_entity_schema = TypedDict('PolymerEntity', {
+    'rcsb_id': Any,
+    'rcsb_polymer_entity_align': Optional[List[EntityAlign]],
+    'rcsb_polymer_entity': Optional[PolymerEntityInfo],
+    'rcsb_entity_source_organism': Optional[List[Organism]],
+    'rcsb_entity_host_organism': Optional[List[Organism]],
+    'entity_poly': Optional[EntityPoly],
+}, total=False)
+
+# Entry fields shared by the entry extractors
+EntryIdentifiers = TypedDict('EntryIdentifiers', {'entry_id': Any, 'emdb_ids': Any}, total=False)
+DatabaseStatus = TypedDict('DatabaseStatus', {'recvd_initial_deposition_date': Any}, total=False)
+AccessionInfo = TypedDict('AccessionInfo', {'initial_release_date': Any}, total=False)
+
+# Entry fields read by pdb_entry_extract_v2.py; the three tables it writes take
+# rcsb_entry_info, refine and rcsb_primary_citation whole
+entry_schema = TypedDict('Entry', {
+    'rcsb_entry_container_identifiers': EntryIdentifiers,
+    'pdbx_database_status': Optional[DatabaseStatus],
+    'rcsb_accession_info': Optional[AccessionInfo],
+    'rcsb_entry_info': Optional[dict],
+    'refine': Optional[List[dict]],
+    'rcsb_primary_citation': Optional[dict],
+}, total=False)
+
+# Entry fields read by pdb_entry_emdb_extract.py
+Reconstruction = TypedDict('Reconstruction', {'resolution': Any, 'num_particles': Any}, total=False)
+entry_emdb_schema = TypedDict('EntryEmdb', {
+    'rcsb_entry_container_identifiers': EntryIdentifiers,
+    'pdbx_database_status': DatabaseStatus,
+    'rcsb_accession_info': AccessionInfo,
+    'em3d_reconstruction': List[Reconstruction],
+}, total=False)
+
+# EMDB fields read by emdb_extract.py; the large sample, interpretation and
+# validation sections are skipped
+PdbReference = TypedDict('PdbReference', {'pdb_id': Any}, total=False)
+PdbList = TypedDict('PdbList', {'pdb_reference': List[PdbReference]}, total=False)
+CrossReferences = TypedDict('CrossReferences', {'pdb_list': PdbList}, total=False)
+Admin = TypedDict('Admin', {'title': Any}, total=False)
+emdb_schema = TypedDict('Emdb', {
+    'structure_determination_list': dict,
+    'crossreferences': CrossReferences,
+    'admin': Admin,
+    'map': dict,
+}, total=False)
+
+schemas = {
+    'polymer_entity': polymer_entity_schema,
+    'entry': entry_schema,
+    'entry_emdb': entry_emdb_schema,
+    'emdb': emdb_schema,
+}
+
+
+def generic_decoder(backend):
+    if backend == 'msgspec':
+        return msgspec.json.decode
+    if backend == 'orjson':
+        return orjson.loads
+    return json.loads
+
+
+class RecordDecoder:
+    """
+    Decodes response bodies, keeping only the fields in schema
+
+    Args:
+        schema: One of the TypedDicts above (or a key of schemas), or None to
+            decode whole documents
+        backend: 'msgspec', 'orjson' or 'json'; defaults to the fastest installed.
+            Only msgspec can skip fields, the others always decode the whole document.
+    """
+
+    def __init__(self, schema=None, backend=None):
+        self.backend = backend if backend else default_backend
+        if isinstance(schema, str):
+            schema = schemas[schema]
+        self.schema = schema
+        self.typed = msgspec.json.Decoder(schema) if schema is not None and self.backend == 'msgspec' else None
+        self.generic = generic_decoder(self.backend)
+        self.fallbacks = 0
+
+    def decode(self, content):
+        if self.typed is not None:
+            try:
+                return self.typed.decode(content)
+            except msgspec.ValidationError:
+                # A field with an unexpected type; decode everything and let the extractor cope
+                self.fallbacks += 1
+            except msgspec.DecodeError:
+                # JSON that msgspec rejects but json accepts (NaN, lone surrogates)
+                self.fallbacks += 1
+                return json.loads(content)
+        try:
+            return self.generic(content)
+        except ValueError:
+            # orjson and msgspec reject a few things json accepts (NaN, lone surrogates)
+            if self.generic is json.loads:
+                raise
+            return json.loads(content)
+
+    def load(self, record):
+        """Decode a record_store record (FileRecord or StoredRecord)"""
+        return self.decode(record.read())
+
+
+# Whole-document decoder for the scripts that read every field
+document_decoder = RecordDecoder()
+
+
+def decode_json(content):
+    """Decode a whole JSON document with the fastest installed decoder"""
+    return document_decoder.decode(content)
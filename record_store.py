@@ -0,0 +1,230 @@
+import gzip
+import json
+import os
+import sqlite3
+from collections import namedtuple
+from datetime import datetime
+from file_inventory import list_files
+from record_decoding import decode_json
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# A record store is a directory of append-only compressed shards plus a SQLite index.
+# Each shard is a run of independently compressed blocks (zstd frames, or gzip members
+# when zstandard is not installed). A block holds JSON lines of the form
+# "<name>\t<compact JSON body>", where name is the file name the pullers would have
+# written (response_entry_4HHB.json), so the extract scripts see the same records.
+index_name = 'index.sqlite'
+default_shard_size = 1 << 30  # ~1 GB of compressed data per shard
+default_block_size = 1 << 20  # ~1 MB of uncompressed records per block
+
+
+def is_record_store(location):
+    return os.path.exists(os.path.join(location, index_name))
+
+
+def shard_extension():
+    return '.jsonl.zst' if zstandard is not None else '.jsonl.gz'
+
+
+def compress_block(data, extension):
+    if extension == '.jsonl.zst':
+        return zstandard.ZstdCompressor(level=3).compress(data)
+    return gzip.compress(data, compresslevel=6)
+
+
+def decompress_block(data, extension):
+    if extension == '.jsonl.zst':
+        if zstandard is None:
+            raise ImportError("zstandard is required to read .jsonl.zst shards")
+        return zstandard.ZstdDecompressor().decompress(data)
+    return gzip.decompress(data)
+
+
+class RecordStore:
+    """
+    Sharded, compressed store for raw API responses
+
+    Writing a name again appends the new body and repoints the index, so the
+    latest version wins. Records are buffered into blocks and the index is only
+    updated once a block is on disk; close() flushes the last block.
+    """
+
+    def __init__(self, path, shard_size=default_shard_size, block_size=default_block_size):
+        self.path = path
+        self.shard_size = shard_size
+        self.block_size = block_size
+        os.makedirs(path, exist_ok=True)
+
+        self.conn = sqlite3.connect(os.path.join(path, index_name))
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS records (
+                name TEXT PRIMARY KEY,
+                shard TEXT NOT NULL,
+                block_offset INTEGER NOT NULL,
+                block_length INTEGER NOT NULL,
+                size INTEGER NOT NULL,
+                written_at TEXT NOT NULL
+            )
+        """)
+        self.conn.execute("CREATE INDEX IF NOT EXISTS records_block ON records (shard, block_offset)")
+        self.conn.commit()
+
+        self.block = []
+        self.block_names = []
+        self.block_bytes = 0
+        self.shard = self.current_shard()
+
+    def current_shard(self):
+        """Last shard with room left, or a new one"""
+        extension = shard_extension()
+        shards = sorted(f for f in os.listdir(self.path) if f.startswith('shard-') and f.endswith(extension))
+        if shards and os.path.getsize(os.path.join(self.path, shards[-1])) < self.shard_size:
+            return shards[-1]
+        return f"shard-{len(shards):05d}{extension}"
+
+    def put(self, name, body):
+        """Add one raw response body (bytes) under a file name"""
+        if '\t' in name or '\n' in name:
+            raise ValueError(f"Record name {name!r} contains a tab or newline")
+        if b'\n' in body:
+            # Re-serialize pretty-printed bodies so each record stays on one line
+            body = json.dumps(json.loads(body), separators=(',', ':')).encode('utf-8')
+        line = name.encode('utf-8') + b'\t' + body + b'\n'
+        self.block.append(line)
+        self.block_names.append((name, len(body)))
+        self.block_bytes += len(line)
+        if self.block_bytes >= self.block_size:
+            self.flush()
+
+    def flush(self):
+        if not self.block:
+            return
+        extension = self.shard[self.shard.index('.'):]
+        data = compress_block(b''.join(self.block), extension)
+        shard_path = os.path.join(self.path, self.shard)
+        with open(shard_path, 'ab') as f:
+            offset = f.tell()
+            f.write(data)
+
+        now = datetime.now().isoformat(timespec='seconds')
+        self.conn.executemany(
+            "INSERT OR REPLACE INTO records (name, shard, block_offset, block_length, size, written_at) "
+            "VALUES (?, ?, ?, ?, ?, ?)",
+            ((name, self.shard, offset, len(data), size, now) for name, size in self.block_names))
+        self.conn.commit()
+
+        self.block = []
+        self.block_names = []
+        self.block_bytes = 0
+        if offset + len(data) >= self.shard_size:
+            self.shard = self.current_shard()
+
+    def delete(self, names):
+        """Drop names from the index; their bytes stay in the shard until it is rewritten"""
+        self.conn.executemany("DELETE FROM records WHERE name = ?", ((n,) for n in names))
+        self.conn.commit()
+
+    def names(self, prefix='', suffix=''):
+        rows = self.conn.execute("SELECT name FROM records").fetchall()
+        return [r[0] for r in rows if r[0].startswith(prefix) and r[0].endswith(suffix)]
+
+    def records(self, prefix='', suffix=''):
+        """StoredRecord references in shard order, so sequential reads reuse each block"""
+        rows = self.conn.execute(
+            "SELECT name, shard, block_offset, block_length, size FROM records ORDER BY shard, block_offset"
+        ).fetchall()
+        return [StoredRecord(name, self.path, shard, offset, length, size)
+                for name, shard, offset, length, size in rows
+                if name.startswith(prefix) and name.endswith(suffix)]
+
+    def get(self, name):
+        row = self.conn.execute(
+            "SELECT name, shard, block_offset, block_length, size FROM records WHERE name = ?", (name,)
+        ).fetchone()
+        if row is None:
+            return None
+        return StoredRecord(row[0], self.path, *row[1:]).read()
+
+    def close(self):
+        self.flush()
+        self.conn.close()
+
+
+# The most recently decompressed block, per process. Records arrive in shard order,
+# so a worker reading consecutive records decompresses each block once.
+last_block = {'key': None, 'records': None}
+
+
+def read_block(store_path, shard, offset, length):
+    key = (store_path, shard, offset)
+    if last_block['key'] != key:
+        with open(os.path.join(store_path, shard), 'rb') as f:
+            f.seek(offset)
+            data = decompress_block(f.read(length), shard[shard.index('.'):])
+        records = {}
+        for line in data.split(b'\n'):
+            if line:
+                name, _, body = line.partition(b'\t')
+                records[name.decode('utf-8')] = body
+        last_block['key'] = key
+        last_block['records'] = records
+    return last_block['records']
+
+
+class StoredRecord(namedtuple('StoredRecord', ['name', 'store_path', 'shard', 'block_offset', 'block_length', 'size'])):
+    """Picklable reference to one record in a RecordStore"""
+    __slots__ = ()
+
+    def read(self):
+        return read_block(self.store_path, self.shard, self.block_offset, self.block_length)[self.name]
+
+
+class FileRecord(namedtuple('FileRecord', ['name', 'path'])):
+    """Picklable reference to one JSON file in a plain directory"""
+    __slots__ = ()
+
+    def read(self):
+        with open(self.path, 'rb') as f:
+            return f.read()
+
+
+def list_records(location, prefix='', suffix='.json'):
+    """
+    References to every record in a JSON directory or record store
+
+    The extract scripts use this instead of os.listdir so the same code reads
+    either layout. Each reference has a .name (the file name) and .read() for the
+    raw bytes, and is cheap to pickle to worker processes. Plain directories are
+    listed through the cached file inventory, in name order.
+    """
+    if is_record_store(location):
+        store = RecordStore(location)
+        records = store.records(prefix, suffix)
+        store.close()
+        return records
+    return [FileRecord(f, os.path.join(location, f)) for f in list_files(location, prefix, suffix)]
+
+
+def reconcile_manifest(store, manifest, source, name_for_id):
+    """
+    Re-queue IDs the manifest counts as fetched but that are not in the store
+
+    Covers blocks still buffered when a pull was killed, and switching a puller
+    from plain files to a store.
+
+    Returns:
+        Number of IDs queued again
+    """
+    stored = set(store.names())
+    lost = [i for i in manifest.ids(source) if name_for_id(i) not in stored]
+    manifest.mark_stale(source, lost)
+    return len(lost)
+
+
+def load_json(record):
+    return decode_json(record.read())
@@ -0,0 +1,149 @@
+import asyncio
+import heapq
+import itertools
+import random
+import time
+from collections import deque
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+
+# Error classes
+PERMANENT = 'permanent'  # 404 and other client errors, never retried
+THROTTLED = 'throttled'  # 429 / 503, wait for Retry-After
+TRANSIENT = 'transient'  # Connection errors, timeouts and other server errors
+
+throttle_codes = (429, 503)
+transient_codes = (408, 500, 502, 504)
+
+
+def classify(status):
+    """
+    Sort the outcome of a request into an error class
+
+    Args:
+        status: HTTP status code, or None when the request did not complete
+
+    Returns:
+        None for a success (including 304 Not Modified), otherwise PERMANENT, THROTTLED or TRANSIENT
+    """
+    if status is None:
+        return TRANSIENT
+    if 200 <= status < 300 or status == 304:
+        return None
+    if status in throttle_codes:
+        return THROTTLED
+    if status in transient_codes or status >= 500:
+        return TRANSIENT
+    return PERMANENT
+
+
+def parse_retry_after(value):
+    """Seconds to wait from a Retry-After header (delta-seconds or HTTP date), or None"""
+    if not value:
+        return None
+    value = value.strip()
+    if value.isdigit():
+        return float(value)
+    try:
+        when = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    if when.tzinfo is None:
+        when = when.replace(tzinfo=timezone.utc)
+    return max(0.0, (when - datetime.now(timezone.utc)).total_seconds())
+
+
+class RetryScheduler:
+    """
+    Decides whether and when a failed request is tried again
+
+    Permanent errors are never retried. Throttled responses wait for the
+    server's Retry-After (falling back to backoff when it is missing), and
+    transient errors use exponential backoff with full jitter.
+    """
+
+    def __init__(self, max_attempts=6, base_delay=1.0, max_delay=300.0, max_retry_after=900.0):
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.max_retry_after = max_retry_after
+
+    def backoff(self, attempt):
+        # Full jitter: uniform in [0, min(max_delay, base * 2^(attempt - 1))]
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** (attempt - 1)))
+
+    def next_delay(self, status, attempt, retry_after=None):
+        """
+        Args:
+            status: HTTP status code of the attempt, or None for a connection error
+            attempt: Number of attempts made so far, starting at 1
+            retry_after: Seconds requested by the server's Retry-After header
+
+        Returns:
+            Seconds to wait before the next attempt, or None if the request is finished
+        """
+        error_class = classify(status)
+        if error_class is None or error_class == PERMANENT:
+            return None
+        if attempt >= self.max_attempts:
+            return None
+        if error_class == THROTTLED and retry_after is not None:
+            # A little jitter keeps throttled requests from all coming back at the same instant
+            return min(self.max_retry_after, retry_after) + random.uniform(0, self.base_delay)
+        return self.backoff(attempt)
+
+
+class DelayQueue:
+    """
+    Work queue for async workers where failed items go back in with a delay
+
+    Items count as unfinished from add() until done(), so an item waiting out
+    its retry delay keeps the workers alive while the rest of the queue drains
+    at full speed. get() returns None once all work is finished.
+    """
+
+    def __init__(self):
+        self.ready = deque()
+        self.delayed = []
+        self.counter = itertools.count()
+        self.unfinished = 0
+        self.changed = asyncio.Event()
+
+    def add(self, item):
+        """Queue a new piece of work"""
+        self.unfinished += 1
+        self.put(item)
+
+    def put(self, item, delay=0):
+        """Return an unfinished item to the queue, optionally after delay seconds"""
+        if delay > 0:
+            heapq.heappush(self.delayed, (time.monotonic() + delay, next(self.counter), item))
+        else:
+            self.ready.append(item)
+        self.changed.set()
+
+    def done(self):
+        """Mark one item as finished for good"""
+        self.unfinished -= 1
+        if self.unfinished == 0:
+            self.changed.set()
+
+    def delayed_count(self):
+        return len(self.delayed)
+
+    async def get(self):
+        while True:
+            now = time.monotonic()
+            while self.delayed and self.delayed[0][0] <= now:
+                self.ready.append(heapq.heappop(self.delayed)[2])
+            if self.ready:
+                return self.ready.popleft()
+            if self.unfinished == 0:
+                return None
+
+            timeout = self.delayed[0][0] - now if self.delayed else None
+            self.changed.clear()
+            try:
+                await asyncio.wait_for(self.changed.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
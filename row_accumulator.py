@@ -0,0 +1,98 @@
+import os
+import pandas as pd
+
+try:
+    import pyarrow as pa
+except ImportError:
+    pa = None
+
+# Rows held before an extractor writes them out
+default_capacity = 5000
+
+
+class ColumnarAccumulator:
+    """
+    Collects extracted rows column by column until they are written out
+
+    Replaces building a one-row DataFrame per record and pd.concat-ing it onto
+    a growing frame, which copies every earlier row on each append. Values go
+    into per-column lists preallocated to capacity, and one frame (or Arrow
+    record batch) is built per flush.
+
+    Args:
+        columns: Column names in output order, or None to take them from the
+            first row added
+        capacity: Rows held before full() is True
+    """
+
+    def __init__(self, columns=None, capacity=default_capacity):
+        self.capacity = capacity
+        self.columns = list(columns) if columns is not None else None
+        self.data = None
+        self.size = 0
+        if self.columns is not None:
+            self.allocate()
+
+    def allocate(self):
+        self.data = {col: [None] * self.capacity for col in self.columns}
+        self.size = 0
+
+    def __len__(self):
+        return self.size
+
+    def full(self):
+        return self.size >= self.capacity
+
+    def add(self, row):
+        """Add one row (dict); keys outside the columns are ignored, missing ones are None"""
+        if self.columns is None:
+            self.columns = list(row)
+            self.allocate()
+        if self.size == self.capacity:
+            # Keep taking rows if the caller flushes late
+            for values in self.data.values():
+                values.extend([None] * self.capacity)
+            self.capacity *= 2
+        index = self.size
+        for col, values in self.data.items():
+            values[index] = row.get(col)
+        self.size += 1
+
+    def clear(self):
+        if self.columns is not None:
+            self.allocate()
+
+    def to_columns(self):
+        return {col: values[:self.size] for col, values in self.data.items()}
+
+    def to_frame(self):
+        # object dtype keeps integer columns with gaps as integers in the CSV,
+        # as the per-row frames did, instead of turning them into floats
+        return pd.DataFrame(self.to_columns(), columns=self.columns, dtype=object)
+
+    def to_arrow(self):
+        if pa is None:
+            raise ImportError("pyarrow is required for Arrow record batches")
+        return pa.RecordBatch.from_pydict(self.to_columns())
+
+    def flush(self, csv_path=None, parquet_writer=None, catalog_table=None):
+        """
+        Append the held rows to a CSV (header written only once), a
+        parquet_output.ParquetBatchWriter and/or a catalog.CatalogTable, then clear
+
+        Returns:
+            Number of rows written
+        """
+        written = self.size
+        if written:
+            if csv_path is not None:
+                self.to_frame().to_csv(csv_path, mode='a', index=False, header=not os.path.exists(csv_path))
+            if parquet_writer is not None:
+                parquet_writer.write_columns(self.to_columns())
+            if catalog_table is not None:
+                catalog_table.write_columns(self.to_columns())
+        self.clear()
+        return written
+
+    def flush_csv(self, path):
+        return self.flush(csv_path=path)
@@ -0,0 +1,250 @@
+import csv
+import os
+import time
+import pandas as pd
+from checkpoint import sync_file, truncate_file
+from parquet_output import ParquetBatchWriter
+from progress import ErrorLog, get_logger
+from record_decoding import decode_json
+
+# Rows buffered before they are appended to the output CSV
+default_batch_size = 5000
+
+# Rows per chunk when the spooled rows are copied into the final outputs
+finish_chunk_size = 10000
+
+
+def rows_to_columns(rows):
+    """
+    Turn a list of row dictionaries into a block of column -> list of values
+
+    Columns are in order of first appearance and rows without a column get "".
+    A block pickles much smaller than the rows, as each key is sent once.
+    """
+    columns = {}
+    for index, row in enumerate(rows):
+        for key, value in row.items():
+            values = columns.get(key)
+            if values is None:
+                values = columns[key] = [""] * len(rows)
+            values[index] = value
+    return columns
+
+
+class StreamingTableWriter:
+    """
+    Writes rows whose columns are only known once the last row has been seen
+
+    Rows are appended in batches to a spool file next to the output, each row
+    written against the column list of its time. That list only grows at the end,
+    so a spooled row is always a prefix of the final columns. close() makes one
+    pass over the spool to write the output with the full header, padding short
+    rows with "" and reordering columns when sort_columns is set. Memory use is
+    one batch plus the column list, whatever the number of rows.
+
+    Args:
+        path: Output CSV, or None for Parquet only
+        quoting: csv quoting mode of the output
+        sort_columns: Sort the output columns by name instead of first appearance
+        batch_size: Rows held before they are spooled
+        parquet_path: Also (or only) write Parquet here
+        parquet_types: Parquet column types, see parquet_output.ParquetBatchWriter
+        partition_by: Date column whose year partitions the Parquet output
+        resume_from: State returned by checkpoint() in an earlier run; the spool is
+            cut back to it instead of being started fresh
+    """
+
+    def __init__(self, path, quoting=csv.QUOTE_MINIMAL, sort_columns=False, batch_size=default_batch_size,
+                 parquet_path=None, parquet_types=None, partition_by=None, resume_from=None):
+        self.path = path
+        self.quoting = quoting
+        self.sort_columns = sort_columns
+        self.batch_size = batch_size
+        self.parquet_path = parquet_path
+        self.parquet_types = parquet_types
+        self.partition_by = partition_by
+        self.spool_path = (path or parquet_path) + '.partial'
+        self.buffer = []
+        self.columns = []
+        self.seen = set()
+        self.row_count = 0
+
+        # Start fresh, as the extract scripts do, unless resuming
+        for stale in (path, None if resume_from else self.spool_path):
+            if stale is not None and os.path.exists(stale):
+                os.remove(stale)
+        if resume_from:
+            truncate_file(self.spool_path, resume_from['spool_offset'])
+            self.columns = list(resume_from['columns'])
+            self.seen = set(self.columns)
+            self.row_count = resume_from['row_count']
+
+    def add(self, row):
+        self.buffer.append(row)
+        if len(self.buffer) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        if not self.buffer:
+            return
+        for row in self.buffer:
+            for key in row:
+                if key not in self.seen:
+                    self.seen.add(key)
+                    self.columns.append(key)
+
+        with open(self.spool_path, 'a', newline='', encoding='utf-8') as f:
+            writer = csv.writer(f)
+            for row in self.buffer:
+                writer.writerow([row.get(col, "") for col in self.columns])
+        self.row_count += len(self.buffer)
+        self.buffer = []
+
+    def add_columns(self, data):
+        """Spool a whole block given as a dictionary of column -> list of values"""
+        self.flush()
+        size = len(next(iter(data.values()), []))
+        if size == 0:
+            return
+        for key in data:
+            if key not in self.seen:
+                self.seen.add(key)
+                self.columns.append(key)
+
+        missing = [""] * size
+        with open(self.spool_path, 'a', newline='', encoding='utf-8') as f:
+            csv.writer(f).writerows(zip(*[data.get(col, missing) for col in self.columns]))
+        self.row_count += size
+
+    def checkpoint(self):
+        """
+        Flush and sync the spool
+
+        Returns:
+            State to save with a checkpoint.Checkpoint and pass back as resume_from
+        """
+        self.flush()
+        return {'spool_offset': sync_file(self.spool_path), 'columns': list(self.columns),
+                'row_count': self.row_count}
+
+    def output_columns(self):
+        return sorted(self.columns) if self.sort_columns else list(self.columns)
+
+    def spooled_rows(self, columns):
+        """Spooled rows as lists in the order of columns"""
+        if not os.path.exists(self.spool_path):
+            return
+        position = {col: i for i, col in enumerate(self.columns)}
+        order = [position[col] for col in columns]
+        with open(self.spool_path, 'r', newline='', encoding='utf-8') as f:
+            for row in csv.reader(f):
+                width = len(row)
+                yield [row[i] if i < width else "" for i in order]
+
+    def close(self, keep_spool=False):
+        """
+        Write the final outputs from the spool
+
+        Args:
+            keep_spool: Leave the spool for remove_spool(), so a run saved with a
+                checkpoint.Checkpoint can remove the checkpoint first; a run killed
+                in between then still finds the spool its checkpoint points at
+
+        Returns:
+            Number of rows written
+        """
+        self.flush()
+        columns = self.output_columns()
+
+        parquet_writer = None
+        if self.parquet_path is not None:
+            parquet_writer = ParquetBatchWriter(self.parquet_path, columns, self.parquet_types, self.partition_by)
+
+        csv_file = open(self.path, 'w', newline='', encoding='utf-8') if self.path is not None else None
+        try:
+            csv_writer = csv.writer(csv_file, quoting=self.quoting) if csv_file is not None else None
+            if csv_writer is not None:
+                csv_writer.writerow(columns)
+            chunk = []
+            for row in self.spooled_rows(columns):
+                chunk.append(row)
+                if len(chunk) >= finish_chunk_size:
+                    self.write_chunk(chunk, columns, csv_writer, parquet_writer)
+                    chunk = []
+            self.write_chunk(chunk, columns, csv_writer, parquet_writer)
+        finally:
+            if csv_file is not None:
+                csv_file.close()
+
+        if parquet_writer is not None:
+            parquet_writer.close()
+        if not keep_spool:
+            self.remove_spool()
+        return self.row_count
+
+    def remove_spool(self):
+        if os.path.exists(self.spool_path):
+            os.remove(self.spool_path)
+
+    @staticmethod
+    def write_chunk(chunk, columns, csv_writer, parquet_writer):
+        if not chunk:
+            return
+        if csv_writer is not None:
+            csv_writer.writerows(chunk)
+        if parquet_writer is not None:
+            parquet_writer.write_columns({col: [row[i] for row in chunk] for i, col in enumerate(columns)})
+
+
+class RowSink:
+    """
+    Turns response bodies into output rows as the pullers receive them
+
+    Pass an instance as sink= to run_fetch / run_graphql_fetch. Each 200 body is
+    decoded and handed to extract (one of the *_extract row functions), and the
+    rows are spooled every batch_size rows, so the table is ready when the
+    download finishes. Unchanged records (304) have no body and produce no row,
+    so an incremental pull writes only new and revised records.
+
+    Columns are kept in the order they are first seen. With a metrics.RunMetrics
+    the decode and extract time of every body is recorded as parse_seconds.
+    Bodies that fail to extract go to the progress.ErrorLog errors.
+    """
+
+    def __init__(self, extract, csv_output, failed_output=None, batch_size=default_batch_size, metrics=None,
+                 errors=None):
+        self.extract = extract
+        self.metrics = metrics
+        self.errors = errors if errors is not None else ErrorLog(None, get_logger('stream_extract'))
+        self.csv_output = csv_output
+        self.failed_output = failed_output
+        self.table = StreamingTableWriter(csv_output, batch_size=batch_size)
+        self.failed_ids = []
+
+    def __call__(self, record_id, content):
+        start = time.perf_counter()
+        try:
+            row = self.extract(decode_json(content))
+        except Exception as e:
+            self.errors.record(record_id, e, stage='extract')
+            self.failed_ids.append(record_id)
+            if self.metrics is not None:
+                self.metrics.count('files_failed_total')
+            return
+        if self.metrics is not None:
+            self.metrics.observe('parse_seconds', time.perf_counter() - start)
+            self.metrics.count('files_parsed_total')
+        self.table.add(row)
+
+    def close(self):
+        """
+        Write the output table and the failed IDs
+
+        Returns:
+            Number of rows written
+        """
+        row_count = self.table.close()
+        if self.failed_ids and self.failed_output:
+            pd.DataFrame({'failed_ids': self.failed_ids}).to_csv(
+                self.failed_output, mode='a', index=False, header=not os.path.exists(self.failed_output))
+        return row_count
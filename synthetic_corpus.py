@@ -0,0 +1,476 @@
+import argparse
+import json
+import multiprocessing as mp
+import os
+import random
+import string
+import time
+
+# Writes a synthetic archive of the JSON responses the extract scripts read, so
+# they can be benchmarked (benchmark_suite.py) without the real downloads:
+#   entry/   response_entry_{pdb_id}.json              (data.rcsb.org entry)
+#   entity/  response_entry_{pdb_id}_{entity_id}.json  (polymer entity)
+#   emdb/    response_emdb_EMD-{n}.json               (EMDB entry)
+#   empiar/  response_empiar_EMD-{n}.json             (EMPIAR entry of that map)
+# Documents follow the layout of the real responses, with the nesting and the
+# array lengths (authors, lineages, entities per entry, components) drawn from
+# distributions close to the archive's, and cross-reference each other the way
+# the real ones do (EM entries list their EMDB maps, maps list their models,
+# EMPIAR entries reference maps). Each document is seeded from its own ID, so a
+# corpus is the same whatever the number of processes. Example:
+#   python synthetic_corpus.py --output /scratch/corpus --entries 100000
+
+# Share of the entries solved by EM, and of the maps with an EMPIAR entry
+default_em_fraction = 0.3
+default_empiar_fraction = 0.1
+# PDB IDs are 4 base-36 characters starting with a digit other than 0
+max_entries = 9 * 36 ** 3
+# Documents written per worker task
+chunk_size = 100
+
+base36 = string.digits + string.ascii_uppercase
+amino_acids = 'ACDEFGHIKLMNPQRSTVWY'
+organisms = [
+    ('Homo sapiens', 9606), ('Mus musculus', 10090), ('Escherichia coli', 562),
+    ('Saccharomyces cerevisiae', 4932), ('Rattus norvegicus', 10116), ('Bos taurus', 9913),
+    ('Thermus thermophilus', 274), ('Arabidopsis thaliana', 3702), ('Drosophila melanogaster', 7227),
+    ('Severe acute respiratory syndrome coronavirus 2', 2697049),
+]
+hosts = [('Escherichia coli BL21(DE3)', 469008), ('Spodoptera frugiperda', 7108),
+         ('Homo sapiens', 9606), ('Komagataella pastoris', 4922)]
+words = ('protein kinase domain complex receptor subunit alpha beta binding factor transporter '
+         'ribosomal structure crystal cryo-EM human bacterial inhibitor channel membrane dehydrogenase '
+         'mutant apo bound ligand antibody fab fragment polymerase nucleosome').split()
+microscopes = ['FEI TITAN KRIOS', 'FEI TALOS ARCTICA', 'JEOL CRYO ARM 300', 'TFS GLACIOS']
+detectors = ['GATAN K3 (6k x 4k)', 'GATAN K2 SUMMIT (4k x 4k)', 'FEI FALCON IV (4k x 4k)']
+symmetries = ['C1', 'C2', 'C3', 'D2', 'T', 'O', 'I']
+
+
+def pdb_id(index):
+    return base36[1 + index // 36 ** 3] + ''.join(base36[index // 36 ** p % 36] for p in (2, 1, 0))
+
+
+def emdb_id(index):
+    return f"EMD-{10000 + index}"
+
+
+def empiar_id(index):
+    return f"EMPIAR-{10000 + index}"
+
+
+def document_rng(seed, kind, record_id):
+    return random.Random(f"{seed}:{kind}:{record_id}")
+
+
+def title(rng, low=4, high=12):
+    return ' '.join(rng.choice(words) for _ in range(rng.randint(low, high))).capitalize()
+
+
+def date(rng, low=1990, high=2024):
+    return f"{rng.randint(low, high)}-{rng.randint(1, 12):02d}-{rng.randint(1, 28):02d}T00:00:00+0000"
+
+
+def count(rng, mean, low=1, high=None):
+    """Array length drawn from a geometric-like distribution with the given mean"""
+    n = low + int(rng.expovariate(1.0 / max(mean - low, 1e-9)))
+    return min(n, high) if high is not None else n
+
+
+def with_units(value, units):
+    return {'valueOf_': str(value), 'units': units}
+
+
+def entity_count(seed, index):
+    # Half the entries have a single polymer entity, a few have dozens
+    return count(document_rng(seed, 'entities', index), 2.2, 1, 40)
+
+
+def emdb_count(seed, index):
+    rng = document_rng(seed, 'maps', index)
+    return 1 + (rng.random() < 0.1)
+
+
+def entry_document(seed, index, emdb_ids):
+    """An entry as returned by /rest/v1/core/entry; EM entries list emdb_ids"""
+    entry_id = pdb_id(index)
+    rng = document_rng(seed, 'entry', entry_id)
+    em = bool(emdb_ids)
+    method = 'ELECTRON MICROSCOPY' if em else rng.choice(['X-RAY DIFFRACTION'] * 9 + ['SOLUTION NMR'])
+    entities = entity_count(seed, index)
+    resolution = round(rng.uniform(1.2, 4.5), 2)
+    released = date(rng, 1995)
+    authors = [{'name': f"{rng.choice(string.ascii_uppercase)}. {title(rng, 1, 1)}", 'pdbx_ordinal': i + 1,
+                'identifier_orcid': f"0000-000{rng.randint(1, 9)}-{rng.randint(1000, 9999)}-{rng.randint(1000, 9999)}"}
+               for i in range(count(rng, 8, 1, 120))]
+    citation = {
+        'country': rng.choice(['US', 'UK', 'DE', 'JP', 'CN']), 'id': 'primary',
+        'journal_abbrev': rng.choice(['Nature', 'Science', 'Cell', 'J Mol Biol', 'Nat Commun']),
+        'journal_id_astm': 'NATUAS', 'journal_id_csd': '0006', 'journal_id_issn': '0028-0836',
+        'journal_volume': str(rng.randint(1, 600)), 'page_first': str(rng.randint(1, 900)),
+        'page_last': str(rng.randint(900, 1800)), 'pdbx_database_id_doi': f"10.1038/s{rng.randint(10 ** 7, 10 ** 8)}",
+        'pdbx_database_id_pub_med': rng.randint(10 ** 7, 4 * 10 ** 7),
+        'rcsb_authors': [a['name'] for a in authors[:20]], 'rcsb_journal_abbrev': 'Nature',
+        'title': title(rng, 6, 20), 'year': int(released[:4]),
+    }
+
+    data = {
+        'audit_author': authors,
+        'cell': {'angle_alpha': 90.0, 'angle_beta': 90.0, 'angle_gamma': 90.0,
+                 'length_a': round(rng.uniform(30, 300), 3), 'length_b': round(rng.uniform(30, 300), 3),
+                 'length_c': round(rng.uniform(30, 300), 3), 'zpdb': rng.choice([2, 4, 8])},
+        'citation': [citation] + [dict(citation, id=str(i), title=title(rng)) for i in range(1, count(rng, 1.5, 1, 6))],
+        'exptl': [{'method': method}],
+        'pdbx_audit_revision_history': [{'data_content_type': 'Structure model', 'major_revision': 1,
+                                         'minor_revision': i, 'ordinal': i + 1, 'revision_date': date(rng, 2000)}
+                                        for i in range(count(rng, 3, 1, 15))],
+        'pdbx_database_related': [{'content_type': 'unspecified', 'db_id': pdb_id(rng.randrange(max_entries)),
+                                   'db_name': 'PDB'} for _ in range(count(rng, 1, 0, 10))],
+        'pdbx_database_status': {'recvd_initial_deposition_date': date(rng, 1990), 'status_code': 'REL',
+                                 'deposit_site': rng.choice(['RCSB', 'PDBE', 'PDBJ']), 'sgentry': 'N'},
+        'rcsb_accession_info': {'deposit_date': date(rng, 1990), 'initial_release_date': released,
+                                'major_revision': 1, 'minor_revision': rng.randint(0, 5), 'status_code': 'REL'},
+        'rcsb_entry_container_identifiers': {
+            'entity_ids': [str(i) for i in range(1, entities + 1)], 'entry_id': entry_id,
+            'polymer_entity_ids': [str(i) for i in range(1, entities + 1)], 'rcsb_id': entry_id,
+            'pubmed_id': citation['pdbx_database_id_pub_med'],
+        },
+        'rcsb_entry_info': {
+            'assembly_count': rng.randint(1, 4), 'branched_entity_count': rng.randint(0, 2),
+            'cis_peptide_count': rng.randint(0, 10), 'deposited_atom_count': rng.randint(500, 200000),
+            'deposited_deuterated_water_count': 0, 'deposited_hydrogen_atom_count': 0,
+            'deposited_model_count': 1, 'deposited_modeled_polymer_monomer_count': rng.randint(50, 20000),
+            'deposited_nonpolymer_entity_instance_count': rng.randint(0, 30),
+            'deposited_polymer_entity_instance_count': entities * rng.randint(1, 4),
+            'deposited_polymer_monomer_count': rng.randint(50, 25000), 'deposited_solvent_atom_count': rng.randint(0, 2000),
+            'deposited_unmodeled_polymer_monomer_count': rng.randint(0, 500), 'disulfide_bond_count': rng.randint(0, 8),
+            'entity_count': entities + rng.randint(0, 3), 'experimental_method': 'EM' if em else 'X-ray',
+            'experimental_method_count': 1, 'inter_mol_covalent_bond_count': 0, 'inter_mol_metalic_bond_count': 0,
+            'molecular_weight': round(rng.uniform(10, 2000), 2), 'na_polymer_entity_types': 'Other',
+            'nonpolymer_bound_components': [f"{rng.choice(string.ascii_uppercase)}{rng.randint(10, 99)}"
+                                            for _ in range(count(rng, 2, 0, 12))],
+            'nonpolymer_entity_count': rng.randint(0, 5), 'polymer_composition': 'heteromeric protein',
+            'polymer_entity_count': entities, 'polymer_entity_count_dna': 0, 'polymer_entity_count_rna': 0,
+            'polymer_entity_count_nucleic_acid': 0, 'polymer_entity_count_nucleic_acid_hybrid': 0,
+            'polymer_entity_count_protein': entities, 'polymer_entity_taxonomy_count': rng.randint(1, 3),
+            'polymer_molecular_weight_maximum': round(rng.uniform(10, 300), 2),
+            'polymer_molecular_weight_minimum': round(rng.uniform(1, 10), 2),
+            'polymer_monomer_count_maximum': rng.randint(100, 3000), 'polymer_monomer_count_minimum': rng.randint(5, 100),
+            'resolution_combined': [resolution], 'selected_polymer_entity_types': 'Protein (only)',
+            'software_programs_combined': rng.sample(['PHENIX', 'COOT', 'REFMAC', 'XDS', 'RELION', 'CRYOSPARC'], 3),
+            'solvent_entity_count': 0 if em else 1, 'structure_determination_methodology': 'experimental',
+            'structure_determination_methodology_priority': 10,
+            'diffrn_resolution_high': {'provenance_source': 'Depositor assigned', 'value': resolution},
+        },
+        'rcsb_primary_citation': citation,
+        'software': [{'classification': rng.choice(['refinement', 'model building', 'data reduction']),
+                      'name': rng.choice(['PHENIX', 'COOT', 'XDS']), 'pdbx_ordinal': i + 1}
+                     for i in range(count(rng, 4, 1, 12))],
+        'struct': {'title': title(rng, 6, 24), 'pdbx_descriptor': title(rng, 2, 6)},
+        'struct_keywords': {'pdbx_keywords': rng.choice(words).upper(), 'text': ', '.join(rng.sample(words, 4))},
+    }
+    if em:
+        data['rcsb_entry_container_identifiers']['emdb_ids'] = emdb_ids
+        data['em3d_reconstruction'] = [{'resolution': resolution, 'num_particles': rng.randint(10 ** 4, 10 ** 6),
+                                        'resolution_method': 'FSC 0.143 CUT-OFF', 'symmetry_type': 'POINT',
+                                        'algorithm': 'FOURIER SPACE', 'id': '1'}]
+        data['em_experiment'] = {'aggregation_state': 'PARTICLE', 'reconstruction_method': 'SINGLE PARTICLE'}
+        data['em_ctf_correction'] = [{'type': 'PHASE FLIPPING AND AMPLITUDE CORRECTION', 'id': '1'}]
+    elif method == 'X-RAY DIFFRACTION':
+        data['refine'] = [{
+            'ls_rfactor_rfree': round(rng.uniform(0.15, 0.3), 4), 'ls_rfactor_rwork': round(rng.uniform(0.12, 0.25), 4),
+            'ls_rfactor_obs': round(rng.uniform(0.12, 0.25), 4), 'ls_dres_high': resolution,
+            'ls_dres_low': round(rng.uniform(20, 80), 2), 'ls_number_reflns_rfree': rng.randint(500, 5000),
+            'ls_number_reflns_obs': rng.randint(5000, 300000), 'ls_percent_reflns_rfree': 5.0,
+            'ls_percent_reflns_obs': round(rng.uniform(90, 100), 2), 'pdbx_rfree_selection_details': 'RANDOM',
+            'pdbx_data_cutoff_high_rms_abs_f': None, 'pdbx_ls_cross_valid_method': 'THROUGHOUT',
+            'pdbx_ls_sigma_f': 1.34, 'pdbx_method_to_determine_struct': 'MOLECULAR REPLACEMENT',
+            'pdbx_refine_id': 'X-RAY DIFFRACTION', 'solvent_model_details': 'FLAT BULK SOLVENT MODEL',
+            'solvent_model_param_bsol': round(rng.uniform(20, 60), 2), 'solvent_model_param_ksol': 0.35,
+            'biso_mean': round(rng.uniform(10, 90), 2),
+        }]
+        data['reflns'] = [{'d_resolution_high': resolution, 'd_resolution_low': 50.0, 'number_obs': rng.randint(5000, 300000),
+                           'pdbx_redundancy': round(rng.uniform(2, 12), 1), 'percent_possible_obs': 99.1}]
+        data['symmetry'] = {'space_group_name_hm': rng.choice(['P 21 21 21', 'C 1 2 1', 'P 1', 'P 43 21 2'])}
+    return data
+
+
+def entity_document(seed, entry_index, entity_id):
+    """A polymer entity as returned by /rest/v1/core/polymer_entity"""
+    entry_id = pdb_id(entry_index)
+    rng = document_rng(seed, 'entity', f"{entry_id}_{entity_id}")
+    length = count(rng, 350, 20, 5000)
+    name = title(rng, 2, 6)
+    organism, taxonomy_id = rng.choice(organisms)
+    lineage = [{'depth': depth, 'id': str(rng.randint(1, 3 * 10 ** 6)), 'name': title(rng, 1, 2)}
+               for depth in range(1, count(rng, 25, 5, 45))]
+    source = {'ncbi_scientific_name': organism, 'ncbi_taxonomy_id': taxonomy_id, 'provenance_source': 'Primary Data',
+              'rcsb_gene_name': [{'value': f"{rng.choice(string.ascii_uppercase)}{rng.randint(1, 99)}",
+                                  'provenance_source': 'UniProt'} for _ in range(count(rng, 1.5, 0, 6))],
+              'taxonomy_lineage': lineage, 'ncbi_common_names': [title(rng, 1, 2) for _ in range(count(rng, 1, 0, 4))],
+              'scientific_name': organism}
+    accession = f"{rng.choice('OPQ')}{rng.randint(0, 9)}{''.join(rng.choice(base36) for _ in range(4))}"
+
+    data = {
+        'rcsb_id': f"{entry_id}_{entity_id}",
+        'entity_poly': {'nstd_linkage': 'no', 'nstd_monomer': 'no', 'pdbx_seq_one_letter_code':
+                        ''.join(rng.choices(amino_acids, k=length)),
+                        'pdbx_strand_id': ','.join(rng.sample(string.ascii_uppercase, rng.randint(1, 4))),
+                        'rcsb_entity_polymer_type': 'Protein', 'rcsb_mutation_count': rng.choice([0] * 4 + [1, 2]),
+                        'rcsb_sample_sequence_length': length, 'type': 'polypeptide(L)'},
+        'rcsb_cluster_membership': [{'cluster_id': rng.randint(1, 60000), 'identity': identity}
+                                    for identity in (100, 95, 90, 70, 50, 30)],
+        'rcsb_entity_source_organism': [source for _ in range(count(rng, 1.1, 1, 3))],
+        'rcsb_polymer_entity': {
+            'formula_weight': round(length * 0.11, 3), 'pdbx_description': name,
+            'pdbx_number_of_molecules': rng.randint(1, 12),
+            'rcsb_macromolecular_names_combined': [{'name': name, 'provenance_code': 'ECO:0000304',
+                                                    'provenance_source': 'PDB Preferred Name'}],
+            'rcsb_ec_lineage': [{'depth': d, 'id': '.'.join(['2', '7', '11', '1'][:d]), 'name': title(rng, 1, 3)}
+                                for d in range(1, rng.choice([0, 0, 3, 5]))],
+        },
+        'rcsb_polymer_entity_align': [{'provenance_source': 'SIFTS', 'reference_database_accession': accession,
+                                       'reference_database_name': 'UniProt',
+                                       'aligned_regions': [{'entity_beg_seq_id': rng.randint(1, 50), 'length': rng.randint(10, length),
+                                                            'ref_beg_seq_id': rng.randint(1, 500)}
+                                                           for _ in range(count(rng, 1.3, 1, 8))]}],
+        'rcsb_polymer_entity_annotation': [{'annotation_id': f"PF{rng.randint(10000, 99999)}", 'type': rng.choice(['Pfam', 'GO', 'InterPro']),
+                                            'name': title(rng, 1, 4), 'provenance_source': 'UniProt',
+                                            'annotation_lineage': [{'id': f"GO:{rng.randint(10 ** 6, 10 ** 7)}", 'name': title(rng, 1, 3)}
+                                                                   for _ in range(count(rng, 4, 0, 20))]}
+                                           for _ in range(count(rng, 8, 0, 60))],
+        'rcsb_polymer_entity_container_identifiers': {
+            'asym_ids': list(data_ids(rng)), 'auth_asym_ids': list(data_ids(rng)),
+            'entity_id': str(entity_id), 'entry_id': entry_id, 'rcsb_id': f"{entry_id}_{entity_id}",
+            'uniprot_ids': [accession],
+        },
+        'rcsb_polymer_entity_feature': [{'name': rng.choice(['disorder', 'hydropathy', 'CATH domain']), 'provenance_source': 'RCSB',
+                                         'type': 'unassigned', 'feature_positions': [
+                                             {'beg_seq_id': 1, 'end_seq_id': length,
+                                              'values': [round(rng.random(), 3) for _ in range(min(length, 400))]}]}
+                                        for _ in range(count(rng, 3, 0, 8))],
+    }
+    if rng.random() < 0.6:
+        host, host_id = rng.choice(hosts)
+        data['rcsb_entity_host_organism'] = [{'ncbi_scientific_name': host, 'ncbi_taxonomy_id': host_id,
+                                              'provenance_source': 'Primary Data', 'taxonomy_lineage': lineage[:10]}]
+    return data
+
+
+def data_ids(rng):
+    return rng.sample(string.ascii_uppercase, rng.randint(1, 6))
+
+
+def emdb_document(seed, index, pdb_ids):
+    """An EMDB entry as returned by the EMDB API; pdb_ids are the models fitted to it"""
+    rng = document_rng(seed, 'emdb', emdb_id(index))
+    box = rng.choice([128, 192, 256, 320, 384, 448, 512])
+    spacing = round(rng.uniform(0.6, 1.8), 3)
+    components = [{'name': rng.choice(['HEPES', 'sodium chloride', 'DTT', 'magnesium chloride', 'TCEP', 'Tris']),
+                   'formula': rng.choice(['NaCl', 'MgCl2', 'C8H18N2O4S']),
+                   'concentration': with_units(rng.choice([1, 5, 20, 50, 150]), 'mM')}
+                  for _ in range(count(rng, 3, 1, 10))]
+    macromolecules = [{'id': i + 1, 'name': {'valueOf_': title(rng, 2, 5)},
+                       'sequence': {'string': ''.join(rng.choices(amino_acids, k=count(rng, 300, 20, 3000)))}}
+                      for i in range(count(rng, 2.5, 1, 30))]
+    return {
+        'emdb_id': emdb_id(index),
+        'admin': {'title': title(rng, 6, 20), 'status_history_list': {'item': [{'code': 'REL', 'date': date(rng, 2010)}]},
+                  'authors_list': {'author': [{'valueOf_': title(rng, 2, 2)} for _ in range(count(rng, 8, 1, 60))]},
+                  'keywords': ', '.join(rng.sample(words, 5))},
+        'crossreferences': {'pdb_list': {'pdb_reference': [{'pdb_id': p.lower(), 'relationship': {'in_frame': 'FULLOVERLAP'}}
+                                                           for p in pdb_ids]},
+                            'citation_list': {'primary_citation': {'journal_citation': {'title': title(rng, 6, 20)}}}},
+        'map': {'format': 'CCP4', 'data_type': 'IMAGE STORED AS FLOATING POINT NUMBER (4 BYTES)',
+                'dimensions': {'col': box, 'row': box, 'sec': box},
+                'pixel_spacing': {axis: with_units(spacing, 'A') for axis in ('x', 'y', 'z')},
+                'contour_list': {'contour': [{'level': round(rng.uniform(0.01, 0.2), 4), 'primary': True}]},
+                'statistics': {'minimum': -0.5, 'maximum': 1.5, 'average': 0.001, 'std': 0.02}},
+        'sample': {'name': {'valueOf_': title(rng, 2, 5)}, 'macromolecule_list': {'macromolecule': macromolecules}},
+        'structure_determination_list': {'structure_determination': [{
+            'method': 'singleParticle', 'aggregation_state': 'particle',
+            'specimen_preparation_list': {'specimen_preparation': [{
+                'concentration': with_units(round(rng.uniform(0.1, 10), 2), 'mg/mL'),
+                'details': title(rng, 0, 10),
+                'buffer': {'ph': round(rng.uniform(5.5, 8.5), 1), 'component': components, 'details': title(rng, 0, 6)},
+                'grid': {'model': rng.choice(['Quantifoil R1.2/1.3', 'C-flat-1.2/1.3', 'UltrAuFoil R1.2/1.3']),
+                         'material': rng.choice(['COPPER', 'GOLD']), 'mesh': rng.choice([200, 300, 400]),
+                         'details': '', 'pretreatment': {'type_': 'GLOW DISCHARGE', 'atmosphere': 'AIR',
+                                                         'time': with_units(rng.choice([30, 45, 60]), 'sec.'),
+                                                         'pressure': with_units(0.039, 'kPa')}},
+                'vitrification': {'cryogen_name': 'ETHANE', 'chamber_humidity': with_units(100, 'percentage'),
+                                  'chamber_temperature': with_units(4, 'K'), 'instrument': 'FEI VITROBOT MARK IV'},
+            }]},
+            'microscopy_list': {'microscopy': [{
+                'microscope': rng.choice(microscopes), 'illumination_mode': 'FLOOD BEAM', 'imaging_mode': 'BRIGHT FIELD',
+                'electron_source': 'FIELD EMISSION GUN', 'acceleration_voltage': with_units(rng.choice([200, 300]), 'kV'),
+                'c2_aperture_diameter': with_units(50, 'µm'), 'nominal_cs': with_units(2.7, 'mm'),
+                'nominal_defocus_min': with_units(0.8, 'µm'), 'nominal_defocus_max': with_units(2.5, 'µm'),
+                'calibrated_magnification': rng.randint(40000, 130000), 'specimen_holder_model': 'FEI TITAN KRIOS AUTOGRID HOLDER',
+                'cooling_holder_cryogen': 'NITROGEN', 'alignment_procedure': {'coma_free': {'residual_tilt': with_units(0.1, 'mrad')}},
+                'image_recording_list': {'image_recording': [{
+                    'film_or_detector_model': {'valueOf_': rng.choice(detectors), 'category': 'DIRECT ELECTRON DETECTOR'},
+                    'number_real_images': rng.randint(1000, 30000),
+                    'average_electron_dose_per_image': with_units(round(rng.uniform(40, 70), 1), 'e/Å^2'),
+                }]},
+            }]},
+            'image_processing': [{
+                'final_reconstruction': {'resolution': with_units(round(rng.uniform(1.8, 8), 2), 'Å'),
+                                         'resolution_method': 'FSC 0.143 CUT-OFF', 'number_images_used': rng.randint(10 ** 4, 10 ** 6),
+                                         'applied_symmetry': {'point_group': rng.choice(symmetries)}},
+                'particle_selection': [{'number_selected': rng.randint(10 ** 5, 10 ** 7)}],
+                'ctf_correction': {'software_list': {'software': [{'name': 'CTFFIND'}]}},
+            }],
+        }]},
+    }
+
+
+def empiar_document(seed, index, emdb_ids):
+    """An EMPIAR entry as returned by the EMPIAR API, keyed by its accession"""
+    rng = document_rng(seed, 'empiar', empiar_id(index))
+    return {empiar_id(index): {
+        'title': title(rng, 6, 20), 'release_date': date(rng, 2013)[:10], 'update_date': date(rng, 2014)[:10],
+        'scale': rng.choice(['molecule', 'cell', 'tissue']),
+        'cross_references': [{'name': e} for e in emdb_ids],
+        'imagesets': [{'name': title(rng, 2, 5), 'directory': f"/data/{i}", 'category': 'micrographs - multiframe',
+                       'image_width': 5760, 'image_height': 4092, 'frames_per_image': 40, 'num_images_or_tilt_series': rng.randint(100, 20000)}
+                      for i in range(count(rng, 2, 1, 10))],
+        'authors': [{'author': {'name': title(rng, 2, 2), 'order_id': i}} for i in range(count(rng, 6, 1, 40))],
+    }}
+
+
+def corpus_layout(seed, entries, em_fraction, empiar_fraction):
+    """
+    Cross-references of a corpus: which entries are EM and their maps, which maps have EMPIAR entries
+
+    Returns:
+        (dict of entry index -> list of EMDB IDs, dict of EMDB index -> list of PDB IDs,
+         list of (EMPIAR index, EMDB index))
+    """
+    entry_maps = {}
+    map_models = {}
+    rng = random.Random(f"{seed}:layout")
+    for index in range(entries):
+        if rng.random() >= em_fraction:
+            continue
+        maps = []
+        for _ in range(emdb_count(seed, index)):
+            maps.append(emdb_id(len(map_models)))
+            map_models[len(map_models)] = [pdb_id(index)]
+        entry_maps[index] = maps
+    # About as many maps again have no model, as in the archive
+    for _ in range(len(map_models) // 2):
+        map_models[len(map_models)] = []
+    empiar = [(i, e) for i, e in enumerate(e for e in map_models if rng.random() < empiar_fraction)]
+    return entry_maps, map_models, empiar
+
+
+def write_document(path, data):
+    # Compact, as the pullers store the response bodies unchanged
+    with open(path, 'w') as f:
+        f.write(json.dumps(data, separators=(',', ':')))
+
+
+def write_chunk(task):
+    """Worker: write one chunk of documents, returning (files, bytes)"""
+    output, seed, kind, items = task
+    files = 0
+    size = 0
+    for item in items:
+        if kind == 'entry':
+            index, maps = item
+            path = os.path.join(output, 'entry', f"response_entry_{pdb_id(index)}.json")
+            write_document(path, entry_document(seed, index, maps))
+            paths = [path]
+            paths += write_entities(output, seed, index)
+        elif kind == 'emdb':
+            index, models = item
+            path = os.path.join(output, 'emdb', f"response_emdb_{emdb_id(index)}.json")
+            write_document(path, emdb_document(seed, index, models))
+            paths = [path]
+        else:
+            index, map_index = item
+            path = os.path.join(output, 'empiar', f"response_empiar_{emdb_id(map_index)}.json")
+            write_document(path, empiar_document(seed, index, [emdb_id(map_index)]))
+            paths = [path]
+        files += len(paths)
+        size += sum(os.path.getsize(p) for p in paths)
+    return files, size
+
+
+def write_entities(output, seed, index):
+    paths = []
+    for entity_id in range(1, entity_count(seed, index) + 1):
+        path = os.path.join(output, 'entity', f"response_entry_{pdb_id(index)}_{entity_id}.json")
+        write_document(path, entity_document(seed, index, entity_id))
+        paths.append(path)
+    return paths
+
+
+def generate_corpus(output, entries, seed=0, em_fraction=default_em_fraction,
+                    empiar_fraction=default_empiar_fraction, processes=None):
+    """
+    Write a synthetic corpus under output
+
+    Args:
+        output: Corpus directory; entry/, entity/, emdb/ and empiar/ are created in it
+        entries: Number of PDB entries (the other directories scale with it)
+        seed: Corpus seed; the same seed and sizes give the same files
+        em_fraction: Share of the entries solved by EM, each with one or two maps
+        empiar_fraction: Share of the maps with raw data in EMPIAR
+        processes: Worker processes, None for one per core
+
+    Returns:
+        Manifest dictionary, also saved as corpus.json in output
+    """
+    if entries > max_entries:
+        raise ValueError(f"At most {max_entries} entries can be generated")
+    for kind in ('entry', 'entity', 'emdb', 'empiar'):
+        os.makedirs(os.path.join(output, kind), exist_ok=True)
+
+    start = time.time()
+    entry_maps, map_models, empiar = corpus_layout(seed, entries, em_fraction, empiar_fraction)
+    work = [('entry', [(i, entry_maps.get(i, [])) for i in range(entries)]),
+            ('emdb', sorted(map_models.items())),
+            ('empiar', empiar)]
+    tasks = [(output, seed, kind, items[i:i + chunk_size]) for kind, items in work
+             for i in range(0, len(items), chunk_size)]
+
+    files = 0
+    size = 0
+    with mp.Pool(processes=processes) as pool:
+        for done, (chunk_files, chunk_bytes) in enumerate(pool.imap_unordered(write_chunk, tasks), start=1):
+            files += chunk_files
+            size += chunk_bytes
+            if done % 100 == 0 or done == len(tasks):
+                print(f"Wrote {files} files ({size / 1e9:.2f} GB), {done} of {len(tasks)} chunks")
+
+    manifest = {
+        'seed': seed, 'entries': entries, 'em_fraction': em_fraction, 'empiar_fraction': empiar_fraction,
+        'files': {kind: len(os.listdir(os.path.join(output, kind))) for kind in ('entry', 'entity', 'emdb', 'empiar')},
+        'bytes': size, 'seconds': round(time.time() - start, 1),
+    }
+    with open(os.path.join(output, 'corpus.json'), 'w') as f:
+        json.dump(manifest, f, indent=4)
+    return manifest
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Write a synthetic RCSB / EMDB / EMPIAR JSON corpus")
+    parser.add_argument('--output', required=True, help="Corpus directory")
+    parser.add_argument('--entries', type=int, default=10000,
+                        help="PDB entries; the corpus has about 3.3 files per entry in total")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--em-fraction', type=float, default=default_em_fraction)
+    parser.add_argument('--empiar-fraction', type=float, default=default_empiar_fraction)
+    parser.add_argument('--processes', type=int, default=None, help="Worker processes (default: one per core)")
+    args = parser.parse_args()
+
+    manifest = generate_corpus(args.output, args.entries, args.seed, args.em_fraction,
+                               args.empiar_fraction, args.processes)
+    print(f"Corpus written to {args.output}: "
+          + ', '.join(f"{n} {kind}" for kind, n in manifest['files'].items())
+          + f", {manifest['bytes'] / 1e9:.2f} GB in {manifest['seconds']} s")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,51 @@
+import asyncio
+import os
+import sys
+import threading
+import pytest
+from aiohttp import web
+
+# The scripts are flat modules in the repository root
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from mock_archive_server import make_app, stats_key  # noqa: E402
+
+
+class MockServer:
+    """mock_archive_server.make_app running on a free local port in a background thread"""
+
+    def __init__(self, *args, **kwargs):
+        self.app = make_app(*args, **kwargs)
+        self.loop = asyncio.new_event_loop()
+        self.runner = web.AppRunner(self.app)
+        self.loop.run_until_complete(self.runner.setup())
+        site = web.TCPSite(self.runner, '127.0.0.1', 0)
+        self.loop.run_until_complete(site.start())
+        self.url = f"http://127.0.0.1:{self.runner.addresses[0][1]}"
+        self.thread = threading.Thread(target=self.loop.run_forever, daemon=True)
+        self.thread.start()
+
+    def statuses(self):
+        return dict(self.app[stats_key])
+
+    def stop(self):
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+        self.loop.run_until_complete(self.runner.cleanup())
+        self.loop.close()
+
+
+@pytest.fixture
+def mock_server():
+    """Start a mock archive server with make_app's arguments; stopped after the test"""
+    servers = []
+
+    def start(*args, **kwargs):
+        server = MockServer(*args, **kwargs)
+        servers.append(server)
+        return server
+
+    yield start
+    for server in servers:
+        server.stop()
+
@@ -0,0 +1,42 @@
+import os
+import time
+import pandas as pd
+from catalog import Catalog, CatalogTable
+
+
+def write_csv(path, emdb_ids, mtime=None):
+    pd.DataFrame({'emdb_id': emdb_ids, 'title': [f'Map {i}' for i in emdb_ids]}).to_csv(path, index=False)
+    if mtime is not None:
+        os.utime(path, (mtime, mtime))
+
+
+def test_missing_table_is_loaded_from_csv(tmp_path):
+    csv_path = tmp_path / 'emdb.csv'
+    write_csv(csv_path, ['EMD-1', 'EMD-2'])
+    catalog = Catalog(str(tmp_path / 'catalog.sqlite'))
+
+    assert catalog.load_csv_if_newer('emdb', csv_path) == 2
+    assert catalog.load_csv_if_newer('emdb', csv_path) is None
+    assert catalog.count('emdb') == 2
+    catalog.close()
+
+
+def test_table_older_than_csv_is_reloaded(tmp_path):
+    csv_path = tmp_path / 'emdb.csv'
+    catalog_path = str(tmp_path / 'catalog.sqlite')
+    # The extractor loaded the catalog on its first run...
+    write_csv(csv_path, ['EMD-1', 'EMD-2'], mtime=time.time() - 60)
+    table = CatalogTable('emdb', replace=True, path=catalog_path)
+    table.write_frame(pd.read_csv(csv_path, dtype=str))
+    table.close()
+
+    catalog = Catalog(catalog_path)
+    assert catalog.load_csv_if_newer('emdb', csv_path) is None
+
+    # ...and only wrote its CSV on the next one
+    write_csv(csv_path, ['EMD-2', 'EMD-3', 'EMD-4'], mtime=time.time() + 60)
+    assert catalog.load_csv_if_newer('emdb', csv_path) == 3
+    catalog.refresh_views()
+    merged = [r[0] for r in catalog.conn.execute("SELECT emdb_id FROM emdb_pdb_merged")]
+    assert merged == ['EMD-2', 'EMD-3', 'EMD-4']
+    catalog.close()
@@ -0,0 +1,51 @@
+import os
+import pytest
+import file_inventory
+from incremental_extract import fingerprints
+from record_store import list_records
+
+
+@pytest.fixture
+def json_folder(tmp_path, monkeypatch):
+    monkeypatch.setattr(file_inventory, 'default_index_path', str(tmp_path / 'inventory.sqlite'))
+    folder = tmp_path / 'json'
+    folder.mkdir()
+    for i in range(3):
+        (folder / f'response_entry_1AA{i}.json').write_text('{}')
+    return folder
+
+
+def age_directory(folder, seconds):
+    # Directories modified within racy_seconds of a scan are never trusted
+    mtime = os.stat(folder).st_mtime - seconds
+    os.utime(folder, (mtime, mtime))
+
+
+def test_unchanged_directory_is_not_walked_again(json_folder, monkeypatch):
+    age_directory(json_folder, 3600)
+    records = list_records(str(json_folder))
+    first = fingerprints(records)
+    assert sorted(first) == [r.name for r in records]
+
+    def no_walk(*args, **kwargs):
+        raise AssertionError("directory walked although it did not change")
+
+    monkeypatch.setattr(file_inventory, 'scan_directory', no_walk)
+    assert fingerprints(list_records(str(json_folder))) == first
+
+
+def test_replaced_file_gets_a_new_fingerprint(json_folder):
+    age_directory(json_folder, 3600)
+    first = fingerprints(list_records(str(json_folder)))
+
+    # Written the way the pullers save a refreshed record
+    path = json_folder / 'response_entry_1AA1.json'
+    (json_folder / 'response_entry_1AA1.json.tmp').write_text('{"changed": true}')
+    os.replace(str(path) + '.tmp', path)
+    age_directory(json_folder, 1800)
+
+    # list_records refreshes the listing without re-stating known names first
+    second = fingerprints(list_records(str(json_folder)))
+    assert second['response_entry_1AA1.json'] != first['response_entry_1AA1.json']
+    assert second['response_entry_1AA1.json'][0] == len('{"changed": true}')
+    assert second['response_entry_1AA0.json'] == first['response_entry_1AA0.json']
@@ -0,0 +1,153 @@
+import json
+import os
+import time
+from fetch_engine import run_fetch
+from fetch_manifest import OBSOLETE, OK, PENDING, FetchManifest
+from incremental_refresh import plan_entity_refresh, plan_pdb_entry_refresh, plan_revalidation
+from retry_scheduler import RetryScheduler
+
+source = 'emdb'
+
+
+def write_payload(directory, record_id, record, mtime=None):
+    path = os.path.join(directory, f'response_entry_{record_id}.json')
+    with open(path, 'w') as f:
+        json.dump(record, f)
+    if mtime is not None:
+        os.utime(path, (mtime, mtime))
+    return path
+
+
+def status_of(manifest, record_id, column='status', source_name=source):
+    return manifest.conn.execute(f"SELECT {column} FROM fetches WHERE source = ? AND record_id = ?",
+                                 (source_name, record_id)).fetchone()[0]
+
+
+def pull(manifest, server, output, record_ids):
+    """One conditional pass over the pending IDs, as the pull scripts run it"""
+    jobs = [(i, f"{server.url}/rest/v1/core/entry/{i}", os.path.join(output, f'response_entry_{i}.json'))
+            for i in manifest.pending(source, record_ids)]
+    return run_fetch(jobs, manifest=manifest, source=source, conditional=True,
+                     retry=RetryScheduler(max_attempts=1))
+
+
+def setup_pull(tmp_path, mock_server, record_ids):
+    payloads, output = tmp_path / 'payloads', tmp_path / 'output'
+    payloads.mkdir()
+    output.mkdir()
+    for record_id in record_ids:
+        write_payload(payloads, record_id, {'rcsb_id': record_id, 'version': 1}, mtime=time.time() - 3600)
+    server = mock_server(str(payloads))
+    manifest = FetchManifest(str(tmp_path / 'manifest.sqlite'))
+    manifest.register(source, record_ids)
+    assert pull(manifest, server, str(output), record_ids) == {i: 200 for i in record_ids}
+    # Push the first pull into the past so a change of last_changed would show
+    manifest.conn.execute("UPDATE fetches SET last_changed = '2000-01-01T00:00:00'")
+    manifest.commit()
+    return payloads, output, server, manifest
+
+
+def test_unchanged_record_answers_304_and_is_left_alone(tmp_path, mock_server):
+    payloads, output, server, manifest = setup_pull(tmp_path, mock_server, ['1AAA'])
+    saved = output / 'response_entry_1AAA.json'
+    os.utime(saved, (1000000000, 1000000000))
+    content = saved.read_bytes()
+
+    plan_revalidation(manifest, source, ['1AAA'])
+    assert manifest.pending(source) == ['1AAA']
+    assert pull(manifest, server, str(output), ['1AAA']) == {'1AAA': 304}
+
+    assert server.statuses() == {200: 1, 304: 1}
+    assert saved.read_bytes() == content
+    assert os.path.getmtime(saved) == 1000000000
+    assert status_of(manifest, '1AAA') == OK
+    assert status_of(manifest, '1AAA', 'http_code') == 304
+    assert status_of(manifest, '1AAA', 'last_changed') == '2000-01-01T00:00:00'
+    manifest.close()
+
+
+def test_changed_payload_is_downloaded_again(tmp_path, mock_server):
+    payloads, output, server, manifest = setup_pull(tmp_path, mock_server, ['1AAA', '1AAB'])
+    write_payload(payloads, '1AAB', {'rcsb_id': '1AAB', 'version': 2})
+
+    plan_revalidation(manifest, source, ['1AAA', '1AAB'])
+    assert pull(manifest, server, str(output), ['1AAA', '1AAB']) == {'1AAA': 304, '1AAB': 200}
+
+    with open(output / 'response_entry_1AAB.json') as f:
+        assert json.load(f)['version'] == 2
+    assert status_of(manifest, '1AAA', 'last_changed') == '2000-01-01T00:00:00'
+    assert status_of(manifest, '1AAB', 'last_changed') > '2000-01-01T00:00:00'
+    manifest.close()
+
+
+def test_withdrawn_record_is_marked_obsolete(tmp_path, mock_server):
+    payloads, output, server, manifest = setup_pull(tmp_path, mock_server, ['1AAA', '1AAB'])
+    os.remove(payloads / 'response_entry_1AAB.json')
+
+    plan_revalidation(manifest, source, ['1AAA', '1AAB'])
+    assert pull(manifest, server, str(output), ['1AAA', '1AAB']) == {'1AAA': 304, '1AAB': 404}
+
+    assert status_of(manifest, '1AAB') == OBSOLETE
+    assert manifest.not_fetched(source, ['1AAA', '1AAB']) == []
+    manifest.close()
+
+
+def test_revalidation_only_queues_fetched_ids(tmp_path, mock_server):
+    payloads, output, server, manifest = setup_pull(tmp_path, mock_server, ['1AAA', '1AAB'])
+    manifest.register(source, ['1AAC'])
+
+    # Only the requested IDs that were fetched before are revalidated; new ones stay pending
+    plan_revalidation(manifest, source, ['1AAA', '1AAC'])
+    assert sorted(manifest.pending(source)) == ['1AAA', '1AAC']
+    assert status_of(manifest, '1AAB') == OK
+    manifest.close()
+
+
+def test_entry_refresh_picks_new_revised_and_withdrawn_entries(tmp_path, mock_server):
+    payloads = tmp_path / 'payloads'
+    payloads.mkdir()
+    old = time.mktime((2019, 6, 1, 0, 0, 0, 0, 0, -1))
+    for pdb_id in ('1AAA', '1AAB', '1AAC'):
+        write_payload(payloads, pdb_id, {'rcsb_id': pdb_id}, mtime=old)
+    # 1AAB was revised after the last pull, 1AAD is new and 1AAC was withdrawn
+    write_payload(payloads, '1AAB', {'rcsb_id': '1AAB', 'version': 2})
+    write_payload(payloads, '1AAD', {'rcsb_id': '1AAD'})
+    os.remove(payloads / 'response_entry_1AAC.json')
+    server = mock_server(str(payloads), removed_ids=['1AAC'])
+
+    manifest = FetchManifest(str(tmp_path / 'manifest.sqlite'))
+    for pdb_id in ('1AAA', '1AAB', '1AAC'):
+        manifest.record('pdb_entry', pdb_id, 200, b'{}')
+    manifest.conn.execute("UPDATE fetches SET last_success = '2020-01-01T00:00:00'")
+    manifest.commit()
+
+    all_ids = plan_pdb_entry_refresh(manifest, 'pdb_entry', ['1AAA', '1AAB', '1AAC'],
+                                     f"{server.url}/rest/v1/holdings", f"{server.url}/rcsbsearch/v2/query")
+
+    assert sorted(all_ids) == ['1AAA', '1AAB', '1AAD']
+    assert sorted(manifest.pending('pdb_entry')) == ['1AAB', '1AAD']
+    assert status_of(manifest, '1AAA', source_name='pdb_entry') == OK
+    assert status_of(manifest, '1AAC', source_name='pdb_entry') == OBSOLETE
+    manifest.close()
+
+
+def test_entity_refresh_follows_changed_and_withdrawn_entries(tmp_path):
+    manifest = FetchManifest(str(tmp_path / 'manifest.sqlite'))
+    for pdb_id in ('1AAA', '1AAB', '1AAC'):
+        manifest.record('pdb_entry', pdb_id, 200, b'{}')
+    for record_id in ('1AAA_1', '1AAB_1', '1AAB_2', '1AAC_1'):
+        manifest.record('pdb_entity', record_id, 200, b'{}')
+    manifest.conn.execute("UPDATE fetches SET last_success = '2020-01-01T00:00:00', "
+                          "last_changed = '2019-01-01T00:00:00'")
+    # 1AAB changed after its entities were fetched, 1AAC was withdrawn
+    manifest.conn.execute("UPDATE fetches SET last_changed = '2021-01-01T00:00:00' "
+                          "WHERE source = 'pdb_entry' AND record_id = '1AAB'")
+    manifest.mark_obsolete('pdb_entry', ['1AAC'])
+
+    plan_entity_refresh(manifest, 'pdb_entry', 'pdb_entity')
+
+    assert sorted(manifest.pending('pdb_entity')) == ['1AAB_1', '1AAB_2']
+    assert status_of(manifest, '1AAA_1', source_name='pdb_entity') == OK
+    assert status_of(manifest, '1AAC_1', source_name='pdb_entity') == OBSOLETE
+    assert PENDING not in manifest.progress('pdb_entry')
+    manifest.close()
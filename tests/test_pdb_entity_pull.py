@@ -0,0 +1,38 @@
+import json
+import os
+import pytest
+import pdb_entity_pull
+from fetch_manifest import MISSING, OK, FetchManifest
+
+
+@pytest.fixture
+def entity_server(tmp_path, mock_server, monkeypatch):
+    payloads, output = tmp_path / 'payloads', tmp_path / 'output'
+    payloads.mkdir()
+    output.mkdir()
+    # 1AAA has two polymer entities, 1AAB one
+    for record_id in ('1AAA_1', '1AAA_2', '1AAB_1'):
+        with open(payloads / f'response_entry_{record_id}.json', 'w') as f:
+            json.dump({'rcsb_id': record_id}, f)
+    server = mock_server(str(payloads))
+    monkeypatch.setattr(pdb_entity_pull, 'rcsb_base_url', server.url)
+    monkeypatch.setattr(pdb_entity_pull, 'output', str(output))
+    return server, output
+
+
+def test_probing_skips_entities_finished_in_an_earlier_run(tmp_path, entity_server):
+    server, output = entity_server
+    manifest = FetchManifest(str(tmp_path / 'manifest.sqlite'))
+
+    assert pdb_entity_pull.pull_by_probing(['1AAA', '1AAB'], manifest) == []
+    assert sorted(os.listdir(output)) == ['response_entry_1AAA_1.json', 'response_entry_1AAA_2.json',
+                                          'response_entry_1AAB_1.json']
+    assert sorted(manifest.ids('pdb_entity', OK)) == ['1AAA_1', '1AAA_2', '1AAB_1']
+    assert sorted(manifest.ids('pdb_entity', MISSING)) == ['1AAA_3', '1AAB_2']
+    first = server.statuses()
+    assert first == {200: 3, 404: 2}
+
+    # A second run walks the same rounds from the manifest without a request
+    assert pdb_entity_pull.pull_by_probing(['1AAA', '1AAB'], manifest) == []
+    assert server.statuses() == first
+    manifest.close()
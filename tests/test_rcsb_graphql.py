@@ -0,0 +1,162 @@
+import ast
+import json
+import os
+from field_spec import FieldSpec
+from mock_archive_server import no_faults
+from rcsb_graphql import run_graphql_fetch, split_response
+from record_decoding import RecordDecoder
+from retry_scheduler import RetryScheduler
+from synthetic_corpus import entry_document
+
+repo = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def entry_record(pdb_id):
+    return {'rcsb_id': pdb_id.upper(), 'rcsb_entry_container_identifiers': {'entry_id': pdb_id.upper()}}
+
+
+def write_payloads(directory, pdb_ids):
+    for pdb_id in pdb_ids:
+        with open(os.path.join(directory, f'response_entry_{pdb_id}.json'), 'w') as f:
+            json.dump(entry_record(pdb_id), f)
+
+
+def test_split_response_maps_upper_case_ids_back():
+    payload = {'data': {'entries': [entry_record('4hhb'), entry_record('1abc')]}}
+    found, missing = split_response('entry', payload, ['4hhb', '1ABC'])
+    assert sorted(found) == ['1ABC', '4hhb']
+    assert found['4hhb']['rcsb_id'] == '4HHB'
+    assert missing == []
+
+
+def test_split_response_reports_missing_ids():
+    payload = {'data': {'entries': [entry_record('4HHB'), None, {'struct': {}}]}}
+    found, missing = split_response('entry', payload, ['4HHB', '9ZZZ'])
+    assert list(found) == ['4HHB']
+    assert missing == ['9ZZZ']
+
+
+def test_split_response_without_data():
+    found, missing = split_response('polymer_entity', {'data': None, 'errors': [{}]}, ['4HHB_1', '4HHB_2'])
+    assert found == {}
+    assert missing == ['4HHB_1', '4HHB_2']
+
+
+def test_missing_ids_are_finished_as_404(tmp_path, mock_server):
+    payloads, output = tmp_path / 'payloads', tmp_path / 'output'
+    payloads.mkdir()
+    output.mkdir()
+    write_payloads(payloads, ['1AAA', '1AAB'])
+    server = mock_server(str(payloads))
+
+    results = run_graphql_fetch(['1AAA', '1AAB', '9ZZZ'], 'entry', str(output), url=f"{server.url}/graphql")
+
+    assert results == {'1AAA': 200, '1AAB': 200, '9ZZZ': 404}
+    assert sorted(os.listdir(output)) == ['response_entry_1AAA.json', 'response_entry_1AAB.json']
+    assert server.statuses() == {200: 1}
+
+
+def test_failing_batch_is_split_and_good_ids_are_written(tmp_path, mock_server):
+    payloads, output = tmp_path / 'payloads', tmp_path / 'output'
+    payloads.mkdir()
+    output.mkdir()
+    pdb_ids = [f'1A{i:02d}' for i in range(8)]
+    write_payloads(payloads, pdb_ids)
+    server = mock_server(str(payloads), fail_ids=['1A05'])
+
+    retry = RetryScheduler(max_attempts=2, base_delay=0.01)
+    results = run_graphql_fetch(pdb_ids, 'entry', str(output), batch_size=8, url=f"{server.url}/graphql",
+                                retry=retry)
+
+    assert results.pop('1A05') is None
+    assert results == {pdb_id: 200 for pdb_id in pdb_ids if pdb_id != '1A05'}
+    for pdb_id in results:
+        with open(output / f'response_entry_{pdb_id}.json') as f:
+            assert json.load(f)['rcsb_entry_container_identifiers']['entry_id'] == pdb_id
+    assert not (output / 'response_entry_1A05.json').exists()
+    # 8 -> 4 -> 2 -> 1: only the halves holding the bad ID come back without data,
+    # and those are split at once rather than retried
+    assert server.statuses() == {200: 7}
+
+
+def test_server_errors_are_retried_before_splitting(tmp_path, mock_server):
+    payloads, output = tmp_path / 'payloads', tmp_path / 'output'
+    payloads.mkdir()
+    output.mkdir()
+    pdb_ids = [f'1B{i:02d}' for i in range(8)]
+    write_payloads(payloads, pdb_ids)
+    # Half of all requests answer 500, 502 or 503, like a flapping gateway
+    server = mock_server(str(payloads), faults=no_faults._replace(error_rate=0.5, retry_after=0), seed=3)
+
+    retry = RetryScheduler(max_attempts=10, base_delay=0.01)
+    results = run_graphql_fetch(pdb_ids, 'entry', str(output), batch_size=8, url=f"{server.url}/graphql",
+                                retry=retry)
+
+    assert results == {pdb_id: 200 for pdb_id in pdb_ids}
+    # The whole batch was resent until it went through, never split
+    statuses = server.statuses()
+    assert statuses.pop(200) == 1
+    assert sum(statuses.values()) >= 1
+
+
+def entry_extract_spec():
+    """
+    The FieldSpec of pdb_entry_extract_v2.py, built from the script's own column lists
+
+    The script runs its extraction on import, so only the statements from
+    citation_columns to entry_fields are executed.
+    """
+    with open(os.path.join(repo, 'pdb_entry_extract_v2.py')) as f:
+        body = ast.parse(f.read()).body
+    names = [node.targets[0].id if isinstance(node, ast.Assign) else None for node in body]
+    statements = body[names.index('citation_columns'):names.index('entry_fields') + 1]
+    namespace = {'FieldSpec': FieldSpec}
+    exec(compile(ast.Module(body=statements, type_ignores=[]), 'pdb_entry_extract_v2.py', 'exec'), namespace)
+    return namespace['entry_fields']
+
+
+def test_graphql_records_fill_the_entry_extractor_columns(tmp_path, mock_server):
+    payloads, output = tmp_path / 'payloads', tmp_path / 'output'
+    payloads.mkdir()
+    output.mkdir()
+    # An X-ray entry, so the refine table has a row too
+    index = next(i for i in range(100) if 'refine' in entry_document(0, i, []))
+    document = entry_document(0, index, [])
+    pdb_id = document['rcsb_entry_container_identifiers']['entry_id']
+    # Real REST documents carry rcsb_id at the top, the synthetic ones only in the identifiers
+    document['rcsb_id'] = pdb_id
+    with open(payloads / f'response_entry_{pdb_id}.json', 'w') as f:
+        json.dump(document, f)
+    server = mock_server(str(payloads))
+
+    assert run_graphql_fetch([pdb_id], 'entry', str(output), url=f"{server.url}/graphql") == {pdb_id: 200}
+
+    spec = entry_extract_spec()
+    decoder = RecordDecoder('entry')
+    with open(output / f'response_entry_{pdb_id}.json', 'rb') as f:
+        row = spec(decoder.decode(f.read()))
+    # The aliased selection gives the same row as the REST document
+    assert row == spec(document)
+    # Columns whose GraphQL names are spelled differently from REST
+    for column in ('journal_id_astm', 'pdbx_database_id_doi', 'pdbx_database_id_pub_med', 'ls_rfactor_rfree',
+                   'ls_dres_high', 'biso_mean', 'polymer_entity_count_dna', 'diffrn_resolution_high_value'):
+        assert row[column] is not None, column
+    assert row['diffrn_resolution_high_value'] == document['rcsb_entry_info']['diffrn_resolution_high']['value']
+
+
+def test_throttled_batch_fails_whole_once_retries_run_out(tmp_path, mock_server):
+    payloads, output = tmp_path / 'payloads', tmp_path / 'output'
+    payloads.mkdir()
+    output.mkdir()
+    pdb_ids = [f'1C{i:02d}' for i in range(8)]
+    write_payloads(payloads, pdb_ids)
+    server = mock_server(str(payloads), faults=no_faults._replace(throttle_rate=1.0, retry_after=0))
+
+    retry = RetryScheduler(max_attempts=3, base_delay=0.01)
+    results = run_graphql_fetch(pdb_ids, 'entry', str(output), batch_size=8, url=f"{server.url}/graphql",
+                                retry=retry)
+
+    assert results == {pdb_id: 429 for pdb_id in pdb_ids}
+    assert os.listdir(output) == []
+    # The batch is tried max_attempts times and never split into more requests
+    assert server.statuses() == {429: 3}
@@ -0,0 +1,15 @@
+import pytest
+from record_decoding import RecordDecoder, available_backends
+
+
+@pytest.mark.parametrize('backend', available_backends)
+def test_nan_literals_decode_like_json(backend):
+    decoder = RecordDecoder('entry', backend=backend)
+    data = decoder.decode(b'{"rcsb_entry_info": {"molecular_weight": NaN, "resolution_combined": [Infinity]}}')
+    assert data['rcsb_entry_info']['molecular_weight'] != data['rcsb_entry_info']['molecular_weight']
+    assert data['rcsb_entry_info']['resolution_combined'] == [float('inf')]
+
+
+def test_malformed_json_still_fails():
+    with pytest.raises(ValueError):
+        RecordDecoder('entry').decode(b'{"rcsb_entry_info": ')
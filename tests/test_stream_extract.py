@@ -0,0 +1,45 @@
+import os
+from checkpoint import Checkpoint
+from stream_extract import StreamingTableWriter
+
+
+def test_run_killed_after_checkpoint_removal_starts_over(tmp_path):
+    output = str(tmp_path / 'combined.csv')
+    checkpoint = Checkpoint(str(tmp_path / 'combined.checkpoint.sqlite'))
+    table = StreamingTableWriter(output, batch_size=1)
+    table.add({'rcsb_id': '1AAA', 'title': 'First'})
+    checkpoint.done('response_entry_1AAA.json')
+    checkpoint.save(table.checkpoint())
+
+    # The end of a combiner's main, killed before the spool is removed
+    assert table.close(keep_spool=True) == 1
+    assert os.path.exists(table.spool_path)
+    checkpoint.remove()
+
+    # --resume then finds no checkpoint and starts over
+    resumed = Checkpoint(str(tmp_path / 'combined.checkpoint.sqlite'), resume=True)
+    assert resumed.state() is None
+    table = StreamingTableWriter(output, resume_from=resumed.state())
+    assert not os.path.exists(table.spool_path)
+    resumed.remove()
+
+
+def test_resume_from_a_saved_checkpoint_keeps_the_spool(tmp_path):
+    output = str(tmp_path / 'combined.csv')
+    checkpoint = Checkpoint(str(tmp_path / 'combined.checkpoint.sqlite'))
+    table = StreamingTableWriter(output, batch_size=1)
+    table.add({'rcsb_id': '1AAA', 'title': 'First'})
+    checkpoint.done('response_entry_1AAA.json')
+    checkpoint.save(table.checkpoint())
+    # Killed after writing the output but before the checkpoint was removed
+    table.close(keep_spool=True)
+    checkpoint.close()
+
+    resumed = Checkpoint(str(tmp_path / 'combined.checkpoint.sqlite'), resume=True)
+    table = StreamingTableWriter(output, batch_size=1, resume_from=resumed.state())
+    table.add({'rcsb_id': '1AAB', 'title': 'Second'})
+    assert table.close() == 2
+    resumed.remove()
+    with open(output) as f:
+        assert f.read().splitlines() == ['rcsb_id,title', '1AAA,First', '1AAB,Second']
+    assert not os.path.exists(table.spool_path)
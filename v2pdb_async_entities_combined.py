@@ -1,13 +1,21 @@
+import argparse
 import os
 import json
 import pandas as pd
 from collections import defaultdict
 import csv
 import multiprocessing as mp
-from functools import partial
 import time
+from checkpoint import Checkpoint
+from incremental_extract import ExtractionState
+from metrics import RunMetrics
+from progress import ErrorLog, Progress, error_log_path, get_logger
+from record_store import list_records, load_json
+from stream_extract import StreamingTableWriter, rows_to_columns
 
-# Set the folder path where the JSON files are located
+# Set the folder path where the JSON files are located. Every key becomes a column,
+# so these must be REST pulls: GraphQL records (rcsb_graphql.py) only hold the
+# fields pdb_entity_extract_v3.py reads
 json_folder = '/kellogg/proj/rrh3749/Working_Projects/AlphaFold/data/pdb_json_entities'
 #json_folder = '/home/zhn1744/AlphaFold/data/pdb/entity'
 json_folder = '/home/zhn1744/AlphaFold/data/pdb/entity/missing'
@@ -16,17 +24,33 @@ json_folder = '/home/zhn1744/AlphaFold/data/pdb/entity/missing'
 combined_output = "/home/zhn1744/AlphaFold/data/pdb/entity/missing/pdb_entities_combined_missing.csv"
 #combined_output = "/kellogg/proj/rrh3749/Working_Projects/AlphaFold/data/pdb_entities_combined_missing.csv"
 failed_output = "/home/zhn1744/AlphaFold/data/failed/pdb_entities_failed.csv"
-temp_dir = "/kellogg/proj/rrh3749/Working_Projects/AlphaFold/data/temp"
 
-# Create temp directory if it doesn't exist
-os.makedirs(temp_dir, exist_ok=True)
+# Upper bound on files per worker task; each task comes back as one columnar
+# block, so this also bounds what a result holds in memory
+max_batch_size = 2000
 
-# Get list of JSON files in the folder
-file_paths = [os.path.join(json_folder, f) for f in os.listdir(json_folder)
-                if f.endswith(".json")]
-#file_paths = file_paths[:25]
-total_files = len(file_paths)
-print(f"Total files to process: {total_files}")
+# "csv", "parquet" or "both"; the Parquet columns are the same sanitized strings as the CSV
+output_format = "csv"
+parquet_output = "/home/zhn1744/AlphaFold/data/pdb/entity/missing/pdb_entities_combined_missing.parquet"
+
+# Progress is saved after at least checkpoint_every files so that a killed run
+# can carry on with --resume instead of starting over
+checkpoint_output = "/home/zhn1744/AlphaFold/data/pdb/entity/missing/pdb_entities_combined_missing.checkpoint.sqlite"
+checkpoint_every = 20000
+
+# Only flatten files that are new or changed since the last run, keeping the
+# rows of every file in state_output (see incremental_extract.py)
+incremental = False
+state_output = "/home/zhn1744/AlphaFold/data/pdb/entity/missing/pdb_entities_combined_missing.state.sqlite"
+
+# Throttled progress lines (see progress.py)
+logger = get_logger('v2pdb_async_entities_combined')
+
+# Get list of JSON records in the folder (plain directory or record store)
+records = list_records(json_folder)
+#records = records[:25]
+total_files = len(records)
+logger.info(f"Total files to process: {total_files}")
 
 # Helper function to sanitize and standardize values
 def sanitize_value(value):
@@ -172,99 +196,102 @@ def extract_fields(data, prefix='', path=None):
     
     return result
 
-def process_file(file_path, batch_id):
-    """Process a single file and return extracted data"""
-    try:
-        # Load the JSON data
-        with open(file_path, "r") as f:
-            data = json.load(f)
-            
-            # Extract entity_id and entry_id from container identifiers
-            entity_id = data.get('rcsb_polymer_entity_container_identifiers', {}).get('entity_id', "")
-            entry_id = data.get('rcsb_polymer_entity_container_identifiers', {}).get('entry_id', "")
-            
-            # For entity files that might not have these fields, extract from rcsb_id
-            if not entry_id and 'rcsb_id' in data:
-                parts = data['rcsb_id'].split('_')
-                if len(parts) >= 2:
-                    entry_id = parts[0]
-                    entity_id = parts[1]
+def flatten_entity(data):
+    """Flatten one polymer entity document into a row"""
+    # Extract entity_id and entry_id from container identifiers
+    entity_id = data.get('rcsb_polymer_entity_container_identifiers', {}).get('entity_id', "")
+    entry_id = data.get('rcsb_polymer_entity_container_identifiers', {}).get('entry_id', "")
+    
+    # For entity files that might not have these fields, extract from rcsb_id
+    if not entry_id and 'rcsb_id' in data:
+        parts = data['rcsb_id'].split('_')
+        if len(parts) >= 2:
+            entry_id = parts[0]
+            entity_id = parts[1]
+    
+    # Create base entry with core identifiers
+    entry_dict = {
+        'entity_id': entity_id,
+        'entry_id': entry_id
+    }
+    
+    # Dynamically extract all fields
+    for key, value in data.items():
+        # Skip fields already in entry_dict
+        if key in entry_dict:
+            continue
             
-            # Create base entry with core identifiers
-            entry_dict = {
-                'entity_id': entity_id,
-                'entry_id': entry_id
-            }
+        # Skip certain metadata fields we don't need to process separately
+        if key in ('rcsb_polymer_entity_container_identifiers'):
+            continue
+        
+        # Handle different field types
+        if isinstance(value, dict):
+            # Handle dictionary fields - extract nested structure
+            extracted = extract_fields(value, key)
+            entry_dict.update(extracted)
+        
+        elif isinstance(value, list):
+            # Special handling for special array fields
+            if key in ('taxonomy_lineage', 'rcsb_ec_lineage', 'ncbi_common_names', 
+                'aligned_regions', 'rcsb_macromolecular_names_combined', 
+                'names', 'aligned_target', 'pubmed_ids', 'values',
+                'annotation_lineage', 'rcsb_cluster_membership'):
+                entry_dict[key] = process_special_array(value, key)
             
-            # Dynamically extract all fields
-            for key, value in data.items():
-                # Skip fields already in entry_dict
-                if key in entry_dict:
-                    continue
-                    
-                # Skip certain metadata fields we don't need to process separately
-                if key in ('rcsb_polymer_entity_container_identifiers'):
-                    continue
-                
-                # Handle different field types
-                if isinstance(value, dict):
-                    # Handle dictionary fields - extract nested structure
-                    extracted = extract_fields(value, key)
-                    entry_dict.update(extracted)
-                
-                elif isinstance(value, list):
-                    # Special handling for special array fields
-                    if key in ('taxonomy_lineage', 'rcsb_ec_lineage', 'ncbi_common_names', 
-                        'aligned_regions', 'rcsb_macromolecular_names_combined', 
-                        'names', 'aligned_target', 'pubmed_ids', 'values',
-                        'annotation_lineage', 'rcsb_cluster_membership'):
-                        entry_dict[key] = process_special_array(value, key)
-                    
-                    # For other arrays, take the first element only
-                    elif len(value) > 0:
-                        item = value[0]
-                        if isinstance(item, dict):
-                            for k, v in item.items():
-                                item_key = f"{key}1_{k}"
-                                entry_dict[item_key] = sanitize_value(v)
-                        else:
-                            entry_dict[f"{key}1"] = sanitize_value(item)
-                
+            # For other arrays, take the first element only
+            elif len(value) > 0:
+                item = value[0]
+                if isinstance(item, dict):
+                    for k, v in item.items():
+                        item_key = f"{key}1_{k}"
+                        entry_dict[item_key] = sanitize_value(v)
                 else:
-                    # Simple scalar field
-                    entry_dict[key] = sanitize_value(value)
-            
-            return (entry_dict, None)
-            
+                    entry_dict[f"{key}1"] = sanitize_value(item)
+        
+        else:
+            # Simple scalar field
+            entry_dict[key] = sanitize_value(value)
+    
+    return entry_dict
+
+def process_file(record):
+    """Process a single file and return (extracted data, None) or (None, (name, error message))"""
+    try:
+        # Load the JSON data
+        return (flatten_entity(load_json(record)), None)
+        
     except Exception as e:
-        print(f"Failed to load or process {file_path}: {e}")
-        return (None, os.path.basename(file_path))
+        return (None, (record.name, str(e)))
+
+def entity_rows(record):
+    """Rows of one file for the incremental state; raises on failure"""
+    return [flatten_entity(load_json(record))]
 
-def write_batch_results(batch_results, batch_id):
-    """Write batch results to temporary files"""
+def process_batch(batch):
+    """
+    Process a batch of files in a worker
+
+    Returns:
+        (block of column -> values for the extracted entries, (failed file name, error)
+         pairs, names of every file in the batch, seconds taken)
+    """
+    start = time.perf_counter()
     entries = []
     failures = []
-    
-    for result in batch_results:
-        entry, failure = result
+    for record in batch:
+        entry, failure = process_file(record)
         if entry:
             entries.append(entry)
         if failure:
             failures.append(failure)
-    
-    # Save the batch results to a temp file
-    entries_file = os.path.join(temp_dir, f"entries_batch_{batch_id}.json")
-    failures_file = os.path.join(temp_dir, f"failures_batch_{batch_id}.json")
-    
-    with open(entries_file, 'w') as f:
-        json.dump(entries, f)
-    
-    with open(failures_file, 'w') as f:
-        json.dump(failures, f)
-    
-    print(f"Batch {batch_id} complete: {len(entries)} entries processed, {len(failures)} failures")
+    return rows_to_columns(entries), failures, [record.name for record in batch], time.perf_counter() - start
 
 def main():
+    parser = argparse.ArgumentParser(description="Flatten PDB polymer entity JSON into one combined table")
+    parser.add_argument('--resume', action='store_true',
+                        help="Carry on from the last checkpoint of a killed run instead of starting over")
+    args = parser.parse_args()
     
     # Remove existing output files if they exist
     try:
@@ -277,108 +304,105 @@ def main():
     except:
         pass
     
-    # Clear any existing temp files
-    for f in os.listdir(temp_dir):
-        if f.startswith("entries_batch_") or f.startswith("failures_batch_"):
-            os.remove(os.path.join(temp_dir, f))
+    # Files/s, parse and flush times go to the metrics textfile and summary (see metrics.py)
+    metrics = RunMetrics('v2pdb_async_entities_combined')
+    # One JSON line per failed file next to failed_output (see progress.py)
+    errors = ErrorLog(error_log_path(failed_output), logger, stage='extract')
+
+    # Files already in the spool of a killed run are skipped when resuming
+    checkpoint = Checkpoint(checkpoint_output, resume=args.resume and not incremental)
+    resume_from = checkpoint.state()
+    to_process = records
+    all_failures = []
+    if resume_from:
+        completed = checkpoint.completed()
+        all_failures = checkpoint.failed()
+        to_process = [r for r in records if r.name not in completed]
+        logger.info(f"Resuming: {len(completed)} files done, {len(to_process)} to go")
     
     # Determine optimal batch size and number of processes
     num_cores = 18
-    print(f"Using {num_cores} CPU cores")
+    logger.info(f"Using {num_cores} CPU cores")
     num_processes = max(1, min(num_cores - 1, 18))  # Leave one core free
     
-    # We want at least 100 files per batch for efficiency
-    batch_size = max(100, (total_files + num_processes - 1) // num_processes)
-    num_batches = (total_files + batch_size - 1) // batch_size
+    # We want at least 100 files per batch for efficiency and several batches
+    # per process so the pool stays busy, with at most max_batch_size files each
+    batch_size = min(max_batch_size, max(100, (len(to_process) + num_processes * 4 - 1) // (num_processes * 4)))
+    num_batches = (len(to_process) + batch_size - 1) // batch_size
+    batches = [to_process[start:start + batch_size] for start in range(0, len(to_process), batch_size)]
+    
+    logger.info(f"Processing {len(to_process)} files in {num_batches} batches of ~{batch_size} files each")
+    logger.info(f"Using {num_processes} parallel processes")
     
-    print(f"Processing {total_files} files in {num_batches} batches of ~{batch_size} files each")
-    print(f"Using {num_processes} parallel processes")
+    # Each batch comes back as one columnar block and is spooled as soon as it
+    # arrives; the unified, sorted header is written in one pass at the end.
+    # Batches arrive in completion order, so rows are not in file order.
+    table = StreamingTableWriter(
+        combined_output if output_format in ("csv", "both") else None,
+        quoting=csv.QUOTE_ALL, sort_columns=True,
+        parquet_path=parquet_output if output_format in ("parquet", "both") else None,
+        resume_from=resume_from)
     
     # Process batches
     start_time = time.time()
     
-    with mp.Pool(processes=num_processes) as pool:
-        for batch_id in range(num_batches):
-            batch_start = batch_id * batch_size
-            batch_end = min(batch_start + batch_size, total_files)
-            
-            print(f"Processing batch {batch_id+1}/{num_batches} (files {batch_start+1}-{batch_end})")
-            
-            # Process batch of files
-            batch_files = file_paths[batch_start:batch_end]
-            
-            # Create a partial function with batch_id
-            process_func = partial(process_file, batch_id=batch_id)
-            
-            # Process files in parallel
-            batch_results = pool.map(process_func, batch_files)
-            
-            # Write batch results to temporary files
-            write_batch_results(batch_results, batch_id)
+    if incremental:
+        # Flatten new and changed files only, then write every stored row; the
+        # state is committed as it goes, so this needs no checkpoint
+        state = ExtractionState(state_output)
+        all_failures = state.update(records, entity_rows, processes=num_processes, metrics=metrics,
+                                    errors=errors)
+        for entry in state.rows():
+            table.add(entry)
+        state.close()
+    else:
+        unsaved = 0
+        progress = Progress(len(to_process), logger)
+        with mp.Pool(processes=num_processes) as pool:
+            for block, failures, names, seconds in pool.imap_unordered(process_batch, batches):
+                table.add_columns(block)
+                # Workers time whole batches, so each file is recorded at its batch's mean
+                metrics.observe('parse_seconds', seconds / len(names), count=len(names))
+                metrics.count('files_parsed_total', len(names) - len(failures))
+                metrics.count('files_failed_total', len(failures))
+                for name, error in failures:
+                    errors.record(name, error)
+                    all_failures.append(name)
+                failed = set(name for name, _ in failures)
+                for name in names:
+                    checkpoint.done(name, failed=name in failed)
+                unsaved += len(names)
+                if unsaved >= checkpoint_every:
+                    checkpoint.save(table.checkpoint())
+                    unsaved = 0
+                progress.update(len(names), failed=len(failures))
+        progress.finish()
+        checkpoint.save(table.checkpoint())
     
     processing_time = time.time() - start_time
-    print(f"File processing completed in {processing_time:.2f} seconds")
-    
-    # Now collect all the entries and failures
-    print("Combining results from all batches...")
-    all_entries = []
-    all_failures = []
-    all_columns = set(['entity_id', 'entry_id'])
-    
-    for batch_id in range(num_batches):
-        entries_file = os.path.join(temp_dir, f"entries_batch_{batch_id}.json")
-        failures_file = os.path.join(temp_dir, f"failures_batch_{batch_id}.json")
-        
-        try:
-            with open(entries_file, 'r') as f:
-                batch_entries = json.load(f)
-                
-                for entry in batch_entries:
-                    all_columns.update(entry.keys())
-                
-                all_entries.extend(batch_entries)
-                
-            with open(failures_file, 'r') as f:
-                batch_failures = json.load(f)
-                all_failures.extend(batch_failures)
-                
-            # Clean up temp files as we go
-            os.remove(entries_file)
-            os.remove(failures_file)
-        except Exception as e:
-            print(f"Error processing batch {batch_id}: {e}")
-    
-    # Convert columns set to sorted list
-    all_columns = sorted(list(all_columns))
-    print(f"Found {len(all_columns)} unique columns across {len(all_entries)} entries")
-    print(f"{len(all_failures)} files failed to process")
+    logger.info(f"File processing completed in {processing_time:.2f} seconds")
     
-    # Write to final CSV
-    print("Writing data to CSV...")
+    # Write the final outputs from the spooled rows
+    logger.info("Writing output...")
     start_time = time.time()
-    
-    with open(combined_output, 'w', newline='', encoding='utf-8') as f:
-        writer = csv.writer(f, quoting=csv.QUOTE_ALL)
-        # Write header row
-        writer.writerow(all_columns)
-        
-        # Write data rows in batches to avoid memory issues
-        entry_batch_size = 10000
-        for i in range(0, len(all_entries), entry_batch_size):
-            end = min(i + entry_batch_size, len(all_entries))
-            print(f"Writing entries {i+1}-{end} of {len(all_entries)}")
-            
-            for entry_dict in all_entries[i:end]:
-                row = [entry_dict.get(col, "") for col in all_columns]
-                writer.writerow(row)
+    with metrics.timer('flush_seconds', table='entities'):
+        entry_count = table.close(keep_spool=True)
+    metrics.count('rows_written_total', entry_count, table='entities')
+    # The checkpoint goes before the spool it points at, so --resume never finds one without the other
+    checkpoint.remove()
+    table.remove_spool()
+    logger.info(f"Found {len(table.columns)} unique columns across {entry_count} entries")
+    logger.info(f"{len(all_failures)} files failed to process")
     
     # Save any failed filenames
     if all_failures:
         pd.DataFrame({'failed_filenames': all_failures}).to_csv(failed_output, index=False)
     
     writing_time = time.time() - start_time
-    print(f"CSV writing completed in {writing_time:.2f} seconds")
-    print(f"Total processing complete. Processed {total_files} files with {len(all_failures)} failures.")
+    logger.info(f"Output writing completed in {writing_time:.2f} seconds")
+    errors.close()
+    metrics.close()
+    logger.info(f"Total processing complete. Processed {total_files} files with {len(all_failures)} failures.")
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
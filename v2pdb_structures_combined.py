@@ -1,10 +1,21 @@
+import argparse
 import os
 import json
 import pandas as pd
 from collections import defaultdict
 import csv
+import multiprocessing as mp
+import time
+from checkpoint import Checkpoint
+from incremental_extract import ExtractionState
+from metrics import RunMetrics
+from progress import ErrorLog, Progress, error_log_path, get_logger
+from record_store import list_records, load_json
+from stream_extract import StreamingTableWriter
 
-# Set the folder path where the JSON files are located
+# Set the folder path (or record store) where the JSON files are located. Every key
+# becomes a column, so these must be REST pulls: GraphQL records (rcsb_graphql.py)
+# only hold the fields the other entry extractors read
 json_folder = '/kellogg/proj/rrh3749/Working_Projects/AlphaFold/data/pdb_json_structures'
 #json_folder = '/home/zhn1744/AlphaFold/data/pdb/entry_v2'
 
@@ -12,20 +23,35 @@ json_folder = '/kellogg/proj/rrh3749/Working_Projects/AlphaFold/data/pdb_json_st
 combined_output = "/home/zhn1744/AlphaFold/data/pdb/pdb_structures_combined.csv"
 failed_output = "/home/zhn1744/AlphaFold/data/failed/pdb_structures_failed.csv"
 
-failed_filenames = []
+# "csv", "parquet" or "both"
+output_format = "csv"
+parquet_output = "/home/zhn1744/AlphaFold/data/pdb/pdb_structures_combined.parquet"
+# Write the Parquet output as release_year=YYYY directories instead of one file
+partition_by_release_year = False
 
-# Remove existing output file if it exists
-try:
-    os.remove(combined_output)
-except:
-    pass
+# Progress is saved every checkpoint_every files so that a killed run can carry
+# on with --resume instead of starting over
+checkpoint_output = "/home/zhn1744/AlphaFold/data/pdb/pdb_structures_combined.checkpoint.sqlite"
+checkpoint_every = 20000
 
-# Get list of JSON files in the folder
-file_paths = [os.path.join(json_folder, f) for f in os.listdir(json_folder)
-              if f.startswith("response_entry_") and f.endswith(".json")]
-#file_paths = file_paths[:25]
-total_files = len(file_paths)
-print(f"Total files to process: {total_files}")
+# Only flatten files that are new or changed since the last run, keeping the
+# rows of every file in state_output (see incremental_extract.py)
+incremental = False
+state_output = "/home/zhn1744/AlphaFold/data/pdb/pdb_structures_combined.state.sqlite"
+
+# The columns are discovered from the data and hold sanitized strings; only the
+# dates get a Parquet type
+structure_types = {'deposition_date': 'timestamp', 'release_date': 'timestamp'}
+
+# Worker processes for flattening, leaving one core for the writer (the SLURM
+# allocation has 18+); set to 1 to run serially in this process
+num_processes = max(1, min(mp.cpu_count() - 1, 18))
+# Files handed to a worker per task; small enough that the work stays balanced
+# over the pool, large enough that each task is worth its pickling round trip
+max_chunk_size = 200
+
+# Throttled progress lines (see progress.py)
+logger = get_logger('v2pdb_structures_combined')
 
 # Dictionary to track which array fields we've seen and their maximum indices
 array_fields = defaultdict(int)
@@ -149,108 +175,214 @@ def extract_fields(data, prefix='', path=None):
     
     return result
 
-print("Processing PDB entries...")
-# Process all files and create entries
-all_entries = []
-all_columns = set(['pdb_id', 'deposition_date', 'release_date'])
+def extract_entry(data):
+    """
+    Flatten one entry document into a row
+
+    Args:
+        data: Decoded entry JSON (REST response)
+
+    Returns:
+        Dictionary mapping column name to sanitized value
+    """
+    pdb_id = data['rcsb_entry_container_identifiers']['entry_id']
+
+    # Handle potentially missing fields with safe access
+    deposition_date = data.get('pdbx_database_status', {}).get('recvd_initial_deposition_date', "")
+    release_date = data.get('rcsb_accession_info', {}).get('initial_release_date', "")
+
+    # Create base entry with core identifiers
+    entry_dict = {
+        'pdb_id': pdb_id,
+        'deposition_date': deposition_date,
+        'release_date': release_date
+    }
+
+    # Special handling for audit_author - concatenate all with # separator
+    if 'audit_author' in data:
+        entry_dict['audit_author'] = process_special_array(data['audit_author'], 'audit_author')
+
+    # Special handling for pdbx_database_related - concatenate all db_ids with # separator
+    if 'pdbx_database_related' in data:
+        entry_dict['pdbx_database_related_db_id'] = process_special_array(data['pdbx_database_related'], 'pdbx_database_related')
+
+    # Dynamically extract all other fields
+    for key, value in data.items():
+        # Skip fields already handled
+        if key in entry_dict or key in ('rcsb_entry_container_identifiers', 'pdbx_database_status', 'rcsb_accession_info', 'audit_author', 'pdbx_database_related'):
+            continue
 
-for index, file_path in enumerate(file_paths, start=1):
-    print(f"{index} of {total_files}")
+        # Handle different field types
+        if isinstance(value, dict):
+            # Handle dictionary fields - extract nested structure
+            extracted = extract_fields(value, key)
+            entry_dict.update(extracted)
+
+        elif isinstance(value, list):
+            # Special handling for citation - only keep the first one
+            if key == 'citation' and len(value) > 0:
+                # Only keep citation1 fields
+                for k, v in value[0].items():
+                    entry_dict[f"{key}1_{k}"] = sanitize_value(v)
+
+            # For most arrays, only keep the first element
+            elif len(value) > 0:
+                if key in ('resolution_combined', 'nonpolymer_bound_components', 
+                          'ndb_struct_conf_na_feature_combined', 'software_programs_combined'):
+                    # Keep these as full arrays
+                    entry_dict[key] = sanitize_value(value)
+                else:
+                    # For other arrays, take the first element but add '1' to the name
+                    item = value[0]
+                    if isinstance(item, dict):
+                        for k, v in item.items():
+                            entry_dict[f"{key}1_{k}"] = sanitize_value(v)
+                    else:
+                        entry_dict[f"{key}1"] = sanitize_value(item)
+
+        else:
+            # Simple scalar field
+            entry_dict[key] = sanitize_value(value)
     
+    return entry_dict
+
+def process_record(record):
+    """
+    Load and flatten one record in a worker
+
+    Returns:
+        (entry, None, seconds) on success, or (None, (name, error message), seconds) on failure
+    """
+    start = time.perf_counter()
     try:
-        # Load the JSON data
-        with open(file_path, "r") as f:
-            data = json.load(f)
-            pdb_id = data['rcsb_entry_container_identifiers']['entry_id']
-            
-            # Handle potentially missing fields with safe access
-            deposition_date = data.get('pdbx_database_status', {}).get('recvd_initial_deposition_date', "")
-            release_date = data.get('rcsb_accession_info', {}).get('initial_release_date', "")
-            
-            # Create base entry with core identifiers
-            entry_dict = {
-                'pdb_id': pdb_id,
-                'deposition_date': deposition_date,
-                'release_date': release_date
-            }
-            
-            # Special handling for audit_author - concatenate all with # separator
-            if 'audit_author' in data:
-                entry_dict['audit_author'] = process_special_array(data['audit_author'], 'audit_author')
-            
-            # Special handling for pdbx_database_related - concatenate all db_ids with # separator
-            if 'pdbx_database_related' in data:
-                entry_dict['pdbx_database_related_db_id'] = process_special_array(data['pdbx_database_related'], 'pdbx_database_related')
-            
-            # Dynamically extract all other fields
-            for key, value in data.items():
-                # Skip fields already handled
-                if key in entry_dict or key in ('rcsb_entry_container_identifiers', 'pdbx_database_status', 'rcsb_accession_info', 'audit_author', 'pdbx_database_related'):
-                    continue
-                
-                # Handle different field types
-                if isinstance(value, dict):
-                    # Handle dictionary fields - extract nested structure
-                    extracted = extract_fields(value, key)
-                    entry_dict.update(extracted)
-                
-                elif isinstance(value, list):
-                    # Special handling for citation - only keep the first one
-                    if key == 'citation' and len(value) > 0:
-                        # Only keep citation1 fields
-                        for k, v in value[0].items():
-                            entry_dict[f"{key}1_{k}"] = sanitize_value(v)
-                    
-                    # For most arrays, only keep the first element
-                    elif len(value) > 0:
-                        if key in ('resolution_combined', 'nonpolymer_bound_components', 
-                                  'ndb_struct_conf_na_feature_combined', 'software_programs_combined'):
-                            # Keep these as full arrays
-                            entry_dict[key] = sanitize_value(value)
-                        else:
-                            # For other arrays, take the first element but add '1' to the name
-                            item = value[0]
-                            if isinstance(item, dict):
-                                for k, v in item.items():
-                                    entry_dict[f"{key}1_{k}"] = sanitize_value(v)
-                            else:
-                                entry_dict[f"{key}1"] = sanitize_value(item)
-                
-                else:
-                    # Simple scalar field
-                    entry_dict[key] = sanitize_value(value)
-            
-            # Add all keys from this entry to the master set of columns
-            all_columns.update(entry_dict.keys())
-            
-            # Store the entry
-            all_entries.append(entry_dict)
-            
+        return extract_entry(load_json(record)), None, time.perf_counter() - start
     except Exception as e:
-        print(f"Failed to load or process {file_path}: {e}")
-        failed_filenames.append(os.path.basename(file_path))
-        continue
-
-# Convert set to list and sort for consistent ordering
-all_columns = sorted(list(all_columns))
-print(f"Found {len(all_columns)} unique columns across {len(all_entries)} entries.")
-
-print("Writing data to CSV...")
-# Now write the CSV with all discovered columns
-with open(combined_output, 'w', newline='', encoding='utf-8') as f:
-    writer = csv.writer(f, quoting=csv.QUOTE_ALL)
-    # Write header row
-    writer.writerow(all_columns)
-    
-    # Write data rows
-    for entry_index, entry_dict in enumerate(all_entries, 1):
-        if entry_index % 1000 == 0:
-            print(f"Writing entry {entry_index} of {len(all_entries)}")
-        row = [entry_dict.get(col, "") for col in all_columns]
-        writer.writerow(row)
-
-# Save any failed filenames
-if failed_filenames:
-    pd.DataFrame({'failed_filenames': failed_filenames}).to_csv(failed_output, index=False)
-
-print(f"Processing complete. Processed {total_files} files with {len(failed_filenames)} failures.")
\ No newline at end of file
+        return None, (record.name, str(e)), time.perf_counter() - start
+
+def structure_rows(record):
+    """Rows of one file for the incremental state; raises on failure"""
+    return [extract_entry(load_json(record))]
+
+def choose_chunk_size(total_files, processes):
+    # About four chunks per worker keeps stragglers short on small runs
+    return max(1, min(max_chunk_size, total_files // (processes * 4)))
+
+def flatten_all(records, table, failed_filenames, checkpoint, metrics=None, errors=None):
+    """Flatten every record across the worker pool into table, saving progress to checkpoint"""
+    total_files = len(records)
+    progress = Progress(total_files, logger)
+    processes = min(num_processes, max(1, total_files))
+    chunk_size = choose_chunk_size(total_files, processes)
+    logger.info(f"Using {processes} processes, {chunk_size} files per task")
+
+    # imap hands out chunks of files but yields results in input order, so the
+    # spooled rows (and the column order they imply) match a serial run
+    if processes > 1:
+        pool = mp.Pool(processes=processes)
+        results = pool.imap(process_record, records, chunksize=chunk_size)
+    else:
+        pool = None
+        results = map(process_record, records)
+
+    try:
+        for index, (record, (entry, failure, seconds)) in enumerate(zip(records, results), start=1):
+            if failure is None:
+                table.add(entry)
+                checkpoint.done(record.name)
+            else:
+                name, error = failure
+                if errors is not None:
+                    errors.record(name, error)
+                failed_filenames.append(name)
+                checkpoint.done(name, failed=True)
+            if metrics is not None:
+                metrics.observe('parse_seconds', seconds)
+                metrics.count('files_parsed_total' if failure is None else 'files_failed_total')
+
+            if index % checkpoint_every == 0:
+                checkpoint.save(table.checkpoint())
+
+            progress.update(failed=int(failure is not None))
+        progress.finish()
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+
+def main():
+    parser = argparse.ArgumentParser(description="Flatten PDB entry JSON into one combined table")
+    parser.add_argument('--resume', action='store_true',
+                        help="Carry on from the last checkpoint of a killed run instead of starting over")
+    args = parser.parse_args()
+
+    failed_filenames = []
+
+    # Files/s, parse and flush times go to the metrics textfile and summary (see metrics.py)
+    metrics = RunMetrics('v2pdb_structures_combined')
+    # One JSON line per failed file next to failed_output (see progress.py)
+    errors = ErrorLog(error_log_path(failed_output), logger, stage='extract')
+
+    # Remove existing output file if it exists
+    try:
+        os.remove(combined_output)
+    except:
+        pass
+
+    # Get list of JSON records in the folder
+    records = list_records(json_folder, "response_entry_")
+    #records = records[:25]
+    total_files = len(records)
+    logger.info(f"Total files to process: {total_files}")
+
+    # Files already in the spool of a killed run are skipped when resuming
+    checkpoint = Checkpoint(checkpoint_output, resume=args.resume and not incremental)
+    resume_from = checkpoint.state()
+    if resume_from:
+        completed = checkpoint.completed()
+        failed_filenames = checkpoint.failed()
+        records = [r for r in records if r.name not in completed]
+        logger.info(f"Resuming: {len(completed)} files done, {len(records)} to go")
+
+    # Rows are spooled to disk as they are flattened and the unified, sorted
+    # header is written in one pass at the end, so memory does not grow with the archive
+    table = StreamingTableWriter(
+        combined_output if output_format in ("csv", "both") else None,
+        quoting=csv.QUOTE_ALL, sort_columns=True,
+        parquet_path=parquet_output if output_format in ("parquet", "both") else None,
+        parquet_types=structure_types, partition_by='release_date' if partition_by_release_year else None,
+        resume_from=resume_from)
+
+    logger.info("Processing PDB entries...")
+    if incremental:
+        # Flatten new and changed files only, then write every stored row; the
+        # state is committed as it goes, so this needs no checkpoint
+        state = ExtractionState(state_output)
+        failed_filenames = state.update(records, structure_rows, processes=num_processes, metrics=metrics,
+                                        errors=errors)
+        for entry in state.rows():
+            table.add(entry)
+        state.close()
+    else:
+        flatten_all(records, table, failed_filenames, checkpoint, metrics, errors)
+        checkpoint.save(table.checkpoint())
+
+    logger.info("Writing output...")
+    with metrics.timer('flush_seconds', table='structures'):
+        entry_count = table.close(keep_spool=True)
+    metrics.count('rows_written_total', entry_count, table='structures')
+    # The checkpoint goes before the spool it points at, so --resume never finds one without the other
+    checkpoint.remove()
+    table.remove_spool()
+    logger.info(f"Found {len(table.columns)} unique columns across {entry_count} entries.")
+
+    # Save any failed filenames
+    if failed_filenames:
+        pd.DataFrame({'failed_filenames': failed_filenames}).to_csv(failed_output, index=False)
+
+    errors.close()
+    metrics.close()
+    logger.info(f"Processing complete. Processed {total_files} files with {len(failed_filenames)} failures.")
+
+
+if __name__ == "__main__":
+    main()